@@ -1,7 +1,13 @@
+from collections import OrderedDict
+from datetime import timedelta
 from functools import reduce
-from model import Cash, Trade, Instrument, Option, LiveDataProvider, Quote, Position
+from model import Cash, Currency, Trade, Instrument, Option, LiveDataProvider, Quote, Position
 from progress.bar import Bar
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import asyncio
+import logging
+import time
 
 
 def tradeAffectsSymbol(trade: Trade, symbol: str) -> bool:
@@ -20,27 +26,267 @@ def realizedBasisForSymbol(symbol: str,
                   None)
 
 
-def liveValuesForPositions(
-        positions: Iterable[Position],
-        dataProvider: LiveDataProvider,
-        progressBar: Optional[Bar] = None,
-) -> Dict[Position, Cash]:
-    def priceFromQuote(q: Quote, p: Position) -> Optional[Cash]:
-        # For a long position, the value should be what the market is willing to pay right now.
-        # For a short position, the value should be what the market is asking to be paid right now.
-        if p.quantity < 0:
-            return q.ask or q.last or q.bid or q.close
-        else:
-            return q.bid or q.last or q.ask or q.close
+# Calculates the realized basis (see realizedBasisForSymbol) of every symbol affected by the given trade history, in a single pass. Option trades count toward both their own symbol and their underlying's.
+#
+# If `symbols` is given, only the bases of those symbols are calculated, so trades in other symbols (whose amounts might not be summable, e.g., because of fees in another currency) are ignored.
+def realizedBasisBySymbol(trades: Iterable[Trade],
+                          symbols: Optional[Iterable[str]] = None
+                          ) -> Dict[str, Cash]:
+    result: Dict[str, Cash] = {}
+    wanted = set(symbols) if symbols is not None else None
+
+    def accumulate(symbol: str, trade: Trade) -> None:
+        if wanted is not None and symbol not in wanted:
+            return
+
+        basis = result.get(symbol)
+        result[symbol] = basis - trade.proceeds if basis else -trade.proceeds
+
+    for t in trades:
+        instrument = t.instrument
+        accumulate(instrument.symbol, t)
+
+        # Avoid counting a trade twice if its symbol and underlying coincide.
+        if isinstance(instrument,
+                      Option) and instrument.underlying != instrument.symbol:
+            accumulate(instrument.underlying, t)
 
+    return result
+
+
+def priceFromQuote(q: Quote, p: Position) -> Optional[Cash]:
+    # For a long position, the value should be what the market is willing to pay right now.
+    # For a short position, the value should be what the market is asking to be paid right now.
+    if p.quantity < 0:
+        return q.ask or q.last or q.bid or q.close
+    else:
+        return q.bid or q.last or q.ask or q.close
+
+
+def marketValueFromQuote(q: Quote, p: Position) -> Optional[Cash]:
+    price = priceFromQuote(q, p)
+    if not price:
+        return None
+
+    return price * p.quantity * p.instrument.multiplier
+
+
+def liveValuesForQuotes(positions: Iterable[Position],
+                        quotes: Dict[Instrument, Quote],
+                        progressBar: Optional[Bar] = None
+                        ) -> Dict[Position, Cash]:
     result = {}
     it = progressBar.iter(positions) if progressBar else positions
 
     for p in it:
-        price = priceFromQuote(dataProvider.fetchQuote(p.instrument), p)
-        if not price:
+        quote = quotes.get(p.instrument)
+        if quote is None:
             continue
 
-        result[p] = price * p.quantity * p.instrument.multiplier
+        value = marketValueFromQuote(quote, p)
+        if value is None:
+            continue
+
+        result[p] = value
 
     return result
+
+
+def liveValuesForPositions(
+        positions: Iterable[Position],
+        dataProvider: LiveDataProvider,
+        progressBar: Optional[Bar] = None,
+) -> Dict[Position, Cash]:
+    positions = list(positions)
+    instruments = set(p.instrument for p in positions)
+
+    # Quotes are fetched in one batch, which is where the time goes, so the progress bar tracks that rather than valuing the positions afterward.
+    if progressBar:
+        progressBar.max = len(instruments)
+        progressBar.start()
+
+    quotes = dataProvider.fetchQuotes(instruments)
+
+    if progressBar:
+        progressBar.next(len(instruments))
+        progressBar.finish()
+
+    return liveValuesForQuotes(positions, quotes)
+
+
+# Like liveValuesForPositions, but requests quotes concurrently, with at most `maxConcurrentRequests` in flight at once.
+async def liveValuesForPositionsAsync(
+        positions: Iterable[Position],
+        dataProvider: LiveDataProvider,
+        maxConcurrentRequests: int = 50,
+        progressBar: Optional[Bar] = None,
+) -> Dict[Position, Cash]:
+    if maxConcurrentRequests <= 0:
+        raise ValueError(
+            'Expected positive maximum number of concurrent requests: {}'.
+            format(maxConcurrentRequests))
+
+    positions = list(positions)
+    instruments = set(p.instrument for p in positions)
+    semaphore = asyncio.Semaphore(maxConcurrentRequests)
+
+    if progressBar:
+        progressBar.max = len(instruments)
+        progressBar.start()
+
+    async def fetch(instrument: Instrument) -> Optional[Quote]:
+        try:
+            async with semaphore:
+                return await dataProvider.fetchQuoteAsync(instrument)
+        except ValueError as err:
+            logging.warning('Could not fetch quote for {}: {}'.format(
+                instrument, err))
+            return None
+        finally:
+            if progressBar:
+                progressBar.next()
+
+    fetched = await asyncio.gather(*(fetch(i) for i in instruments))
+
+    if progressBar:
+        progressBar.finish()
+
+    quotes = {
+        i: quote
+        for (i, quote) in zip(instruments, fetched) if quote is not None
+    }
+
+    return liveValuesForQuotes(positions, quotes)
+
+
+# Keeps the market values of positions up to date as new quotes arrive. Each quote only revalues the positions in that instrument, and portfolio totals (per currency) are adjusted incrementally.
+class LiveValueTracker:
+    def __init__(self, positions: Iterable[Position]):
+        self._positionsByInstrument: Dict[Instrument, List[Position]] = {}
+        for p in positions:
+            self._positionsByInstrument.setdefault(p.instrument, []).append(p)
+
+        self._values: Dict[Position, Cash] = {}
+        self._totals: Dict[Currency, Cash] = {}
+        super().__init__()
+
+    @property
+    def instruments(self) -> Iterable[Instrument]:
+        return self._positionsByInstrument.keys()
+
+    @property
+    def values(self) -> Dict[Position, Cash]:
+        return self._values
+
+    @property
+    def totals(self) -> Dict[Currency, Cash]:
+        return self._totals
+
+    def _adjustTotal(self, value: Cash) -> None:
+        total = self._totals.get(value.currency)
+        self._totals[
+            value.currency] = total + value if total is not None else value
+
+    def update(self, instrument: Instrument, quote: Quote) -> None:
+        for p in self._positionsByInstrument.get(instrument, []):
+            oldValue = self._values.pop(p, None)
+            if oldValue is not None:
+                self._adjustTotal(-oldValue)
+
+            newValue = marketValueFromQuote(quote, p)
+            if newValue is not None:
+                self._values[p] = newValue
+                self._adjustTotal(newValue)
+
+
+# Wraps another LiveDataProvider, remembering the quotes it returns for up to `ttl`. At most `maxEntries` quotes are kept, evicting the least recently used first.
+class CachingDataProvider(LiveDataProvider):
+    def __init__(self,
+                 inner: LiveDataProvider,
+                 ttl: timedelta,
+                 maxEntries: int = 1000,
+                 clock: Callable[[], float] = time.monotonic):
+        if maxEntries <= 0:
+            raise ValueError(
+                'Expected positive maximum number of entries: {}'.format(
+                    maxEntries))
+
+        # Maps each instrument to the time its quote expires, and the quote itself.
+        entries: 'OrderedDict[Instrument, Tuple[float, Quote]]' = OrderedDict()
+
+        self._inner = inner
+        self._ttl = ttl.total_seconds()
+        self._maxEntries = maxEntries
+        self._clock = clock
+        self._entries = entries
+        self._hits = 0
+        self._misses = 0
+        super().__init__()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def _lookup(self, instrument: Instrument) -> Optional[Quote]:
+        entry = self._entries.get(instrument)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        (expiry, quote) = entry
+        if self._clock() >= expiry:
+            del self._entries[instrument]
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(instrument)
+        self._hits += 1
+        return quote
+
+    def _store(self, instrument: Instrument, quote: Quote) -> None:
+        self._entries[instrument] = (self._clock() + self._ttl, quote)
+        self._entries.move_to_end(instrument)
+
+        while len(self._entries) > self._maxEntries:
+            self._entries.popitem(last=False)
+
+    def fetchQuote(self, instrument: Instrument) -> Quote:
+        quote = self._lookup(instrument)
+        if quote is None:
+            quote = self._inner.fetchQuote(instrument)
+            self._store(instrument, quote)
+
+        return quote
+
+    def fetchQuotes(self, instruments: Iterable[Instrument]
+                    ) -> Dict[Instrument, Quote]:
+        result: Dict[Instrument, Quote] = {}
+        missing = []
+
+        for i in instruments:
+            quote = self._lookup(i)
+            if quote is None:
+                missing.append(i)
+            else:
+                result[i] = quote
+
+        if missing:
+            fetched = self._inner.fetchQuotes(missing)
+            for i, quote in fetched.items():
+                self._store(i, quote)
+
+            result.update(fetched)
+
+        return result
+
+    async def fetchQuoteAsync(self, instrument: Instrument) -> Quote:
+        quote = self._lookup(instrument)
+        if quote is None:
+            quote = await self._inner.fetchQuoteAsync(instrument)
+            self._store(instrument, quote)
+
+        return quote
@@ -1,18 +1,22 @@
 from argparse import ArgumentParser, Namespace
-from functools import reduce
-from ib_insync import IB
-from itertools import groupby
+from concurrent.futures import Executor
+from datetime import timedelta
+from decimal import Decimal
+from dedup import deduplicateTrades
 from model import Instrument, Stock, Position, Trade, Cash, LiveDataProvider
+from parsetools import ParseErrors
 from pathlib import Path
-from progress.bar import Bar
-from typing import Dict, Iterable, List, Optional
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypeVar, TYPE_CHECKING
 
-import analysis
-import ibkr
-import fidelity
+import asyncio
 import logging
-import schwab
-import vanguard
+
+# Broker modules (and especially ib_insync) are slow to import, so are only imported when the options which need them are given. See tests/test_importtime.py.
+if TYPE_CHECKING:
+    from ib_insync import IB
+    from parsecache import ParseCache
+    import ibkr
+    import vanguard
 
 parser = ArgumentParser()
 
@@ -23,6 +27,21 @@ parser.add_argument(
     default=False,
     action='store_true')
 parser.add_argument('--no-lenient', dest='lenient', action='store_false')
+parser.add_argument(
+    '--cache-dir',
+    help=
+    'Directory in which to cache parsed statements, so unchanged files need not be parsed again',
+    type=Path,
+    default=Path.home() / '.bankroll' / 'parsecache')
+parser.add_argument('--cache-size',
+                    help='Maximum size of the parse cache, in megabytes',
+                    type=int,
+                    default=64)
+parser.add_argument('--no-cache',
+                    help='Always parse statements, without using the cache',
+                    dest='cache',
+                    default=True,
+                    action='store_false')
 parser.add_argument('-v',
                     '--verbose',
                     help='More logging.',
@@ -47,6 +66,17 @@ ibGroup.add_argument(
     help=
     'Query ID from IB\'s Flex Web Service: https://www.interactivebrokers.com/en/software/am/am/reports/flex_web_service_version_3.htm',
     type=int)
+ibGroup.add_argument(
+    '--contractcache',
+    help=
+    'Path to a file caching contracts qualified by IB, so they do not need to be looked up again on later runs',
+    type=Path,
+    default=Path.home() / '.bankroll' / 'ibcontracts.json')
+ibGroup.add_argument(
+    '--flexstore',
+    help=
+    'Path to a local store of trades downloaded from IB\'s Flex Web Service. Downloads only add trades not already in the store, and the whole store is imported. Without --flextoken, trades are imported from the store alone',
+    type=Path)
 ibGroup.add_argument(
     '--ibtrades',
     help=
@@ -86,35 +116,227 @@ vanguardGroup.add_argument(
     type=Path)
 
 
-def combinePositions(positions: Iterable[Position]) -> Iterable[Position]:
-    return (reduce(lambda a, b: a.combine(b), ps)
-            for i, ps in groupby(sorted(positions, key=lambda p: p.instrument),
-                                 key=lambda p: p.instrument))
+# Combines positions in the same instrument (e.g., held in different accounts), returning them sorted by instrument.
+#
+# This is equivalent to Position.combine() over each group of positions, but sums quantities and cost bases in a single pass, only creating one new Position per instrument. See ledger.PositionLedger for a columnar equivalent.
+def combinePositions(positions: Iterable[Position]) -> List[Position]:
+    # Per instrument: the first position seen, then the running quantity and cost basis (in Cash units), and the number of positions combined.
+    totals: Dict[Instrument, Tuple[Position, Decimal, int, int]] = {}
+
+    for p in positions:
+        total = totals.get(p.instrument)
+        if total is None:
+            totals[p.instrument] = (p, p.quantity, p.costBasis.units, 1)
+        else:
+            (first, quantity, costBasis, count) = total
+            totals[p.instrument] = (first, quantity + p.quantity,
+                                    costBasis + p.costBasis.units, count + 1)
+
+    return [
+        first if count == 1 else Position(
+            instrument=instrument,
+            quantity=quantity,
+            costBasis=Cash.fromUnits(first.costBasis.currency, costBasis))
+        for (instrument,
+             (first, quantity, costBasis,
+              count)) in sorted(totals.items(), key=lambda item: item[0])
+    ]
 
 
 positions: List[Position] = []
 trades: List[Trade] = []
 dataProvider: Optional[LiveDataProvider] = None
+parseCache: Optional['ParseCache'] = None
 
+T = TypeVar('T')
 
-def printPositions(args: Namespace) -> None:
-    values: Dict[Position, Cash] = {}
-    if args.live_value:
-        if dataProvider:
-            values = analysis.liveValuesForPositions(
-                positions,
-                dataProvider=dataProvider,
-                progressBar=Bar('Loading market data for positions'))
-        else:
-            logging.error(
-                'Live data connection required to fetch market values')
 
+# Runs a file parser, using the given cache if any, and returns its result along with the failures it skipped. This is a top-level function so it can be run in a worker process.
+def parseFile(parse: Callable[..., T], path: Path, lenient: bool,
+              cache: Optional['ParseCache']) -> Tuple[T, ParseErrors]:
+    errors = ParseErrors()
+    if cache:
+        return (cache.parse(parse, path, lenient=lenient,
+                            errors=errors), errors)
+    else:
+        return (parse(path, lenient=lenient, errors=errors), errors)
+
+
+class LoadedSource(NamedTuple):
+    positions: List[Position]
+    trades: List[Trade]
+    errors: Optional[ParseErrors] = None
+
+
+def loadedPositions(positions: List[Position]) -> LoadedSource:
+    return LoadedSource(positions=positions, trades=[])
+
+
+def loadedTrades(trades: List[Trade]) -> LoadedSource:
+    return LoadedSource(positions=[], trades=trades)
+
+
+def loadedPositionsAndTrades(result: 'vanguard.PositionsAndTrades'
+                             ) -> LoadedSource:
+    return LoadedSource(positions=result.positions, trades=result.trades)
+
+
+# Loads every configured source concurrently: files are parsed in a process pool, while the connection to TWS and the Flex report download proceed on the event loop.
+#
+# Results are merged in a fixed order (the order of the options), regardless of which source finishes first. Returns the connected IB client, if any.
+async def loadSources(args: Namespace) -> Tuple[LoadedSource, Optional['IB']]:
+    if args.flextoken or args.flexquery:
+        if not args.flextoken or not args.flexquery:
+            raise Exception(
+                'Both a Flex token and a Flex query ID are required to download trade reports'
+            )
+
+    loop = asyncio.get_event_loop()
+    ib: Optional['IB'] = None
+
+    async def connectTWS() -> LoadedSource:
+        from ib_insync import IB
+        import ibkr
+
+        nonlocal ib
+        ib = IB()
+        await ib.connectAsync('127.0.0.1', port=args.twsport)
+
+        errors = ParseErrors()
+        return loadedPositions(
+            ibkr.downloadPositions(ib, lenient=args.lenient,
+                                   errors=errors))._replace(errors=errors)
+
+    async def downloadFlexTrades() -> LoadedSource:
+        import ibkr
+
+        errors = ParseErrors()
+
+        # The Flex web service client and the trade store block, so run them on a thread.
+        def download() -> List[Trade]:
+            store = ibkr.TradeStore(args.flexstore) if args.flexstore else None
+            return ibkr.downloadTrades(token=args.flextoken,
+                                       queryID=args.flexquery,
+                                       lenient=args.lenient,
+                                       store=store,
+                                       errors=errors)
+
+        return loadedTrades(await loop.run_in_executor(
+            None, download))._replace(errors=errors)
+
+    async def loadStoredTrades() -> LoadedSource:
+        import ibkr
+
+        errors = ParseErrors()
+
+        def load() -> List[Trade]:
+            return ibkr.TradeStore(args.flexstore).trades(lenient=args.lenient,
+                                                          errors=errors)
+
+        return loadedTrades(await
+                            loop.run_in_executor(None,
+                                                 load))._replace(errors=errors)
+
+    fileOptions = [
+        args.fidelitypositions, args.fidelitytransactions,
+        args.schwabpositions, args.schwabtransactions, args.vanguardstatement,
+        args.ibtrades
+    ]
+
+    # Starting worker processes only pays off if there are files to parse in parallel. Otherwise, parse on the event loop's default thread pool.
+    executor: Optional[Executor] = None
+    if len([o for o in fileOptions if o]) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor()
+
+    try:
+
+        async def parseInPool(parse: Callable[..., T], path: Path,
+                              load: Callable[[T], LoadedSource]
+                              ) -> LoadedSource:
+            (result,
+             errors) = await loop.run_in_executor(executor, parseFile, parse,
+                                                  path, args.lenient,
+                                                  parseCache)
+            return load(result)._replace(errors=errors)
+
+        # Each source is named after the option which configured it, for reporting.
+        sources: List[Tuple[str, Awaitable[LoadedSource]]] = []
+        if args.fidelitytransactions or args.fidelitypositions:
+            import fidelity
+        if args.schwabpositions or args.schwabtransactions:
+            import schwab
+        if args.vanguardstatement:
+            import vanguard
+        if args.ibtrades:
+            import ibkr
+
+        if args.fidelitypositions:
+            sources.append(
+                ('--fidelitypositions',
+                 parseInPool(fidelity.parsePositions, args.fidelitypositions,
+                             loadedPositions)))
+        if args.fidelitytransactions:
+            sources.append(
+                ('--fidelitytransactions',
+                 parseInPool(fidelity.parseTransactions,
+                             args.fidelitytransactions, loadedTrades)))
+        if args.schwabpositions:
+            sources.append(
+                ('--schwabpositions',
+                 parseInPool(schwab.parsePositions, args.schwabpositions,
+                             loadedPositions)))
+        if args.schwabtransactions:
+            sources.append(
+                ('--schwabtransactions',
+                 parseInPool(schwab.parseTransactions, args.schwabtransactions,
+                             loadedTrades)))
+        if args.vanguardstatement:
+            sources.append(('--vanguardstatement',
+                            parseInPool(vanguard.parsePositionsAndTrades,
+                                        args.vanguardstatement,
+                                        loadedPositionsAndTrades)))
+        if args.twsport:
+            sources.append(('--twsport', connectTWS()))
+        if args.flextoken:
+            sources.append(('--flextoken', downloadFlexTrades()))
+        elif args.flexstore:
+            sources.append(('--flexstore', loadStoredTrades()))
+        if args.ibtrades:
+            sources.append(('--ibtrades',
+                            parseInPool(ibkr.parseTrades, args.ibtrades,
+                                        loadedTrades)))
+
+        # gather() returns results in the order given, not completion order.
+        loaded = await asyncio.gather(*(s for (_, s) in sources))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    # Report skipped inputs once, instead of warning about each.
+    for ((name, _), l) in zip(sources, loaded):
+        if l.errors:
+            logging.warning('{}: {}'.format(name, l.errors.summary()))
+
+    # Sources can overlap (e.g., an exported Flex report and a fresh download), so don't import the same trade twice.
+    deduplicated = deduplicateTrades([
+        (name, l.trades) for ((name, _), l) in zip(sources, loaded)
+    ])
+    for (name, count) in deduplicated.duplicatesBySource.items():
+        logging.info('Dropped {} duplicate trades from {}'.format(count, name))
+
+    return (LoadedSource(positions=[p for l in loaded for p in l.positions],
+                         trades=deduplicated.trades), ib)
+
+
+def printPositionsReport(args: Namespace, values: Dict[Position, Cash],
+                         realizedBases: Dict[str, Cash]) -> None:
     for p in sorted(positions, key=lambda p: p.instrument):
         print(p)
 
         if p in values:
             print('\tMarket value: {}'.format(values[p]))
-        elif args.live_value:
+        elif args.live_value and not args.watch:
             logging.warning('Could not fetch market value for {}'.format(
                 p.instrument))
 
@@ -124,11 +346,89 @@ def printPositions(args: Namespace) -> None:
         print('\tCost basis: {}'.format(p.costBasis))
 
         if args.realized_basis:
-            realizedBasis = analysis.realizedBasisForSymbol(
-                p.instrument.symbol, trades=trades)
+            realizedBasis = realizedBases.get(p.instrument.symbol)
             print('\tRealized basis: {}'.format(realizedBasis))
 
 
+async def watchPositions(args: Namespace, dataProvider: 'ibkr.IBDataProvider',
+                         realizedBases: Dict[str, Cash]) -> None:
+    import analysis
+
+    tracker = analysis.LiveValueTracker(positions)
+
+    try:
+        # Instruments beyond the available market data lines are polled at the refresh interval instead.
+        await dataProvider.subscribeQuotes(
+            tracker.instruments,
+            onQuote=tracker.update,
+            pollInterval=timedelta(seconds=args.refresh_interval))
+
+        while True:
+            # Clear the terminal and redraw from the top.
+            print('\x1b[2J\x1b[H', end='')
+            printPositionsReport(args, tracker.values, realizedBases)
+
+            print()
+            for currency, total in sorted(tracker.totals.items(),
+                                          key=lambda kv: kv[0].value):
+                print('Total market value ({}): {}'.format(
+                    currency.value, total))
+
+            await asyncio.sleep(args.refresh_interval)
+    finally:
+        await dataProvider.unsubscribeQuotes()
+
+
+def printPositions(args: Namespace) -> None:
+    import analysis
+
+    realizedBases: Dict[str, Cash] = {}
+    if args.realized_basis:
+        realizedBases = analysis.realizedBasisBySymbol(
+            trades, symbols=(p.instrument.symbol for p in positions))
+
+    if args.watch:
+        import ibkr
+
+        if not args.live_value:
+            logging.error('--watch requires --live-value')
+        elif isinstance(dataProvider, ibkr.IBDataProvider):
+            loop = asyncio.get_event_loop()
+            watch = loop.create_task(
+                watchPositions(args, dataProvider, realizedBases))
+            try:
+                loop.run_until_complete(watch)
+            except KeyboardInterrupt:
+                # The interrupt escapes run_until_complete() while watchPositions() is suspended, so its cleanup hasn't run. Cancel it explicitly, to close the subscriptions.
+                watch.cancel()
+                try:
+                    loop.run_until_complete(watch)
+                except asyncio.CancelledError:
+                    pass
+        else:
+            logging.error(
+                'Live data connection to TWS required to watch market values')
+
+        return
+
+    values: Dict[Position, Cash] = {}
+    if args.live_value:
+        if dataProvider:
+            from progress.bar import Bar
+
+            values = asyncio.get_event_loop().run_until_complete(
+                analysis.liveValuesForPositionsAsync(
+                    positions,
+                    dataProvider=dataProvider,
+                    maxConcurrentRequests=args.max_quote_requests,
+                    progressBar=Bar('Loading market data for positions')))
+        else:
+            logging.error(
+                'Live data connection required to fetch market values')
+
+    printPositionsReport(args, values, realizedBases)
+
+
 def printTrades(args: Namespace) -> None:
     for t in sorted(trades, key=lambda t: t.date, reverse=True):
         print(t)
@@ -154,6 +454,22 @@ positionsParser.add_argument(
     help='Fetch live, mark-to-market value of positions',
     default=False,
     action='store_true')
+positionsParser.add_argument(
+    '--max-quote-requests',
+    help=
+    'Maximum number of market data requests to have in flight at once when fetching live values',
+    type=int,
+    default=50)
+positionsParser.add_argument(
+    '--watch',
+    help=
+    'Keep market data subscriptions open, and periodically redraw positions as live values change (requires --live-value)',
+    default=False,
+    action='store_true')
+positionsParser.add_argument('--refresh-interval',
+                             help='Seconds between redraws when using --watch',
+                             type=float,
+                             default=5)
 
 tradesParser = subparsers.add_parser(
     'trades', help='Operations upon the imported list of trades')
@@ -167,49 +483,23 @@ if __name__ == '__main__':
         parser.print_usage()
         quit(1)
 
-    if args.fidelitypositions:
-        positions += fidelity.parsePositions(args.fidelitypositions,
-                                             lenient=args.lenient)
-
-    if args.fidelitytransactions:
-        trades += fidelity.parseTransactions(args.fidelitytransactions,
-                                             lenient=args.lenient)
-
-    if args.schwabpositions:
-        positions += schwab.parsePositions(args.schwabpositions,
-                                           lenient=args.lenient)
-
-    if args.schwabtransactions:
-        trades += schwab.parseTransactions(args.schwabtransactions,
-                                           lenient=args.lenient)
+    if args.cache:
+        from parsecache import ParseCache
 
-    if args.vanguardstatement:
-        positionsAndTrades = vanguard.parsePositionsAndTrades(
-            args.vanguardstatement, lenient=args.lenient)
-        positions += positionsAndTrades.positions
-        trades += positionsAndTrades.trades
+        parseCache = ParseCache(args.cache_dir,
+                                maxBytes=args.cache_size * 1024 * 1024)
 
-    if args.twsport:
-        ib = IB()
-        ib.connect('127.0.0.1', port=args.twsport)
-
-        if not dataProvider:
-            dataProvider = ibkr.IBDataProvider(ib)
-
-        positions += ibkr.downloadPositions(ib, lenient=args.lenient)
-
-    if args.flextoken or args.flexquery:
-        if not args.flextoken or not args.flexquery:
-            raise Exception(
-                'Both a Flex token and a Flex query ID are required to download trade reports'
-            )
+    (loaded,
+     ib) = asyncio.get_event_loop().run_until_complete(loadSources(args))
+    positions += loaded.positions
+    trades += loaded.trades
 
-        trades += ibkr.downloadTrades(token=args.flextoken,
-                                      queryID=args.flexquery,
-                                      lenient=args.lenient)
+    if ib and not dataProvider:
+        import ibkr
 
-    if args.ibtrades:
-        trades += ibkr.parseTrades(args.ibtrades, lenient=args.lenient)
+        dataProvider = ibkr.IBDataProvider(ib,
+                                           contractCache=ibkr.ContractCache(
+                                               args.contractcache))
 
-    positions = list(combinePositions(positions))
+    positions = combinePositions(positions)
     commands[args.command](args)
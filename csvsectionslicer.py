@@ -1,7 +1,12 @@
+from enum import Enum, auto, unique
+from parsetools import fileDigest
 from pathlib import Path
-from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import csv
+import io
+import json
+import logging
 
 CriterionRowFilter = Callable[[List[str]], Optional[List[str]]]
 
@@ -46,51 +51,340 @@ class CSVSectionResult(NamedTuple):
     rows: List[List[str]]
 
 
-def parseSectionsForCSV(csvFile: Iterator[str],
-                        criteria: List[CSVSectionCriterion]
-                        ) -> List[CSVSectionResult]:
-    results: List[CSVSectionResult] = []
+class CSVSectionRow(NamedTuple):
+    criterion: CSVSectionCriterion
+    row: List[str]
+
+
+@unique
+class _SectionBoundary(Enum):
+    START = auto()
+    END = auto()
+
+
+# Indexes criteria by the first cell of their starting row, so that the criteria which might start a section can be found with one lookup per row.
+#
+# Criteria with an empty starting row match every row. These are indexed under None, and also added to every other entry.
+def _indexCriteriaByStart(criteria: Iterable[CSVSectionCriterion]
+                          ) -> Dict[Optional[str], List[CSVSectionCriterion]]:
+    index: Dict[Optional[str], List[CSVSectionCriterion]] = {None: []}
+    for criterion in criteria:
+        if criterion.startSectionRowMatch:
+            index.setdefault(criterion.startSectionRowMatch[0],
+                             []).append(criterion)
+        else:
+            index[None].append(criterion)
+
+    for (key, candidates) in index.items():
+        if key is not None:
+            candidates.extend(index[None])
+
+    return index
 
+
+# Reads through the CSV once, yielding each (filtered) row within a section, along with the boundaries of each section.
+#
+# If `ordered` is true, sections are expected in the same order as `criteria`, and any section appearing out of order is skipped. Otherwise, sections are recognized in whatever order they appear.
+def _sliceRowsForCSV(
+        csvFile: Iterator[str], criteria: List[CSVSectionCriterion],
+        ordered: bool
+) -> Iterator[Tuple[CSVSectionCriterion, Union[List[str], _SectionBoundary]]]:
     assert len(criteria)
 
     reader = csv.reader(csvFile, skipinitialspace=True)
 
-    currentCriterionIndex = 0
-    matchingRows: Optional[List[List[str]]] = None
-    for r in reader:
-        criterion = criteria[currentCriterionIndex]
-        startSectionRowMatchLength = len(criterion.startSectionRowMatch)
-        endSectionRowMatchLength = len(criterion.endSectionRowMatch)
-
-        def rowEndsSection(row: List[str]) -> bool:
-            if endSectionRowMatchLength == 0 and len(r) == 0:
-                return True
-            elif endSectionRowMatchLength > 0 and \
-                len(row) >= endSectionRowMatchLength and \
-                row[0:endSectionRowMatchLength] == criterion.endSectionRowMatch:
-                return True
+    remaining = list(criteria)
+    while remaining:
+        startIndex = _indexCriteriaByStart(
+            remaining[0:1] if ordered else remaining)
+        matchAnyRow = startIndex[None]
+
+        # Look for the start of the next section.
+        criterion: Optional[CSVSectionCriterion] = None
+        for r in reader:
+            candidates = startIndex.get(r[0],
+                                        matchAnyRow) if r else matchAnyRow
+            for c in candidates:
+                # A shorter row's prefix is also shorter, so will never match.
+                if r[0:len(c.startSectionRowMatch)] == c.startSectionRowMatch:
+                    criterion = c
+                    break
+
+            if criterion is not None:
+                break
+
+        if criterion is None:
+            # reached the end of the file
+            return
+
+        yield (criterion, _SectionBoundary.START)
+
+        startMatch = criterion.startSectionRowMatch
+        startMatchLength = len(startMatch)
+        endMatch = criterion.endSectionRowMatch
+        endMatchLength = len(endMatch)
+        rowFilter = criterion.rowFilter
+
+        for r in reader:
+            if r[0:startMatchLength] == startMatch:
+                # restarting section
+                yield (criterion, _SectionBoundary.START)
+                continue
+
+            if endMatchLength > 0:
+                endsSection = r[0:endMatchLength] == endMatch
             else:
-                return False
+                endsSection = len(r) == 0
 
-        if len(r) >= startSectionRowMatchLength and r[
-                0:startSectionRowMatchLength] == criterion.startSectionRowMatch:
-            # starting section
+            if endsSection:
+                yield (criterion, _SectionBoundary.END)
+                break
+
+            filteredRow = rowFilter(r) if rowFilter else r
+            if filteredRow is not None:
+                yield (criterion, filteredRow)
+        else:
+            # reached the end of the file
+            return
+
+        remaining = [c for c in remaining if c is not criterion]
+
+
+# Lazily yields the rows of each section as the CSV is read, without holding whole sections in memory.
+#
+# Unlike parseSectionsForCSV(), rows are yielded as soon as they are read, so the rows of a section which never ends (or which is restarted) are still included.
+def streamSectionsForCSV(csvFile: Iterator[str],
+                         criteria: List[CSVSectionCriterion],
+                         ordered: bool = True) -> Iterator[CSVSectionRow]:
+    for (criterion, row) in _sliceRowsForCSV(csvFile, criteria, ordered):
+        if not isinstance(row, _SectionBoundary):
+            yield CSVSectionRow(criterion=criterion, row=row)
+
+
+# Returns each section matching the given criteria, in the order they appear in the CSV.
+#
+# By default, sections are expected in the same order as `criteria`. If `ordered` is false, sections in any order are recognized (each criterion still matching at most one section).
+def parseSectionsForCSV(csvFile: Iterator[str],
+                        criteria: List[CSVSectionCriterion],
+                        ordered: bool = True) -> List[CSVSectionResult]:
+    results: List[CSVSectionResult] = []
+
+    matchingRows: Optional[List[List[str]]] = None
+    for (criterion, row) in _sliceRowsForCSV(csvFile, criteria, ordered):
+        if row is _SectionBoundary.START:
             matchingRows = []
-            continue
-        elif matchingRows is not None and rowEndsSection(r):
-            # end of section
-            section = CSVSectionResult(criterion=criterion, rows=matchingRows)
-            results.append(section)
+        elif row is _SectionBoundary.END:
+            assert matchingRows is not None
+            results.append(
+                CSVSectionResult(criterion=criterion, rows=matchingRows))
             matchingRows = None
+        else:
+            assert matchingRows is not None
+            assert not isinstance(row, _SectionBoundary)
+            matchingRows.append(row)
+
+    return results
+
+
+# The location of one section within a CSV file, as found by indexSectionsForCSV().
+class CSVSectionOffsets(NamedTuple):
+    # Index into the list of criteria the section was found with.
+    criterionIndex: int
+
+    # Byte offset of the first row after the section's starting row.
+    start: int
 
-            currentCriterionIndex += 1
-            if currentCriterionIndex >= len(criteria):
-                # no more criteria to parse
+    # Byte offset of the row which ended the section.
+    end: int
+
+
+# Yields each CSV record in a binary file along with its byte offset, joining lines as needed so that quoted fields may contain newlines.
+#
+# Quotes are assumed to appear only around quoted fields (as the csv module writes them), not within unquoted ones.
+def _recordsWithOffsets(f: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    offset = 0
+    recordOffset = 0
+    record = b''
+    inQuotes = False
+
+    for line in f:
+        record += line
+        offset += len(line)
+
+        # Escaped quotes are doubled, so don't affect the parity.
+        if line.count(b'"') % 2:
+            inQuotes = not inQuotes
+        if inQuotes:
+            continue
+
+        yield (recordOffset, record)
+        recordOffset = offset
+        record = b''
+
+    if record:
+        yield (recordOffset, record)
+
+
+def _parseRecord(record: bytes) -> List[str]:
+    return next(csv.reader([record.decode('utf-8')], skipinitialspace=True),
+                [])
+
+
+# Returns the first cell of a raw CSV record, or None if the record is an empty row. This is usually much faster than parsing the whole record.
+def _firstCell(record: bytes) -> Optional[str]:
+    record = record.lstrip(b' ')
+    if record.startswith(b'"'):
+        row = _parseRecord(record)
+        return row[0] if row else None
+
+    line = record.rstrip(b'\r\n')
+    if not line:
+        return None
+
+    return line.split(b',', 1)[0].decode('utf-8')
+
+
+# Whether the given raw record begins with the cells in `match`. An empty `match` matches only empty rows.
+def _recordStartsWith(record: bytes, firstCell: Optional[str],
+                      match: List[str]) -> bool:
+    if not match:
+        return firstCell is None
+    elif firstCell != match[0]:
+        return False
+    elif len(match) == 1:
+        return True
+    else:
+        return _parseRecord(record)[0:len(match)] == match
+
+
+def _scanSectionOffsets(f: BinaryIO, criteria: List[CSVSectionCriterion],
+                        ordered: bool) -> List[CSVSectionOffsets]:
+    assert len(criteria)
+
+    indices = {id(c): i for (i, c) in enumerate(criteria)}
+    records = _recordsWithOffsets(f)
+    results: List[CSVSectionOffsets] = []
+
+    remaining = list(criteria)
+    while remaining:
+        startIndex = _indexCriteriaByStart(
+            remaining[0:1] if ordered else remaining)
+        matchAnyRow = startIndex[None]
+
+        # Look for the start of the next section.
+        criterion: Optional[CSVSectionCriterion] = None
+        start = 0
+        for (offset, record) in records:
+            firstCell = _firstCell(record)
+            candidates = startIndex.get(
+                firstCell,
+                matchAnyRow) if firstCell is not None else matchAnyRow
+            for c in candidates:
+                if _recordStartsWith(record, firstCell,
+                                     c.startSectionRowMatch):
+                    criterion = c
+                    start = offset + len(record)
+                    break
+
+            if criterion is not None:
                 break
 
-        if matchingRows is not None:
-            filteredRow = criterion.rowFilter(r) if criterion.rowFilter else r
-            if filteredRow is not None:
-                matchingRows.append(filteredRow)
+        if criterion is None:
+            break
+
+        # A restarted section keeps its rows from before the restart (parseSectionAtOffsets() skips the restarting rows), and a section which never ends runs to the end of the file, like streamSectionsForCSV().
+        end = start
+        endsSection = False
+        for (offset, record) in records:
+            firstCell = _firstCell(record)
+            restartsSection = _recordStartsWith(record, firstCell,
+                                                criterion.startSectionRowMatch)
+            if not restartsSection and _recordStartsWith(
+                    record, firstCell, criterion.endSectionRowMatch):
+                end = offset
+                endsSection = True
+                break
+
+            end = offset + len(record)
+
+        results.append(
+            CSVSectionOffsets(criterionIndex=indices[id(criterion)],
+                              start=start,
+                              end=end))
+        if not endsSection:
+            # reached the end of the file
+            break
+
+        remaining = [c for c in remaining if c is not criterion]
 
     return results
+
+
+# Identifies the given criteria (and matching mode) in cached indices. Row filters cannot be compared, and don't affect where sections are found, so are not included.
+def _criteriaCacheKey(criteria: List[CSVSectionCriterion],
+                      ordered: bool) -> str:
+    return json.dumps({
+        # Bumped whenever the offsets found for the same file could change.
+        'version':
+        2,
+        'ordered':
+        ordered,
+        'criteria':
+        [[c.startSectionRowMatch, c.endSectionRowMatch] for c in criteria],
+    })
+
+
+# Scans a CSV file for the sections matching the given criteria, returning their byte offsets without parsing the rows in between. The sections can then be parsed independently (e.g., in parallel) using parseSectionAtOffsets().
+#
+# Sections are found in the same way as streamSectionsForCSV(), so a section which never ends runs to the end of the file. If `cacheDirectory` is provided, the index is saved there, keyed by the file's SHA-256 digest, and reused if the same file is indexed again.
+def indexSectionsForCSV(path: Path,
+                        criteria: List[CSVSectionCriterion],
+                        ordered: bool = True,
+                        cacheDirectory: Optional[Path] = None
+                        ) -> List[CSVSectionOffsets]:
+    cachePath: Optional[Path] = None
+    criteriaKey = _criteriaCacheKey(criteria, ordered)
+    if cacheDirectory:
+        cachePath = cacheDirectory / '{}.json'.format(fileDigest(path))
+        try:
+            with open(cachePath) as f:
+                cached = json.load(f)
+            if criteriaKey in cached:
+                return [CSVSectionOffsets(*o) for o in cached[criteriaKey]]
+        except FileNotFoundError:
+            cached = {}
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable section index {}: {}'.format(
+                cachePath, err))
+            cached = {}
+
+    with open(path, 'rb') as f:
+        offsets = _scanSectionOffsets(f, criteria, ordered)
+
+    if cachePath:
+        cached[criteriaKey] = offsets
+        cachePath.parent.mkdir(parents=True, exist_ok=True)
+        with open(cachePath, 'w') as f:
+            json.dump(cached, f)
+
+    return offsets
+
+
+# Parses the rows of one section previously found by indexSectionsForCSV().
+def parseSectionAtOffsets(path: Path, criterion: CSVSectionCriterion,
+                          offsets: CSVSectionOffsets) -> List[List[str]]:
+    with open(path, 'rb') as f:
+        f.seek(offsets.start)
+        data = f.read(offsets.end - offsets.start)
+
+    reader = csv.reader(io.StringIO(data.decode('utf-8'), newline=''),
+                        skipinitialspace=True)
+
+    # Skip the starting rows of a restarted section.
+    startMatch = criterion.startSectionRowMatch
+    rows = (r for r in reader if r[0:len(startMatch)] != startMatch)
+    if not criterion.rowFilter:
+        return list(rows)
+
+    rowFilter = criterion.rowFilter
+    return [row for row in map(rowFilter, rows) if row is not None]
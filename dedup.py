@@ -0,0 +1,53 @@
+from decimal import Decimal
+from datetime import datetime
+from model import Cash, Instrument, Trade
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple, Union
+
+TradeFingerprint = Union[str, Tuple[datetime, Instrument, Decimal, Cash]]
+
+
+# Identifies a trade for the purpose of recognizing it in more than one source. Uses the ID assigned by the broker when there is one, otherwise the date, instrument, quantity and amount.
+def tradeFingerprint(trade: Trade) -> TradeFingerprint:
+    if trade.sourceID is not None:
+        return trade.sourceID
+
+    return (trade.date, trade.instrument, trade.quantity, trade.amount)
+
+
+class DeduplicatedTrades(NamedTuple):
+    trades: List[Trade]
+
+    # The number of trades dropped from each source, for sources that had any.
+    duplicatesBySource: Dict[str, int]
+
+
+# Combines the trades from several sources, dropping any which were already imported from an earlier source.
+#
+# Trades are never considered duplicates of others in the same source, since a source can legitimately contain several identical trades (e.g., fills at the same price, when the broker doesn't assign IDs). Instead, if a trade appears N times in one source, and at most M times in any one earlier source, then max(0, N - M) of them are kept.
+def deduplicateTrades(sources: Sequence[Tuple[str, Iterable[Trade]]]
+                      ) -> DeduplicatedTrades:
+    seen: Dict[TradeFingerprint, int] = {}
+    trades: List[Trade] = []
+    duplicatesBySource: Dict[str, int] = {}
+
+    for (name, sourceTrades) in sources:
+        counts: Dict[TradeFingerprint, int] = {}
+        duplicates = 0
+
+        for trade in sourceTrades:
+            fingerprint = tradeFingerprint(trade)
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+
+            if counts[fingerprint] <= seen.get(fingerprint, 0):
+                duplicates += 1
+            else:
+                trades.append(trade)
+
+        for (fingerprint, count) in counts.items():
+            seen[fingerprint] = max(seen.get(fingerprint, 0), count)
+
+        if duplicates:
+            duplicatesBySource[name] = duplicates
+
+    return DeduplicatedTrades(trades=trades,
+                              duplicatesBySource=duplicatesBySource)
@@ -1,12 +1,16 @@
-from csvsectionslicer import parseSectionsForCSV, CSVSectionCriterion, CSVSectionResult
+from concurrent.futures import Executor
+from csvsectionslicer import indexSectionsForCSV, parseSectionAtOffsets, streamSectionsForCSV, CSVSectionCriterion, CSVSectionOffsets
 from datetime import date, datetime
 from decimal import Decimal
 from enum import IntEnum, unique
+from itertools import groupby
 from model import Cash, Currency, Instrument, Stock, Bond, Option, OptionType, Position, Trade, TradeFlags
-from parsetools import lenientParse
+from numericparsing import parseFiniteDecimal
+from parsetools import ParseErrors, lenientParse
 from pathlib import Path
+from rowschema import RowSchema, dateConverter, defaultIfEmpty
 from sys import stderr
-from typing import Callable, Dict, List, NamedTuple, Optional, Set
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 from warnings import warn
 
 import csv
@@ -16,23 +20,31 @@ import re
 class FidelityPosition(NamedTuple):
     symbol: str
     description: str
-    quantity: str
+    quantity: Decimal
     price: str
     beginningValue: str
     endingValue: str
-    costBasis: str
+    costBasis: Decimal
 
 
 InstrumentFactory = Callable[[FidelityPosition], Instrument]
 
+# The fields read by parseFidelityPosition() and the instrument factories.
+positionSchema = RowSchema(
+    FidelityPosition,
+    needed=['symbol', 'description', 'quantity', 'costBasis'],
+    converters={
+        'quantity': parseFiniteDecimal,
+        'costBasis': parseFiniteDecimal,
+    })
+
 
 def parseFidelityPosition(p: FidelityPosition,
                           instrumentFactory: InstrumentFactory) -> Position:
-    qty = Decimal(p.quantity)
     return Position(instrument=instrumentFactory(p),
-                    quantity=qty,
+                    quantity=p.quantity,
                     costBasis=Cash(currency=Currency.USD,
-                                   quantity=Decimal(p.costBasis)))
+                                   quantity=p.costBasis))
 
 
 @unique
@@ -51,10 +63,13 @@ class FidelityMonth(IntEnum):
     DEC = 12
 
 
+optionsPositionPattern = re.compile(
+    r'^(?P<putCall>CALL|PUT) \((?P<underlying>[A-Z]+)\) .+ (?P<month>[A-Z]{3}) (?P<day>\d{2}) (?P<year>\d{2}) \$(?P<strike>[0-9\.]+) \(100 SHS\)$'
+)
+
+
 def parseOptionsPosition(description: str) -> Option:
-    match = re.match(
-        r'^(?P<putCall>CALL|PUT) \((?P<underlying>[A-Z]+)\) .+ (?P<month>[A-Z]{3}) (?P<day>\d{2}) (?P<year>\d{2}) \$(?P<strike>[0-9\.]+) \(100 SHS\)$',
-        description)
+    match = optionsPositionPattern.match(description)
     if not match:
         raise ValueError(
             'Could not parse Fidelity options description: {}'.format(
@@ -68,48 +83,117 @@ def parseOptionsPosition(description: str) -> Option:
     month = FidelityMonth[match['month']]
     year = datetime.strptime(match['year'], '%y').year
 
-    return Option(underlying=match['underlying'],
-                  currency=Currency.USD,
-                  expiration=date(year, month, int(match['day'])),
-                  optionType=optionType,
-                  strike=Decimal(match['strike']))
+    return Option.interned(underlying=match['underlying'],
+                           currency=Currency.USD,
+                           expiration=date(year, month, int(match['day'])),
+                           optionType=optionType,
+                           strike=Decimal(match['strike']))
+
+
+def positionColumns(r: List[str]) -> List[str]:
+    return r[0:7]
+
+
+# Section criteria and instrument factories are defined at the top level (not as lambdas), so that sections can be parsed in worker processes.
+stocksCriterion = CSVSectionCriterion(startSectionRowMatch=["Stocks"],
+                                      endSectionRowMatch=[""],
+                                      rowFilter=positionColumns)
+bondsCriterion = CSVSectionCriterion(startSectionRowMatch=["Bonds"],
+                                     endSectionRowMatch=[""],
+                                     rowFilter=positionColumns)
+optionsCriterion = CSVSectionCriterion(startSectionRowMatch=["Options"],
+                                       endSectionRowMatch=["", ""],
+                                       rowFilter=positionColumns)
+
+positionsCriteria = [stocksCriterion, bondsCriterion, optionsCriterion]
+
+
+def stockForPosition(p: FidelityPosition) -> Instrument:
+    return Stock.interned(p.symbol, currency=Currency.USD)
+
+
+def bondForPosition(p: FidelityPosition) -> Instrument:
+    return Bond.interned(p.symbol, currency=Currency.USD)
+
+
+def optionForPosition(p: FidelityPosition) -> Instrument:
+    return parseOptionsPosition(p.description)
+
+
+instrumentBySection: Dict[CSVSectionCriterion, InstrumentFactory] = {
+    stocksCriterion: stockForPosition,
+    bondsCriterion: bondForPosition,
+    optionsCriterion: optionForPosition,
+}
+
+
+def parsePositionRows(criterion: CSVSectionCriterion,
+                      rows: Iterable[List[str]],
+                      lenient: bool = False,
+                      errors: Optional[ParseErrors] = None) -> List[Position]:
+    fromRow = positionSchema.compile()
+    instrumentFactory = instrumentBySection[criterion]
+    return list(
+        lenientParse(rows,
+                     transform=lambda r: parseFidelityPosition(
+                         fromRow(r), instrumentFactory),
+                     lenient=lenient,
+                     errors=errors,
+                     parser='fidelity.parseFidelityPosition'))
+
+
+# Parses one section in a worker process. Failures are recorded into `errors`, which is returned so the caller can merge it into its own.
+def parsePositionsSection(path: Path,
+                          offsets: CSVSectionOffsets,
+                          lenient: bool = False,
+                          errors: Optional[ParseErrors] = None
+                          ) -> Tuple[List[Position], Optional[ParseErrors]]:
+    criterion = positionsCriteria[offsets.criterionIndex]
+    positions = parsePositionRows(criterion,
+                                  parseSectionAtOffsets(
+                                      path, criterion, offsets),
+                                  lenient=lenient,
+                                  errors=errors)
+    return (positions, errors)
+
+
+# If an executor is provided, the stocks, bonds, and options sections are each parsed in a separate task.
+def parsePositions(path: Path,
+                   lenient: bool = False,
+                   executor: Optional[Executor] = None,
+                   errors: Optional[ParseErrors] = None) -> List[Position]:
+    positions: List[Position] = []
+    if executor:
+        sections = indexSectionsForCSV(path, positionsCriteria, ordered=False)
+        futures = [
+            executor.submit(
+                parsePositionsSection, path, offsets, lenient,
+                ParseErrors(maxSamples=errors.maxSamples)
+                if errors is not None else None) for offsets in sections
+        ]
+
+        for f in futures:
+            (sectionPositions, sectionErrors) = f.result()
+            positions += sectionPositions
+            if errors is not None and sectionErrors is not None:
+                errors.update(sectionErrors)
 
+        return positions
 
-def parsePositions(path: Path, lenient: bool = False) -> List[Position]:
     with open(path, newline='') as csvfile:
-        stocksCriterion = CSVSectionCriterion(startSectionRowMatch=["Stocks"],
-                                              endSectionRowMatch=[""],
-                                              rowFilter=lambda r: r[0:7])
-        bondsCriterion = CSVSectionCriterion(startSectionRowMatch=["Bonds"],
-                                             endSectionRowMatch=[""],
-                                             rowFilter=lambda r: r[0:7])
-        optionsCriterion = CSVSectionCriterion(
-            startSectionRowMatch=["Options"],
-            endSectionRowMatch=["", ""],
-            rowFilter=lambda r: r[0:7])
-
-        instrumentBySection: Dict[CSVSectionCriterion, InstrumentFactory] = {
-            stocksCriterion: lambda p: Stock(p.symbol, currency=Currency.USD),
-            bondsCriterion: lambda p: Bond(p.symbol, currency=Currency.USD),
-            optionsCriterion: lambda p: parseOptionsPosition(p.description),
-        }
-
-        sections = parseSectionsForCSV(
-            csvfile, [stocksCriterion, bondsCriterion, optionsCriterion])
-
-        positions: List[Position] = []
-
-        for sec in sections:
-            for r in sec.rows:
-                pos = parseFidelityPosition(FidelityPosition._make(r),
-                                            instrumentBySection[sec.criterion])
-                positions.append(pos)
+        rows = streamSectionsForCSV(csvfile, positionsCriteria, ordered=False)
+
+        # Rows from each section are contiguous.
+        for (criterion, section) in groupby(rows, key=lambda r: r.criterion):
+            positions += parsePositionRows(criterion, (r.row for r in section),
+                                           lenient=lenient,
+                                           errors=errors)
 
         return positions
 
 
 class FidelityTransaction(NamedTuple):
-    date: str
+    date: datetime
     account: str
     action: str
     symbol: str
@@ -117,21 +201,44 @@ class FidelityTransaction(NamedTuple):
     securityType: str
     exchangeQuantity: str
     exchangeCurrency: str
-    quantity: str
-    currency: str
+    quantity: Decimal
+    currency: Currency
     price: str
     exchangeRate: str
-    commission: str
-    fees: str
+    commission: Decimal
+    fees: Decimal
     accruedInterest: str
-    amount: str
+    amount: Optional[Decimal]
     settlementDate: str
 
 
+# Fees and amounts are left empty for some trades.
+decimalOrZero = defaultIfEmpty(parseFiniteDecimal, Decimal(0))
+decimalOrNone = defaultIfEmpty(parseFiniteDecimal, None)
+
+# The fields read by parseFidelityTransaction().
+transactionSchema = RowSchema(FidelityTransaction,
+                              needed=[
+                                  'date', 'action', 'symbol', 'quantity',
+                                  'currency', 'commission', 'fees', 'amount'
+                              ],
+                              converters={
+                                  'date': dateConverter('%m/%d/%Y'),
+                                  'quantity': parseFiniteDecimal,
+                                  'currency': Currency,
+                                  'commission': decimalOrZero,
+                                  'fees': decimalOrZero,
+                                  'amount': decimalOrNone,
+                              })
+
+optionTransactionPattern = re.compile(
+    r'^-(?P<underlying>[A-Z]+)(?P<date>\d{6})(?P<putCall>C|P)(?P<strike>[0-9\.]+)$'
+)
+optionSymbolPattern = re.compile(r'[0-9]+(C|P)[0-9]+$')
+
+
 def parseOptionTransaction(symbol: str) -> Option:
-    match = re.match(
-        r'^-(?P<underlying>[A-Z]+)(?P<date>\d{6})(?P<putCall>C|P)(?P<strike>[0-9\.]+)$',
-        symbol)
+    match = optionTransactionPattern.match(symbol)
     if not match:
         raise ValueError(
             'Could not parse Fidelity options symbol: {}'.format(symbol))
@@ -141,76 +248,84 @@ def parseOptionTransaction(symbol: str) -> Option:
     else:
         optionType = OptionType.CALL
 
-    return Option(underlying=match['underlying'],
-                  currency=Currency.USD,
-                  expiration=datetime.strptime(match['date'], '%y%m%d').date(),
-                  optionType=optionType,
-                  strike=Decimal(match['strike']))
+    return Option.interned(underlying=match['underlying'],
+                           currency=Currency.USD,
+                           expiration=datetime.strptime(
+                               match['date'], '%y%m%d').date(),
+                           optionType=optionType,
+                           strike=Decimal(match['strike']))
 
 
 def guessInstrumentFromSymbol(symbol: str) -> Instrument:
-    if re.search(r'[0-9]+(C|P)[0-9]+$', symbol):
+    if optionSymbolPattern.search(symbol):
         return parseOptionTransaction(symbol)
     elif Bond.validBondSymbol(symbol):
-        return Bond(symbol, currency=Currency.USD)
+        return Bond.interned(symbol, currency=Currency.USD)
     else:
-        return Stock(symbol, currency=Currency.USD)
+        return Stock.interned(symbol, currency=Currency.USD)
 
 
 def forceParseFidelityTransaction(t: FidelityTransaction,
                                   flags: TradeFlags) -> Trade:
-    quantity = Decimal(t.quantity)
-
-    totalFees = Decimal(0)
     # Fidelity's total fees include commision and fees
-    if t.commission:
-        totalFees += Decimal(t.commission)
-    if t.fees:
-        totalFees += Decimal(t.fees)
+    totalFees = t.commission + t.fees
 
     amount = Decimal(0)
-    if t.amount:
-        amount = Decimal(t.amount) + totalFees
+    if t.amount is not None:
+        amount = t.amount + totalFees
 
-    return Trade(date=datetime.strptime(t.date, '%m/%d/%Y'),
+    return Trade(date=t.date,
                  instrument=guessInstrumentFromSymbol(t.symbol),
-                 quantity=quantity,
-                 amount=Cash(currency=Currency(t.currency), quantity=amount),
-                 fees=Cash(currency=Currency(t.currency), quantity=totalFees),
+                 quantity=t.quantity,
+                 amount=Cash(currency=t.currency, quantity=amount),
+                 fees=Cash(currency=t.currency, quantity=totalFees),
                  flags=flags)
 
 
-def parseFidelityTransaction(t: FidelityTransaction) -> Optional[Trade]:
-    flags = None
-    if t.action.startswith('YOU BOUGHT'):
-        flags = TradeFlags.OPEN
-    elif t.action.startswith('YOU SOLD'):
-        flags = TradeFlags.CLOSE
-    elif t.action.startswith('REINVESTMENT'):
-        flags = TradeFlags.OPEN | TradeFlags.DRIP
+# Returns the flags for a trade with the given action, or None if the action isn't a trade.
+def flagsForAction(action: str) -> Optional[TradeFlags]:
+    if action.startswith('YOU BOUGHT'):
+        return TradeFlags.OPEN
+    elif action.startswith('YOU SOLD'):
+        return TradeFlags.CLOSE
+    elif action.startswith('REINVESTMENT'):
+        return TradeFlags.OPEN | TradeFlags.DRIP
     else:
         return None
 
+
+def parseFidelityTransaction(t: FidelityTransaction) -> Optional[Trade]:
+    flags = flagsForAction(t.action)
+    if flags is None:
+        return None
+
     return forceParseFidelityTransaction(t, flags=flags)
 
 
 # Transactions will be ordered from newest to oldest
-def parseTransactions(path: Path, lenient: bool = False) -> List[Trade]:
+def parseTransactions(path: Path,
+                      lenient: bool = False,
+                      errors: Optional[ParseErrors] = None) -> List[Trade]:
     with open(path, newline='') as csvfile:
         transactionsCriterion = CSVSectionCriterion(
             startSectionRowMatch=["Run Date", "Account", "Action"],
             endSectionRowMatch=[],
             rowFilter=lambda r: r if len(r) >= 17 else None)
 
-        sections = parseSectionsForCSV(csvfile, [transactionsCriterion])
+        rows = streamSectionsForCSV(csvfile, [transactionsCriterion])
+        fromRow = transactionSchema.compile()
 
-        if not sections:
-            return []
+        # Rows which aren't trades (e.g., dividends) are skipped before their values are converted, as they needn't hold trade quantities.
+        action = transactionSchema.column('action')
+        trades = (r.row for r in rows
+                  if flagsForAction(r.row[action]) is not None)
 
         return list(
             filter(
                 None,
                 lenientParse(
-                    (FidelityTransaction._make(r) for r in sections[0].rows),
-                    transform=parseFidelityTransaction,
-                    lenient=lenient)))
+                    trades,
+                    transform=lambda r: parseFidelityTransaction(fromRow(r)),
+                    lenient=lenient,
+                    errors=errors,
+                    parser='fidelity.parseFidelityTransaction')))
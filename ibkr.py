@@ -1,25 +1,30 @@
-from datetime import datetime
-from decimal import Context, Decimal, DivisionByZero, Overflow, InvalidOperation, localcontext
+from collections import deque
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
 from enum import IntEnum
 from model import Currency, Cash, Instrument, Stock, Bond, Option, OptionType, FutureOption, Future, Forex, Position, TradeFlags, Trade, LiveDataProvider, Quote
-from parsetools import lenientParse
+from numericparsing import parseFiniteDecimal
+from parsecache import parserVersion
+from parsetools import ParseErrors, lenientParse
 from pathlib import Path
 from progress.spinner import Spinner
-from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Type
+from rowschema import RowSchema
+from typing import Any, Awaitable, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, TypeVar, Union
+from xml.etree import ElementTree
 
+import asyncio
+import hashlib
 import ib_insync as IB
+import json
 import logging
 import math
+import os
+import pickle
 import re
+import time
+import zlib
 
-
-def parseFiniteDecimal(input: str) -> Decimal:
-    with localcontext(ctx=Context(traps=[DivisionByZero, Overflow])):
-        value = Decimal(input)
-        if not value.is_finite():
-            raise ValueError('Input is not numeric: {}'.format(input))
-
-        return value
+T = TypeVar('T')
 
 
 def parseOption(symbol: str,
@@ -38,11 +43,12 @@ def parseOption(symbol: str,
     else:
         optionType = OptionType.CALL
 
-    return cls(underlying=match['underlying'].rstrip(),
-               currency=currency,
-               optionType=optionType,
-               expiration=datetime.strptime(match['date'], '%y%m%d').date(),
-               strike=parseFiniteDecimal(match['strike']) / 1000)
+    return cls.interned(underlying=match['underlying'].rstrip(),
+                        currency=currency,
+                        optionType=optionType,
+                        expiration=datetime.strptime(match['date'],
+                                                     '%y%m%d').date(),
+                        strike=parseFiniteDecimal(match['strike']) / 1000)
 
 
 def parseForex(symbol: str, currency: Currency) -> Forex:
@@ -57,7 +63,8 @@ def parseForex(symbol: str, currency: Currency) -> Forex:
             'Expected quote currency {} to match position currency {}'.format(
                 quoteCurrency, currency))
 
-    return Forex(baseCurrency=baseCurrency, quoteCurrency=quoteCurrency)
+    return Forex.interned(baseCurrency=baseCurrency,
+                          quoteCurrency=quoteCurrency)
 
 
 def parseFutureOptionContract(contract: IB.Contract,
@@ -70,15 +77,15 @@ def parseFutureOptionContract(contract: IB.Contract,
         raise ValueError(
             'Unexpected right in IB contract: {}'.format(contract))
 
-    return FutureOption(symbol=contract.localSymbol,
-                        currency=currency,
-                        underlying=contract.symbol,
-                        optionType=optionType,
-                        expiration=datetime.strptime(
-                            contract.lastTradeDateOrContractMonth,
-                            '%Y%m%d').date(),
-                        strike=parseFiniteDecimal(contract.strike),
-                        multiplier=parseFiniteDecimal(contract.multiplier))
+    return FutureOption.interned(
+        symbol=contract.localSymbol,
+        currency=currency,
+        underlying=contract.symbol,
+        optionType=optionType,
+        expiration=datetime.strptime(contract.lastTradeDateOrContractMonth,
+                                     '%Y%m%d').date(),
+        strike=parseFiniteDecimal(contract.strike),
+        multiplier=parseFiniteDecimal(contract.multiplier))
 
 
 def extractPosition(p: IB.Position) -> Position:
@@ -93,18 +100,18 @@ def extractPosition(p: IB.Position) -> Position:
     try:
         instrument: Instrument
         if tag == 'STK':
-            instrument = Stock(symbol=symbol, currency=currency)
+            instrument = Stock.interned(symbol=symbol, currency=currency)
         elif tag == 'BOND':
-            instrument = Bond(symbol=symbol,
-                              currency=currency,
-                              validateSymbol=False)
+            instrument = Bond.interned(symbol=symbol,
+                                       currency=currency,
+                                       validateSymbol=False)
         elif tag == 'OPT':
             instrument = parseOption(symbol=symbol,
                                      currency=currency,
                                      multiplier=parseFiniteDecimal(
                                          p.contract.multiplier))
         elif tag == 'FUT':
-            instrument = Future(
+            instrument = Future.interned(
                 symbol=symbol,
                 currency=currency,
                 multiplier=parseFiniteDecimal(p.contract.multiplier),
@@ -133,11 +140,14 @@ def extractPosition(p: IB.Position) -> Position:
             .format(p))
 
 
-def downloadPositions(ib: IB.IB, lenient: bool) -> List[Position]:
+def downloadPositions(ib: IB.IB,
+                      lenient: bool,
+                      errors: Optional[ParseErrors] = None) -> List[Position]:
     return list(
         lenientParse(ib.positions(),
                      transform=extractPosition,
-                     lenient=lenient))
+                     lenient=lenient,
+                     errors=errors))
 
 
 class IBTradeConfirm(NamedTuple):
@@ -213,14 +223,22 @@ def parseFutureOptionTrade(trade: IBTradeConfirm) -> Instrument:
         raise ValueError(
             'Unexpected value for putCall in IB trade: {}'.format(trade))
 
-    return FutureOption(symbol=trade.symbol,
-                        currency=Currency[trade.currency],
-                        underlying=trade.underlyingSymbol,
-                        optionType=optionType,
-                        expiration=datetime.strptime(trade.expiry,
-                                                     '%Y%m%d').date(),
-                        strike=parseFiniteDecimal(trade.strike),
-                        multiplier=parseFiniteDecimal(trade.multiplier))
+    return FutureOption.interned(
+        symbol=trade.symbol,
+        currency=Currency[trade.currency],
+        underlying=trade.underlyingSymbol,
+        optionType=optionType,
+        expiration=datetime.strptime(trade.expiry, '%Y%m%d').date(),
+        strike=parseFiniteDecimal(trade.strike),
+        multiplier=parseFiniteDecimal(trade.multiplier))
+
+
+# Identifies a trade confirmation by its IB trade and execution IDs, if it has them.
+def tradeConfirmID(trade: IBTradeConfirm) -> Optional[str]:
+    if not trade.tradeID and not trade.execID:
+        return None
+
+    return '{}|{}'.format(trade.tradeID, trade.execID)
 
 
 def parseTradeConfirm(trade: IBTradeConfirm) -> Trade:
@@ -237,18 +255,18 @@ def parseTradeConfirm(trade: IBTradeConfirm) -> Trade:
     try:
         instrument: Instrument
         if tag == 'STK':
-            instrument = Stock(symbol=symbol, currency=currency)
+            instrument = Stock.interned(symbol=symbol, currency=currency)
         elif tag == 'BOND':
-            instrument = Bond(symbol=symbol,
-                              currency=currency,
-                              validateSymbol=False)
+            instrument = Bond.interned(symbol=symbol,
+                                       currency=currency,
+                                       validateSymbol=False)
         elif tag == 'OPT':
             instrument = parseOption(symbol=symbol,
                                      currency=currency,
                                      multiplier=parseFiniteDecimal(
                                          trade.multiplier))
         elif tag == 'FUT':
-            instrument = Future(
+            instrument = Future.interned(
                 symbol=symbol,
                 currency=currency,
                 multiplier=parseFiniteDecimal(trade.multiplier),
@@ -296,6 +314,9 @@ def parseTradeConfirm(trade: IBTradeConfirm) -> Trade:
             else:
                 flags |= TradeFlags.CLOSE
 
+        confirmID = tradeConfirmID(trade)
+        sourceID = 'IB:' + confirmID if confirmID else None
+
         return Trade(date=datetime.strptime(trade.tradeDate, '%Y%m%d'),
                      instrument=instrument,
                      quantity=parseFiniteDecimal(trade.quantity),
@@ -305,24 +326,75 @@ def parseTradeConfirm(trade: IBTradeConfirm) -> Trade:
                          currency=Currency(trade.commissionCurrency),
                          quantity=-(parseFiniteDecimal(trade.commission) +
                                     parseFiniteDecimal(trade.tax))),
-                     flags=flags)
+                     flags=flags,
+                     sourceID=sourceID)
     except InvalidOperation:
         raise ValueError(
             'One of the numeric trade values is out of range: {}'.format(
                 trade))
 
 
-def tradesFromReport(report: IB.FlexReport, lenient: bool) -> List[Trade]:
+def tradesFromReport(report: IB.FlexReport,
+                     lenient: bool,
+                     errors: Optional[ParseErrors] = None) -> List[Trade]:
     return list(
         lenientParse(
             (IBTradeConfirm(**t.__dict__)
              for t in report.extract('TradeConfirm', parseNumbers=False)),
             transform=parseTradeConfirm,
-            lenient=lenient))
-
-
-def parseTrades(path: Path, lenient: bool = False) -> List[Trade]:
-    return tradesFromReport(IB.FlexReport(path=path), lenient=lenient)
+            lenient=lenient,
+            errors=errors))
+
+
+# The TradeConfirm attributes read by parseTradeConfirm() and TradeStore.key(). Update this if they start reading others.
+tradeConfirmSchema = RowSchema(IBTradeConfirm,
+                               needed=[
+                                   'assetCategory', 'buySell', 'code',
+                                   'commission', 'commissionCurrency',
+                                   'currency', 'expiry', 'multiplier',
+                                   'proceeds', 'putCall', 'quantity', 'strike',
+                                   'symbol', 'tax', 'tradeDate',
+                                   'underlyingSymbol', 'tradeID', 'execID'
+                               ])
+
+
+# Streams the TradeConfirm elements out of a Flex report, without building the whole document in memory.
+#
+# Only the attributes needed by `tradeConfirmSchema` are read; reading any other field of the confirmations raises AttributeError.
+def streamTradeConfirms(source: Union[Path, BinaryIO]
+                        ) -> Iterator[IBTradeConfirm]:
+    fromAttributes = tradeConfirmSchema.compileMapping()
+    parents: List[ElementTree.Element] = []
+
+    for (event, element) in ElementTree.iterparse(
+            str(source) if isinstance(source, Path) else source,
+            events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if element.tag != 'TradeConfirm':
+            continue
+
+        confirm = fromAttributes(element.attrib)
+
+        # Discard the element (and detach it from its parent) to keep memory bounded.
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+        yield confirm
+
+
+def parseTrades(path: Path,
+                lenient: bool = False,
+                errors: Optional[ParseErrors] = None) -> List[Trade]:
+    return list(
+        lenientParse(streamTradeConfirms(path),
+                     transform=parseTradeConfirm,
+                     lenient=lenient,
+                     errors=errors))
 
 
 class SpinnerOnLogHandler(logging.Handler):
@@ -334,8 +406,7 @@ class SpinnerOnLogHandler(logging.Handler):
         self._spinner.next()
 
 
-def downloadTrades(token: str, queryID: int,
-                   lenient: bool = False) -> List[Trade]:
+def downloadTradeConfirms(token: str, queryID: int) -> List[IBTradeConfirm]:
     with Spinner('Downloading trade report ') as spinner:
         handler = SpinnerOnLogHandler(spinner)
         logger = logging.getLogger('ib_insync.flexreport')
@@ -347,7 +418,203 @@ def downloadTrades(token: str, queryID: int,
         finally:
             logger.removeHandler(handler)
 
-    return tradesFromReport(report, lenient=lenient)
+    return [
+        IBTradeConfirm(**t.__dict__)
+        for t in report.extract('TradeConfirm', parseNumbers=False)
+    ]
+
+
+# Downloads a trade report from the Flex Web Service.
+#
+# If a store is given, only trade confirmations it hasn't seen before are parsed, and then appended to it; the returned trades are everything in the store. Note that the Flex Web Service always returns the whole period configured for the query, so the download itself still scales with that period. Once a store has been seeded, the query can be narrowed (e.g., to the last 30 days) to make downloads small too.
+def downloadTrades(token: str,
+                   queryID: int,
+                   lenient: bool = False,
+                   store: Optional['TradeStore'] = None,
+                   errors: Optional[ParseErrors] = None) -> List[Trade]:
+    confirms = downloadTradeConfirms(token, queryID)
+    if store is None:
+        return list(
+            lenientParse(confirms,
+                         transform=parseTradeConfirm,
+                         lenient=lenient,
+                         errors=errors))
+
+    store.merge(confirms, lenient=lenient, errors=errors)
+    return store.trades(lenient=lenient, errors=errors)
+
+
+def parseKeyedTradeConfirm(keyed: Tuple[str, IBTradeConfirm]
+                           ) -> Tuple[str, Trade]:
+    return (keyed[0], parseTradeConfirm(keyed[1]))
+
+
+# An append-only local store of trade confirmations, so that trade history doesn't need to be downloaded and parsed again on every run.
+#
+# Confirmations are keyed by their IB trade and execution IDs. The file holds one JSON object per line, containing the non-empty fields of a confirmation.
+#
+# The trades parsed from the confirmations are kept alongside, in `tradesPath`, so that later runs only parse confirmations added since. They are discarded whenever the parser changes (see parserVersion()). Like ParseCache, only use a store you trust, as loading the trades unpickles them.
+class TradeStore:
+    @classmethod
+    def key(cls, confirm: IBTradeConfirm) -> str:
+        confirmID = tradeConfirmID(confirm)
+        if confirmID:
+            return confirmID
+
+        # Without IDs (which shouldn't happen), fall back to the content of the confirmation, as it would be stored. This way, a full confirmation (e.g., fetched from IB) and the same one read back from the store have the same key.
+        return hashlib.sha256(
+            json.dumps(cls.storedFields(confirm),
+                       sort_keys=True).encode('utf-8')).hexdigest()
+
+    # Only the non-empty fields in `tradeConfirmSchema` are stored, as nothing else is read back.
+    @classmethod
+    def storedFields(cls, confirm: IBTradeConfirm) -> Dict[str, str]:
+        return {
+            field: getattr(confirm, field)
+            for field in tradeConfirmSchema.needed if getattr(confirm, field)
+        }
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._confirms: Dict[str, IBTradeConfirm] = {}
+        self._trades: Dict[str, Trade] = {}
+        self._endsWithNewline = True
+
+        if path.exists():
+            self._load()
+            self._loadTrades()
+
+        super().__init__()
+
+    def _load(self) -> None:
+        # Only the fields which are parsed are read back, matching streamed confirmations.
+        fromFields = tradeConfirmSchema.compileMapping()
+
+        with open(self._path) as f:
+            for (lineNumber, line) in enumerate(f, start=1):
+                self._endsWithNewline = line.endswith('\n')
+                if not line.strip():
+                    continue
+
+                try:
+                    confirm = fromFields(json.loads(line))
+                except (ValueError, AttributeError) as err:
+                    # Most likely a write was interrupted.
+                    logging.warning(
+                        'Ignoring unreadable line {} of trade store {}: {}'.
+                        format(lineNumber, self._path, err))
+                    continue
+
+                self._confirms[self.key(confirm)] = confirm
+
+    def _loadTrades(self) -> None:
+        try:
+            with open(self.tradesPath, 'rb') as f:
+                (version, trades) = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, zlib.error, pickle.UnpicklingError,
+                EOFError, AttributeError, ImportError) as err:
+            logging.warning('Ignoring unreadable trades {}: {}'.format(
+                self.tradesPath, err))
+            return
+
+        if version != parserVersion(parseTradeConfirm):
+            return
+
+        self._trades = {
+            k: t
+            for (k, t) in trades.items() if k in self._confirms
+        }
+
+    def _saveTrades(self) -> None:
+        try:
+            data = zlib.compress(
+                pickle.dumps((parserVersion(parseTradeConfirm), self._trades),
+                             protocol=pickle.HIGHEST_PROTOCOL))
+
+            # Write atomically, so a concurrent reader never sees partial trades.
+            temporaryPath = self.tradesPath.with_suffix('.tmp{}'.format(
+                os.getpid()))
+            with open(temporaryPath, 'wb') as f:
+                f.write(data)
+            os.replace(temporaryPath, self.tradesPath)
+        except (OSError, pickle.PicklingError) as err:
+            logging.warning('Could not write trades {}: {}'.format(
+                self.tradesPath, err))
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def tradesPath(self) -> Path:
+        return self._path.with_name(self._path.name + '.trades')
+
+    def __len__(self) -> int:
+        return len(self._confirms)
+
+    def __contains__(self, confirm: IBTradeConfirm) -> bool:
+        return self.key(confirm) in self._confirms
+
+    def confirms(self) -> List[IBTradeConfirm]:
+        return list(self._confirms.values())
+
+    # Parses any confirmations that haven't been parsed yet, and returns the trades for everything in the store.
+    def trades(self,
+               lenient: bool = False,
+               errors: Optional[ParseErrors] = None) -> List[Trade]:
+        unparsed = [(k, c) for (k, c) in self._confirms.items()
+                    if k not in self._trades]
+        if unparsed:
+            parsed = dict(
+                lenientParse(unparsed,
+                             transform=parseKeyedTradeConfirm,
+                             lenient=lenient,
+                             errors=errors))
+            if parsed:
+                self._trades.update(parsed)
+                self._saveTrades()
+
+        return [self._trades[k] for k in self._confirms if k in self._trades]
+
+    # Adds the given confirmations to the store, skipping any it already has. New confirmations are parsed (to validate them) before being written, and their trades returned.
+    def merge(self,
+              confirms: Iterable[IBTradeConfirm],
+              lenient: bool = False,
+              errors: Optional[ParseErrors] = None) -> List[Trade]:
+        new: Dict[str, IBTradeConfirm] = {}
+        for confirm in confirms:
+            key = self.key(confirm)
+            if key not in self._confirms and key not in new:
+                new[key] = confirm
+
+        parsed: Dict[str, Trade] = dict(
+            lenientParse(new.items(),
+                         transform=parseKeyedTradeConfirm,
+                         lenient=lenient,
+                         errors=errors))
+        if not parsed:
+            return []
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._path, 'a') as f:
+            # Don't let a previously interrupted write swallow the first new line.
+            if not self._endsWithNewline:
+                f.write('\n')
+
+            for key in parsed:
+                confirm = new[key]
+                f.write(json.dumps(self.storedFields(confirm), sort_keys=True))
+                f.write('\n')
+
+                self._confirms[key] = confirm
+
+            self._endsWithNewline = True
+
+        self._trades.update(parsed)
+        self._saveTrades()
+        return list(parsed.values())
 
 
 def stockContract(stock: Stock) -> IB.Contract:
@@ -415,42 +682,535 @@ class MarketDataType(IntEnum):
     DELAYED_FROZEN = 4
 
 
-class IBDataProvider(LiveDataProvider):
-    def __init__(self, client: IB.IB):
+def quoteFromTicker(ticker: IB.Ticker, currency: Currency) -> Quote:
+    bid: Optional[Cash] = None
+    ask: Optional[Cash] = None
+    last: Optional[Cash] = None
+    close: Optional[Cash] = None
+
+    if (ticker.bid and math.isfinite(ticker.bid)) and not ticker.bidSize == 0:
+        bid = Cash(currency=currency, quantity=Decimal(ticker.bid))
+    if (ticker.ask and math.isfinite(ticker.ask)) and not ticker.askSize == 0:
+        ask = Cash(currency=currency, quantity=Decimal(ticker.ask))
+    if (ticker.last
+            and math.isfinite(ticker.last)) and not ticker.lastSize == 0:
+        last = Cash(currency=currency, quantity=Decimal(ticker.last))
+    if ticker.close and math.isfinite(ticker.close):
+        close = Cash(currency=currency, quantity=Decimal(ticker.close))
+
+    return Quote(bid=bid, ask=ask, last=last, close=close)
+
+
+def instrumentExpiration(instrument: Instrument) -> Optional[date]:
+    if isinstance(instrument, Option) or isinstance(instrument, Future):
+        return instrument.expiration
+    else:
+        return None
+
+
+# Persists the contracts that IB has qualified for each instrument, so that later runs can skip qualification entirely.
+class ContractCache:
+    # Only the fields needed to identify a qualified contract when requesting market data.
+    contractFields = [
+        'conId', 'secType', 'symbol', 'localSymbol', 'exchange',
+        'primaryExchange', 'currency', 'lastTradeDateOrContractMonth',
+        'strike', 'right', 'multiplier', 'tradingClass'
+    ]
+
+    @classmethod
+    def key(cls, instrument: Instrument) -> str:
+        expiration = instrumentExpiration(instrument)
+        strike = instrument.strike if isinstance(instrument, Option) else None
+
+        return '|'.join([
+            type(instrument).__name__, instrument.symbol,
+            instrument.currency.value,
+            expiration.isoformat() if expiration else '',
+            str(strike) if strike is not None else ''
+        ])
+
+    def __init__(self, path: Optional[Path] = None):
+        self._path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+
+        if path and path.exists():
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+                if not isinstance(entries, dict):
+                    raise ValueError('Expected an object of entries')
+            except (OSError, ValueError) as err:
+                logging.warning(
+                    'Ignoring unreadable contract cache {}: {}'.format(
+                        path, err))
+                entries = {}
+
+            self._entries = {
+                k: v
+                for k, v in entries.items() if self.isValidEntry(v)
+            }
+            if len(self._entries) < len(entries):
+                logging.warning(
+                    'Ignoring {} malformed entries in contract cache {}'.
+                    format(len(entries) - len(self._entries), path))
+
+        self.pruneExpired()
+        super().__init__()
+
+    # Whether a loaded entry has the shape written by set(), as the file might have been edited or written by another version.
+    @classmethod
+    def isValidEntry(cls, entry: Any) -> bool:
+        if not isinstance(entry, dict) or not isinstance(
+                entry.get('contract'), dict):
+            return False
+
+        if not set(entry['contract']).issubset(cls.contractFields):
+            return False
+
+        if 'expiration' not in entry:
+            return False
+        if entry['expiration'] is None:
+            return True
+
+        try:
+            datetime.strptime(entry['expiration'], '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return False
+
+        return True
+
+    def pruneExpired(self, today: Optional[date] = None) -> None:
+        today = today or date.today()
+        self._entries = {
+            k: v
+            for k, v in self._entries.items() if not v['expiration']
+            or datetime.strptime(v['expiration'], '%Y-%m-%d').date() >= today
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, instrument: Instrument) -> Optional[IB.Contract]:
+        entry = self._entries.get(self.key(instrument))
+        if entry is None:
+            return None
+
+        return IB.Contract(**entry['contract'])
+
+    def set(self, instrument: Instrument, con: IB.Contract) -> None:
+        expiration = instrumentExpiration(instrument)
+        self._entries[self.key(instrument)] = {
+            'expiration': expiration.isoformat() if expiration else None,
+            'contract': {f: getattr(con, f)
+                         for f in self.contractFields},
+        }
+
+    def save(self) -> None:
+        if not self._path:
+            return
+
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Write atomically, so an interrupted write never leaves a truncated cache.
+            temporaryPath = self._path.with_suffix('.tmp{}'.format(
+                os.getpid()))
+            with open(temporaryPath, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temporaryPath, self._path)
+        except OSError as err:
+            logging.warning('Could not write contract cache {}: {}'.format(
+                self._path, err))
+
+
+def chunked(xs: List[T], size: int) -> List[List[T]]:
+    return [xs[i:i + size] for i in range(0, len(xs), size)]
+
+
+# Paces requests to TWS to stay within IB's limits: https://interactivebrokers.github.io/tws-api/market_data.html
+#
+# At most `maxLines` market data lines are used at once (snapshots and subscriptions alike), and at most `maxMessages` messages are sent per `interval`. Requests beyond either limit wait their turn, except that subscriptions (which never release their lines by themselves) fail with ValueError if they would hold every line.
+class MarketDataScheduler:
+    def __init__(self,
+                 client: IB.IB,
+                 maxLines: int = 100,
+                 maxMessages: int = 50,
+                 interval: timedelta = timedelta(seconds=1),
+                 clock: Callable[[], float] = time.monotonic):
+        if maxLines <= 0:
+            raise ValueError(
+                'Expected positive number of market data lines: {}'.format(
+                    maxLines))
+        if maxMessages <= 0:
+            raise ValueError(
+                'Expected positive number of messages per interval: {}'.format(
+                    maxMessages))
+
         self._client = client
+        self._maxLines = maxLines
+        self._maxMessages = maxMessages
+        self._interval = interval.total_seconds()
+        self._clock = clock
+
+        self._linesInUse = 0
+        self._streamingLines = 0
+        self._linesReleased: Optional[asyncio.Condition] = None
+        self._sentTimes: Deque[float] = deque()
+        self._marketDataType: Optional[MarketDataType] = None
+        self._subscriptions: Dict[int, Tuple[IB.Contract, IB.Ticker]] = {}
         super().__init__()
 
-    def fetchQuote(self,
-                   instrument: Instrument,
-                   dataType: MarketDataType = MarketDataType.DELAYED_FROZEN
-                   ) -> Quote:
+    @property
+    def maxLines(self) -> int:
+        return self._maxLines
+
+    @property
+    def linesInUse(self) -> int:
+        return self._linesInUse
+
+    # Lines held (or about to be held) by streaming subscriptions.
+    @property
+    def streamingLines(self) -> int:
+        return self._streamingLines
+
+    # Waits until `count` more messages can be sent without exceeding the message rate, then reserves them.
+    async def _throttle(self, count: int = 1) -> None:
+        assert count <= self._maxMessages
+
+        while True:
+            now = self._clock()
+            while self._sentTimes and self._sentTimes[
+                    0] <= now - self._interval:
+                self._sentTimes.popleft()
+
+            if len(self._sentTimes) + count <= self._maxMessages:
+                self._sentTimes.extend([now] * count)
+                return
+
+            await asyncio.sleep(self._sentTimes[0] + self._interval - now)
+
+    def _lineCondition(self) -> asyncio.Condition:
+        # Created lazily, so it belongs to the event loop actually running requests.
+        if self._linesReleased is None:
+            self._linesReleased = asyncio.Condition()
+
+        return self._linesReleased
+
+    async def _acquireLines(self, count: int) -> None:
+        assert count <= self._maxLines
+
+        condition = self._lineCondition()
+        async with condition:
+            await condition.wait_for(lambda: self._linesInUse + count <= self.
+                                     _maxLines)
+            self._linesInUse += count
+
+    async def _releaseLines(self, count: int) -> None:
+        condition = self._lineCondition()
+        async with condition:
+            self._linesInUse -= count
+            condition.notify_all()
+
+    async def setMarketDataType(self, dataType: MarketDataType) -> None:
+        if dataType == self._marketDataType:
+            return
+
+        await self._throttle()
         self._client.reqMarketDataType(dataType.value)
+        self._marketDataType = dataType
+
+    # Qualifies contracts in place, one request per batch of as many contracts as the message rate allows.
+    async def qualify(self, *contracts: IB.Contract) -> None:
+        for chunk in chunked(list(contracts), self._maxMessages):
+            await self._throttle(len(chunk))
+            await self._client.qualifyContractsAsync(*chunk)
+
+    # Requests snapshot tickers for the given contracts, returned in the same order. Snapshots end by themselves, releasing their lines once received.
+    async def snapshot(self, *contracts: IB.Contract) -> List[IB.Ticker]:
+        async def request(chunk: List[IB.Contract]) -> List[IB.Ticker]:
+            await self._acquireLines(len(chunk))
+            try:
+                await self._throttle(len(chunk))
+                tickers: List[IB.Ticker] = await self._client.reqTickersAsync(
+                    *chunk)
+                return tickers
+            finally:
+                await self._releaseLines(len(chunk))
+
+        # Lines held by subscriptions won't be released while waiting, so don't wait for more than are left.
+        freeLines = self._maxLines - self._streamingLines
+        if freeLines <= 0:
+            raise ValueError(
+                'All {} market data lines are held by subscriptions, leaving none for snapshots'
+                .format(self._maxLines))
+
+        chunks = chunked(list(contracts), min(freeLines, self._maxMessages))
+        results = await asyncio.gather(*(request(c) for c in chunks))
+        return [ticker for tickers in results for ticker in tickers]
+
+    # Opens a streaming market data subscription, which holds a line until unsubscribed.
+    async def subscribe(self, con: IB.Contract) -> IB.Ticker:
+        if con.conId in self._subscriptions:
+            return self._subscriptions[con.conId][1]
+
+        # Otherwise, this would wait forever for a line to be released.
+        if self._streamingLines >= self._maxLines:
+            raise ValueError(
+                'All {} market data lines are held by subscriptions; cannot subscribe to {}'
+                .format(self._maxLines, con))
+
+        self._streamingLines += 1
+        try:
+            await self._acquireLines(1)
+        except BaseException:
+            self._streamingLines -= 1
+            raise
 
-        con = contract(instrument)
-        self._client.qualifyContracts(con)
+        try:
+            await self._throttle()
+            ticker: IB.Ticker = self._client.reqMktData(con)
+        except BaseException:
+            self._streamingLines -= 1
+            await self._releaseLines(1)
+            raise
+
+        self._subscriptions[con.conId] = (con, ticker)
+        return ticker
+
+    async def unsubscribe(self, con: IB.Contract) -> None:
+        if self._subscriptions.pop(con.conId, None) is None:
+            return
+
+        try:
+            await self._throttle()
+            self._client.cancelMktData(con)
+        finally:
+            self._streamingLines -= 1
+            await self._releaseLines(1)
+
+    async def unsubscribeAll(self) -> None:
+        for (con, _) in list(self._subscriptions.values()):
+            await self.unsubscribe(con)
+
+
+class IBDataProvider(LiveDataProvider):
+    # Market data lines to leave for snapshots when there are too many instruments to stream them all, so that the rest can be polled instead.
+    pollingLines = 10
+
+    def __init__(self,
+                 client: IB.IB,
+                 contractCache: Optional[ContractCache] = None,
+                 scheduler: Optional[MarketDataScheduler] = None):
+        if contractCache is None:
+            contractCache = ContractCache()
+        if scheduler is None:
+            scheduler = MarketDataScheduler(client)
+
+        self._client = client
+        self._contractCache = contractCache
+        self._scheduler = scheduler
+        self._quoteHandlers: List[
+            Tuple[IB.Ticker, Callable[[IB.Ticker], None]]] = []
+        self._pollingTasks: List['asyncio.Future[None]'] = []
+        self._pendingQualification: Dict[Instrument, IB.Contract] = {}
+        self._qualificationBatch: Optional[
+            'asyncio.Future[Dict[Instrument, IB.Contract]]'] = None
+        super().__init__()
 
-        ticker = self._client.reqTickers(con)[0]
+    @property
+    def scheduler(self) -> MarketDataScheduler:
+        return self._scheduler
+
+    # Splits instruments into those with a cached qualified contract, and (unqualified) contracts for the rest.
+    def _lookUpContracts(
+            self, instruments: Iterable[Instrument]
+    ) -> Tuple[Dict[Instrument, IB.Contract], Dict[Instrument, IB.Contract]]:
+        cached: Dict[Instrument, IB.Contract] = {}
+        unqualified: Dict[Instrument, IB.Contract] = {}
+
+        for i in instruments:
+            con = self._contractCache.get(i)
+            if con is not None:
+                cached[i] = con
+            else:
+                unqualified[i] = contract(i)
+
+        return (cached, unqualified)
+
+    # Records contracts which IB has just been asked to qualify, and returns the ones which succeeded.
+    def _recordQualified(self, contracts: Dict[Instrument, IB.Contract]
+                         ) -> Dict[Instrument, IB.Contract]:
+        result: Dict[Instrument, IB.Contract] = {}
+
+        # Contracts that failed to qualify are left without a conId; requesting market data for them would only produce errors.
+        for i, con in contracts.items():
+            if con.conId:
+                result[i] = con
+                self._contractCache.set(i, con)
+            else:
+                logging.warning('Could not qualify contract for {}'.format(i))
+
+        self._contractCache.save()
+        return result
+
+    # Qualifies contracts together with any others requested concurrently (e.g., by many fetchQuoteAsync() calls at once), so they share requests, and the contract cache is saved once per batch rather than once per instrument.
+    async def _qualifyBatched(self, contracts: Dict[Instrument, IB.Contract]
+                              ) -> Dict[Instrument, IB.Contract]:
+        for (i, con) in contracts.items():
+            self._pendingQualification.setdefault(i, con)
+
+        if self._qualificationBatch is None:
+            self._qualificationBatch = asyncio.ensure_future(
+                self._qualifyPending())
+
+        # Shielded, so that cancelling one caller doesn't fail the others in the batch.
+        qualified = await asyncio.shield(self._qualificationBatch)
+        return {i: qualified[i] for i in contracts if i in qualified}
+
+    async def _qualifyPending(self) -> Dict[Instrument, IB.Contract]:
+        # Let other tasks which are about to qualify contracts join this batch.
+        await asyncio.sleep(0)
+
+        pending = self._pendingQualification
+        self._pendingQualification = {}
+        self._qualificationBatch = None
+
+        await self._scheduler.qualify(*pending.values())
+        return self._recordQualified(pending)
+
+    # Returns qualified contracts for the given instruments, consulting the contract cache first and qualifying the rest in as few requests as possible. Instruments which could not be qualified are omitted.
+    async def qualifiedContractsAsync(self, instruments: Iterable[Instrument]
+                                      ) -> Dict[Instrument, IB.Contract]:
+        (result, unqualified) = self._lookUpContracts(instruments)
+        if unqualified:
+            result.update(await self._qualifyBatched(unqualified))
+
+        return result
+
+    def qualifiedContracts(self, instruments: Iterable[Instrument]
+                           ) -> Dict[Instrument, IB.Contract]:
+        result: Dict[Instrument, IB.Contract] = IB.util.run(
+            self.qualifiedContractsAsync(instruments))
+        return result
+
+    async def fetchQuoteAsync(
+            self,
+            instrument: Instrument,
+            dataType: MarketDataType = MarketDataType.DELAYED_FROZEN) -> Quote:
+        await self._scheduler.setMarketDataType(dataType)
+
+        con = (await
+               self.qualifiedContractsAsync([instrument])).get(instrument)
+        if con is None:
+            raise ValueError(
+                'Could not qualify contract for {}'.format(instrument))
+
+        ticker = (await self._scheduler.snapshot(con))[0]
         logging.info('Received ticker: {}'.format(repr(ticker)))
 
-        bid: Optional[Cash] = None
-        ask: Optional[Cash] = None
-        last: Optional[Cash] = None
-        close: Optional[Cash] = None
-
-        if (ticker.bid
-                and math.isfinite(ticker.bid)) and not ticker.bidSize == 0:
-            bid = Cash(currency=instrument.currency,
-                       quantity=Decimal(ticker.bid))
-        if (ticker.ask
-                and math.isfinite(ticker.ask)) and not ticker.askSize == 0:
-            ask = Cash(currency=instrument.currency,
-                       quantity=Decimal(ticker.ask))
-        if (ticker.last
-                and math.isfinite(ticker.last)) and not ticker.lastSize == 0:
-            last = Cash(currency=instrument.currency,
-                        quantity=Decimal(ticker.last))
-        if ticker.close and math.isfinite(ticker.close):
-            close = Cash(currency=instrument.currency,
-                         quantity=Decimal(ticker.close))
-
-        return Quote(bid=bid, ask=ask, last=last, close=close)
+        return quoteFromTicker(ticker, currency=instrument.currency)
+
+    def fetchQuote(self,
+                   instrument: Instrument,
+                   dataType: MarketDataType = MarketDataType.DELAYED_FROZEN
+                   ) -> Quote:
+        quote: Quote = IB.util.run(
+            self.fetchQuoteAsync(instrument, dataType=dataType))
+        return quote
+
+    async def fetchQuotesAsync(
+            self,
+            instruments: Iterable[Instrument],
+            dataType: MarketDataType = MarketDataType.DELAYED_FROZEN
+    ) -> Dict[Instrument, Quote]:
+        instruments = list(instruments)
+        if not instruments:
+            return {}
+
+        await self._scheduler.setMarketDataType(dataType)
+
+        qualified = await self.qualifiedContractsAsync(instruments)
+        tickers = await self._scheduler.snapshot(*qualified.values())
+
+        result: Dict[Instrument, Quote] = {}
+        for (i, ticker) in zip(qualified.keys(), tickers):
+            logging.info('Received ticker: {}'.format(repr(ticker)))
+            result[i] = quoteFromTicker(ticker, currency=i.currency)
+
+        return result
+
+    def fetchQuotes(self,
+                    instruments: Iterable[Instrument],
+                    dataType: MarketDataType = MarketDataType.DELAYED_FROZEN
+                    ) -> Dict[Instrument, Quote]:
+        result: Dict[Instrument, Quote] = IB.util.run(
+            self.fetchQuotesAsync(instruments, dataType=dataType))
+        return result
+
+    # Opens streaming market data for the given instruments, invoking `onQuote` with a fresh quote whenever one of them updates. Subscriptions remain open until `unsubscribeQuotes` is called.
+    #
+    # Each subscription holds a market data line. If there are more instruments than free lines, all but `pollingLines` are used for streaming, and the remaining instruments are instead polled with snapshots every `pollInterval`.
+    async def subscribeQuotes(
+            self,
+            instruments: Iterable[Instrument],
+            onQuote: Callable[[Instrument, Quote], None],
+            dataType: MarketDataType = MarketDataType.DELAYED_FROZEN,
+            pollInterval: timedelta = timedelta(seconds=5)) -> None:
+        await self._scheduler.setMarketDataType(dataType)
+
+        qualified = list((await
+                          self.qualifiedContractsAsync(instruments)).items())
+
+        freeLines = self._scheduler.maxLines - self._scheduler.streamingLines
+        if len(qualified) > freeLines:
+            if freeLines <= 0:
+                raise ValueError(
+                    'All {} market data lines are already held by subscriptions'
+                    .format(self._scheduler.maxLines))
+
+            streamedCount = max(0, freeLines - self.pollingLines)
+            logging.warning(
+                'Only {} market data lines are free: streaming quotes for {} instruments, and polling {} every {}'
+                .format(freeLines, streamedCount,
+                        len(qualified) - streamedCount, pollInterval))
+
+            polled = dict(qualified[streamedCount:])
+            qualified = qualified[:streamedCount]
+
+            self._pollingTasks.append(
+                asyncio.ensure_future(
+                    self._pollQuotes(polled, onQuote, pollInterval)))
+
+        for (i, con) in qualified:
+            ticker = await self._scheduler.subscribe(con)
+
+            def tickerUpdated(t: IB.Ticker,
+                              instrument: Instrument = i) -> None:
+                onQuote(instrument,
+                        quoteFromTicker(t, currency=instrument.currency))
+
+            ticker.updateEvent += tickerUpdated
+            self._quoteHandlers.append((ticker, tickerUpdated))
+
+    async def _pollQuotes(self, contracts: Dict[Instrument, IB.Contract],
+                          onQuote: Callable[[Instrument, Quote], None],
+                          interval: timedelta) -> None:
+        while True:
+            tickers = await self._scheduler.snapshot(*contracts.values())
+            for (i, ticker) in zip(contracts.keys(), tickers):
+                onQuote(i, quoteFromTicker(ticker, currency=i.currency))
+
+            await asyncio.sleep(interval.total_seconds())
+
+    async def unsubscribeQuotes(self) -> None:
+        for task in self._pollingTasks:
+            task.cancel()
+
+        await asyncio.gather(*self._pollingTasks, return_exceptions=True)
+        self._pollingTasks = []
+
+        for (ticker, handler) in self._quoteHandlers:
+            ticker.updateEvent -= handler
+
+        self._quoteHandlers = []
+        await self._scheduler.unsubscribeAll()
@@ -0,0 +1,380 @@
+from datetime import datetime
+from decimal import Decimal
+from model import Cash, Currency, Instrument, Position, Trade, TradeFlags
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+# Dense index of every currency, used to store currencies as small integers.
+currencies: List[Currency] = list(Currency)
+currencyIndices: Dict[Currency, int] = {c: i for i, c in enumerate(currencies)}
+
+# Trade quantities are stored as integer counts of this unit.
+quantityExponent = int(Position.quantityQuantization.as_tuple().exponent)
+
+
+def quantityToUnits(quantity: Decimal) -> int:
+    return int(quantity.scaleb(-quantityExponent))
+
+
+def unitsToQuantity(units: int) -> Decimal:
+    return Decimal(units).scaleb(quantityExponent)
+
+
+# A column of Cash values, stored as int64 fixed-point amounts (see Cash.units) alongside the index of each value's currency.
+class CashArray:
+    def __init__(self, units: np.ndarray, currencyIndices: np.ndarray):
+        if units.shape != currencyIndices.shape:
+            raise ValueError(
+                'Expected units and currencies of the same shape, got {} and {}'
+                .format(units.shape, currencyIndices.shape))
+
+        self._units = units.astype(np.int64, copy=False)
+        self._currencyIndices = currencyIndices.astype(np.uint8, copy=False)
+        super().__init__()
+
+    @classmethod
+    def fromCash(cls, values: Iterable[Cash]) -> 'CashArray':
+        values = list(values)
+        return cls(units=np.array([v.units for v in values], dtype=np.int64),
+                   currencyIndices=np.array(
+                       [currencyIndices[v.currency] for v in values],
+                       dtype=np.uint8))
+
+    @property
+    def units(self) -> np.ndarray:
+        return self._units
+
+    @property
+    def currencyIndices(self) -> np.ndarray:
+        return self._currencyIndices
+
+    def __len__(self) -> int:
+        return len(self._units)
+
+    def __getitem__(self, index: int) -> Cash:
+        return Cash.fromUnits(currencies[self._currencyIndices[index]],
+                              int(self._units[index]))
+
+    def take(self, indices: np.ndarray) -> 'CashArray':
+        return CashArray(units=self._units[indices],
+                         currencyIndices=self._currencyIndices[indices])
+
+    def toCash(self) -> List[Cash]:
+        return [
+            Cash.fromUnits(currencies[c], u) for (
+                u,
+                c) in zip(self._units.tolist(), self._currencyIndices.tolist())
+        ]
+
+    def sumByCurrency(self) -> Dict[Currency, Cash]:
+        sums = np.zeros(len(currencies), dtype=np.int64)
+        np.add.at(sums, self._currencyIndices, self._units)
+
+        present = np.unique(self._currencyIndices)
+        return {
+            currencies[c]: Cash.fromUnits(currencies[c], int(sums[c]))
+            for c in present.tolist()
+        }
+
+
+# A columnar, NumPy-backed collection of trades, for portfolio-wide math that would be slow over lists of Trade objects.
+#
+# Instruments are stored as indices into a dense table of distinct instruments, which is shared by ledgers derived from this one (e.g., by filtering).
+class TradeLedger:
+    def __init__(self, trades: Iterable[Trade]):
+        instruments: List[Instrument] = []
+        instrumentIndices: Dict[Instrument, int] = {}
+
+        dates: List[datetime] = []
+        instrumentIds: List[int] = []
+        quantities: List[int] = []
+        amounts: List[Cash] = []
+        fees: List[Cash] = []
+        flags: List[int] = []
+
+        for t in trades:
+            instrumentId = instrumentIndices.get(t.instrument)
+            if instrumentId is None:
+                instrumentId = len(instruments)
+                instrumentIndices[t.instrument] = instrumentId
+                instruments.append(t.instrument)
+
+            dates.append(t.date)
+            instrumentIds.append(instrumentId)
+            quantities.append(quantityToUnits(t.quantity))
+            amounts.append(t.amount)
+            fees.append(t.fees)
+            flags.append(t.flags.value)
+
+        self._instruments = instruments
+        self._instrumentIndices = instrumentIndices
+        self._dates = np.array(dates, dtype='datetime64[us]')
+        self._instrumentIds = np.array(instrumentIds, dtype=np.int32)
+        self._quantities = np.array(quantities, dtype=np.int64)
+        self._amounts = CashArray.fromCash(amounts)
+        self._fees = CashArray.fromCash(fees)
+        self._flags = np.array(flags, dtype=np.uint8)
+        super().__init__()
+
+    # Creates a ledger from existing columns, sharing the given instrument table (and its index).
+    @classmethod
+    def _fromColumns(cls, instruments: List[Instrument],
+                     instrumentIndices: Dict[Instrument, int],
+                     dates: np.ndarray, instrumentIds: np.ndarray,
+                     quantities: np.ndarray, amounts: CashArray,
+                     fees: CashArray, flags: np.ndarray) -> 'TradeLedger':
+        ledger: TradeLedger = cls.__new__(cls)
+        ledger._instruments = instruments
+        ledger._instrumentIndices = instrumentIndices
+        ledger._dates = dates
+        ledger._instrumentIds = instrumentIds
+        ledger._quantities = quantities
+        ledger._amounts = amounts
+        ledger._fees = fees
+        ledger._flags = flags
+        return ledger
+
+    # The distinct instruments referred to by `instrumentIds`. Derived ledgers may not use every instrument in the table.
+    @property
+    def instruments(self) -> Sequence[Instrument]:
+        return self._instruments
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self._dates
+
+    @property
+    def instrumentIds(self) -> np.ndarray:
+        return self._instrumentIds
+
+    # Trade quantities, in units of Position.quantityQuantization.
+    @property
+    def quantities(self) -> np.ndarray:
+        return self._quantities
+
+    @property
+    def amounts(self) -> CashArray:
+        return self._amounts
+
+    @property
+    def fees(self) -> CashArray:
+        return self._fees
+
+    # TradeFlags values.
+    @property
+    def flags(self) -> np.ndarray:
+        return self._flags
+
+    def __len__(self) -> int:
+        return len(self._dates)
+
+    def __getitem__(self, index: int) -> Trade:
+        return Trade(date=self._dates[index].astype(datetime),
+                     instrument=self._instruments[self._instrumentIds[index]],
+                     quantity=unitsToQuantity(int(self._quantities[index])),
+                     amount=self._amounts[index],
+                     fees=self._fees[index],
+                     flags=TradeFlags(int(self._flags[index])))
+
+    def toTrades(self) -> List[Trade]:
+        return [
+            Trade(date=date,
+                  instrument=self._instruments[instrumentId],
+                  quantity=unitsToQuantity(quantity),
+                  amount=amount,
+                  fees=fee,
+                  flags=TradeFlags(flags))
+            for (
+                date, instrumentId, quantity, amount, fee,
+                flags) in zip(self._dates.tolist(), self._instrumentIds.tolist(
+                ), self._quantities.tolist(), self._amounts.toCash(),
+                              self._fees.toCash(), self._flags.tolist())
+        ]
+
+    # Returns a ledger of the trades at the given indices (or where the given boolean mask is true), in that order.
+    def take(self, indices: np.ndarray) -> 'TradeLedger':
+        return TradeLedger._fromColumns(
+            instruments=self._instruments,
+            instrumentIndices=self._instrumentIndices,
+            dates=self._dates[indices],
+            instrumentIds=self._instrumentIds[indices],
+            quantities=self._quantities[indices],
+            amounts=self._amounts.take(indices),
+            fees=self._fees.take(indices),
+            flags=self._flags[indices])
+
+    def filter(self, mask: np.ndarray) -> 'TradeLedger':
+        if mask.dtype != np.bool_ or mask.shape != self._dates.shape:
+            raise ValueError(
+                'Expected boolean mask with one entry per trade, got {} of shape {}'
+                .format(mask.dtype, mask.shape))
+
+        return self.take(mask)
+
+    def instrumentMask(self, instrument: Instrument) -> np.ndarray:
+        instrumentId = self._instrumentIndices.get(instrument)
+        if instrumentId is None:
+            return np.zeros(len(self), dtype=np.bool_)
+
+        mask: np.ndarray = self._instrumentIds == instrumentId
+        return mask
+
+    def flagsMask(self, flags: TradeFlags) -> np.ndarray:
+        mask: np.ndarray = (self._flags & flags.value) == flags.value
+        return mask
+
+    def sortedByDate(self, reverse: bool = False) -> 'TradeLedger':
+        # A stable sort keeps trades on the same date in their original order.
+        indices = np.argsort(self._dates, kind='stable')
+        if reverse:
+            indices = indices[::-1]
+
+        return self.take(indices)
+
+    # Sums the given per-trade column (e.g., `quantities` or `amounts.units`) for each instrument in the instrument table.
+    def sumByInstrument(self, column: np.ndarray) -> np.ndarray:
+        sums = np.zeros(len(self._instruments), dtype=column.dtype)
+        np.add.at(sums, self._instrumentIds, column)
+        return sums
+
+    def quantityByInstrument(self) -> Dict[Instrument, Decimal]:
+        sums = self.sumByInstrument(self._quantities)
+        present = np.unique(self._instrumentIds)
+
+        return {
+            self._instruments[i]: unitsToQuantity(int(sums[i]))
+            for i in present.tolist()
+        }
+
+    # Sums the trade amounts for each instrument. Raises ValueError if any one instrument's amounts are in different currencies.
+    def amountByInstrument(self) -> Dict[Instrument, Cash]:
+        sums = self.sumByInstrument(self._amounts.units)
+        present = np.unique(self._instrumentIds)
+
+        # Compare the lowest and highest currency used for each instrument; they must match.
+        currencyIndices = self._amounts.currencyIndices.astype(np.int64)
+        lowest = np.full(len(self._instruments), len(currencies), np.int64)
+        highest = np.full(len(self._instruments), -1, np.int64)
+        np.minimum.at(lowest, self._instrumentIds, currencyIndices)
+        np.maximum.at(highest, self._instrumentIds, currencyIndices)
+
+        mixed = present[lowest[present] != highest[present]]
+        if len(mixed):
+            raise ValueError(
+                'Trade amounts for {} are in more than one currency'.format(
+                    self._instruments[mixed[0]]))
+
+        return {
+            self._instruments[i]: Cash.fromUnits(currencies[lowest[i]],
+                                                 int(sums[i]))
+            for i in present.tolist()
+        }
+
+
+# A columnar, NumPy-backed collection of positions, like TradeLedger.
+# Instruments are indexed by identity, rather than equality, so that instruments which compare equal but differ otherwise (e.g., futures differing only in multiplier) keep separate entries in the instrument table. Parsers intern instruments, so this doesn't usually duplicate any.
+class PositionLedger:
+    def __init__(self, positions: Iterable[Position]):
+        instruments: List[Instrument] = []
+        instrumentIndices: Dict[int, int] = {}
+
+        instrumentIds: List[int] = []
+        quantities: List[int] = []
+        costBases: List[Cash] = []
+
+        for p in positions:
+            # The table keeps each instrument alive, so its id() isn't reused.
+            instrumentId = instrumentIndices.get(id(p.instrument))
+            if instrumentId is None:
+                instrumentId = len(instruments)
+                instrumentIndices[id(p.instrument)] = instrumentId
+                instruments.append(p.instrument)
+
+            instrumentIds.append(instrumentId)
+            quantities.append(quantityToUnits(p.quantity))
+            costBases.append(p.costBasis)
+
+        self._instruments = instruments
+        self._instrumentIds = np.array(instrumentIds, dtype=np.int32)
+        self._quantities = np.array(quantities, dtype=np.int64)
+        self._costBases = CashArray.fromCash(costBases)
+        super().__init__()
+
+    # Creates a ledger from existing columns, sharing the given instrument table.
+    @classmethod
+    def _fromColumns(cls, instruments: List[Instrument],
+                     instrumentIds: np.ndarray, quantities: np.ndarray,
+                     costBases: CashArray) -> 'PositionLedger':
+        ledger: PositionLedger = cls.__new__(cls)
+        ledger._instruments = instruments
+        ledger._instrumentIds = instrumentIds
+        ledger._quantities = quantities
+        ledger._costBases = costBases
+        return ledger
+
+    @property
+    def instruments(self) -> Sequence[Instrument]:
+        return self._instruments
+
+    @property
+    def instrumentIds(self) -> np.ndarray:
+        return self._instrumentIds
+
+    # Position quantities, in units of Position.quantityQuantization.
+    @property
+    def quantities(self) -> np.ndarray:
+        return self._quantities
+
+    @property
+    def costBases(self) -> CashArray:
+        return self._costBases
+
+    def __len__(self) -> int:
+        return len(self._instrumentIds)
+
+    def toPositions(self) -> List[Position]:
+        return [
+            Position(instrument=self._instruments[instrumentId],
+                     quantity=unitsToQuantity(quantity),
+                     costBasis=costBasis)
+            for (instrumentId, quantity,
+                 costBasis) in zip(self._instrumentIds.tolist(
+                 ), self._quantities.tolist(), self._costBases.toCash())
+        ]
+
+    # Combines positions in the same instrument, like bankroll.combinePositions(): the result has one position per instrument, sorted by instrument.
+    #
+    # Also like combinePositions(), instruments which compare equal are combined, into whichever of them appears first.
+    #
+    # A position's cost basis is always in the currency of its instrument, so per-instrument sums never mix currencies.
+    def combined(self) -> 'PositionLedger':
+        (present, firstIndices) = np.unique(self._instrumentIds,
+                                            return_index=True)
+
+        # Maps each instrument in the table to the first equal instrument present.
+        groups = np.zeros(len(self._instruments), dtype=np.int32)
+        firstEqual: Dict[Instrument, int] = {}
+        for i in present[np.argsort(firstIndices)].tolist():
+            groups[i] = firstEqual.setdefault(self._instruments[i], i)
+
+        groupIds = groups[self._instrumentIds]
+        order = sorted(firstEqual.values(), key=lambda i: self._instruments[i])
+        instrumentIds = np.array(order, dtype=np.int32)
+
+        quantities = np.zeros(len(self._instruments), dtype=np.int64)
+        np.add.at(quantities, groupIds, self._quantities)
+
+        costBases = np.zeros(len(self._instruments), dtype=np.int64)
+        np.add.at(costBases, groupIds, self._costBases.units)
+
+        currencyIndices = np.zeros(len(self._instruments), dtype=np.uint8)
+        currencyIndices[groupIds] = self._costBases.currencyIndices
+
+        return PositionLedger._fromColumns(
+            instruments=self._instruments,
+            instrumentIds=instrumentIds,
+            quantities=quantities[instrumentIds],
+            costBases=CashArray(
+                units=costBases[instrumentIds],
+                currencyIndices=currencyIndices[instrumentIds]))
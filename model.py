@@ -3,9 +3,10 @@ from datetime import date, datetime
 from decimal import Decimal, ROUND_HALF_EVEN
 from enum import Enum, Flag, auto, unique
 from itertools import permutations
-from typing import Any, Dict, Iterable, NamedTuple, Optional, TypeVar, Union
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple, Type, TypeVar, Union
 
 import re
+import weakref
 
 
 @unique
@@ -45,19 +46,30 @@ T = TypeVar('T', Decimal, int)
 
 
 class Cash:
+    # Cash is stored internally as an integer count of `quantization` units, so that arithmetic between Cash values is exact and needs no requantization.
     quantization = Decimal('0.0001')
 
+    __slots__ = ('_currency', '_units')
+
     @classmethod
     def quantize(cls, d: Decimal) -> Decimal:
         return d.quantize(cls.quantization, rounding=ROUND_HALF_EVEN)
 
+    # Creates Cash directly from an integer count of `quantization` units.
+    @classmethod
+    def fromUnits(cls, currency: Currency, units: int) -> 'Cash':
+        cash: Cash = cls.__new__(cls)
+        cash._currency = currency
+        cash._units = units
+        return cash
+
     def __init__(self, currency: Currency, quantity: Decimal):
         if not quantity.is_finite():
             raise ValueError(
                 'Cash quantity {} is not a finite number'.format(quantity))
 
         self._currency = currency
-        self._quantity = self.quantize(quantity)
+        self._units = int(self.quantize(quantity).scaleb(4))
         super().__init__()
 
     @property
@@ -66,7 +78,11 @@ class Cash:
 
     @property
     def quantity(self) -> Decimal:
-        return self._quantity
+        return Decimal(self._units).scaleb(-4)
+
+    @property
+    def units(self) -> int:
+        return self._units
 
     def __repr__(self) -> str:
         return 'Cash(currency={}, quantity={})'.format(repr(self.currency),
@@ -82,8 +98,7 @@ class Cash:
                     'Currency of {} must match {} for arithmetic'.format(
                         self, other))
 
-            return Cash(currency=self.currency,
-                        quantity=self.quantity + other.quantity)
+            return Cash.fromUnits(self.currency, self._units + other._units)
         else:
             return Cash(currency=self.currency, quantity=self.quantity + other)
 
@@ -94,22 +109,24 @@ class Cash:
                     'Currency of {} must match {} for arithmetic'.format(
                         self, other))
 
-            return Cash(currency=self.currency,
-                        quantity=self.quantity - other.quantity)
+            return Cash.fromUnits(self.currency, self._units - other._units)
         else:
             return Cash(currency=self.currency, quantity=self.quantity - other)
 
     def __mul__(self, other: T) -> 'Cash':
+        if isinstance(other, int):
+            return Cash.fromUnits(self.currency, self._units * other)
+
         return Cash(currency=self.currency, quantity=self.quantity * other)
 
     def __truediv__(self, other: T) -> 'Cash':
         return Cash(currency=self.currency, quantity=self.quantity / other)
 
     def __neg__(self) -> 'Cash':
-        return Cash(currency=self.currency, quantity=-self.quantity)
+        return Cash.fromUnits(self.currency, -self._units)
 
     def __abs__(self) -> 'Cash':
-        return Cash(currency=self.currency, quantity=abs(self.quantity))
+        return Cash.fromUnits(self.currency, abs(self._units))
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, Cash):
@@ -117,7 +134,7 @@ class Cash:
             b: bool = self.quantity == other
             return b
 
-        return self.currency == other.currency and self.quantity == other.quantity
+        return self.currency == other.currency and self._units == other._units
 
     def __lt__(self, other: 'Cash') -> bool:
         if self.currency != other.currency:
@@ -125,7 +142,7 @@ class Cash:
                 'Currency of {} must match {} for comparison'.format(
                     self, other))
 
-        return self.quantity < other.quantity
+        return self._units < other._units
 
     def __le__(self, other: 'Cash') -> bool:
         if self.currency != other.currency:
@@ -133,7 +150,7 @@ class Cash:
                 'Currency of {} must match {} for comparison'.format(
                     self, other))
 
-        return self.quantity <= other.quantity
+        return self._units <= other._units
 
     def __gt__(self, other: 'Cash') -> bool:
         if self.currency != other.currency:
@@ -141,7 +158,7 @@ class Cash:
                 'Currency of {} must match {} for comparison'.format(
                     self, other))
 
-        return self.quantity > other.quantity
+        return self._units > other._units
 
     def __ge__(self, other: 'Cash') -> bool:
         if self.currency != other.currency:
@@ -149,13 +166,18 @@ class Cash:
                 'Currency of {} must match {} for comparison'.format(
                     self, other))
 
-        return self.quantity >= other.quantity
+        return self._units >= other._units
 
     def __hash__(self) -> int:
-        return hash((self.currency, self.quantity))
+        return hash((self.currency, self._units))
+
+
+_InstrumentT = TypeVar('_InstrumentT', bound='Instrument')
 
 
 class Instrument(ABC):
+    __slots__ = ('_symbol', '_currency', '_hash', '__weakref__')
+
     multiplierQuantization = Decimal('0.1')
 
     @classmethod
@@ -163,6 +185,21 @@ class Instrument(ABC):
         return multiplier.quantize(cls.multiplierQuantization,
                                    rounding=ROUND_HALF_EVEN)
 
+    # Returns the instrument constructed from the given arguments, reusing a previously constructed instrument if the arguments are the same.
+    #
+    # Parsers should use this instead of the initializer, so that the many rows referring to one instrument share a single object, and validation and symbol formatting only happen once.
+    @classmethod
+    def interned(cls: Type[_InstrumentT], *args: Any,
+                 **kwargs: Any) -> _InstrumentT:
+        key = (cls, args, tuple(sorted(kwargs.items())))
+        instrument = _internedInstruments.get(key)
+        if instrument is None:
+            instrument = cls(*args, **kwargs)
+            _internedInstruments[key] = instrument
+
+        assert isinstance(instrument, cls)
+        return instrument
+
     @abstractmethod
     def __init__(self, symbol: str, currency: Currency):
         if not symbol:
@@ -172,6 +209,7 @@ class Instrument(ABC):
 
         self._symbol = symbol
         self._currency = currency
+        self._hash = hash((currency, symbol))
         super().__init__()
 
     @property
@@ -187,6 +225,10 @@ class Instrument(ABC):
         return Decimal(1)
 
     def __eq__(self, other: Any) -> bool:
+        # Interned instruments are usually identical if equal.
+        if self is other:
+            return True
+
         # Strict typechecking, because we want different types of Instrument to be inequal.
         if type(self) != type(other):
             return False
@@ -195,7 +237,15 @@ class Instrument(ABC):
                     and self.currency == other.currency)
 
     def __hash__(self) -> int:
-        return hash((self.currency, self.symbol))
+        return self._hash
+
+    # Arguments to the initializer which reconstruct this instrument.
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        return (self.symbol, self.currency)
+
+    # Pickles instruments as a call to interned(), instead of by their slots: the cached hash is derived from string hashes, which differ between processes (see PYTHONHASHSEED), so it must be recomputed on load.
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (type(self).interned, self._initializerArguments())
 
     def __lt__(self, other: 'Instrument') -> bool:
         return self.symbol < other.symbol
@@ -221,13 +271,22 @@ class Instrument(ABC):
         return self._symbol
 
 
+# Instruments returned by Instrument.interned(), keyed by class and constructor arguments. Entries are dropped once nothing else refers to the instrument.
+_internedInstruments: 'weakref.WeakValueDictionary[Tuple[Any, ...], Instrument]'
+_internedInstruments = weakref.WeakValueDictionary()
+
+
 # Also used for ETFs.
 class Stock(Instrument):
+    __slots__ = ()
+
     def __init__(self, symbol: str, currency: Currency):
         super().__init__(symbol, currency)
 
 
 class Bond(Instrument):
+    __slots__ = ()
+
     regexCUSIP = r'^[0-9]{3}[0-9A-Z]{5}[0-9]$'
 
     @classmethod
@@ -244,6 +303,10 @@ class Bond(Instrument):
 
         super().__init__(symbol, currency)
 
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        # Already validated when first constructed.
+        return (self.symbol, self.currency, False)
+
 
 @unique
 class OptionType(Enum):
@@ -252,6 +315,9 @@ class OptionType(Enum):
 
 
 class Option(Instrument):
+    __slots__ = ('_underlying', '_optionType', '_expiration', '_strike',
+                 '_multiplier')
+
     # Matches the multiplicative factor in OCC options symbology.
     strikeQuantization = Decimal('0.001')
 
@@ -311,6 +377,10 @@ class Option(Instrument):
     def multiplier(self) -> Decimal:
         return self._multiplier
 
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        return (self.underlying, self.currency, self.optionType,
+                self.expiration, self.strike, self.multiplier, self.symbol)
+
     def __repr__(self) -> str:
         return '{}(underlying={}, optionType={}, expiration={}, strike={}, currency={}, multiplier={})'.format(
             repr(type(self)), repr(self.underlying), repr(self.optionType),
@@ -319,6 +389,8 @@ class Option(Instrument):
 
 
 class FutureOption(Option):
+    __slots__ = ()
+
     def __init__(self, symbol: str, underlying: str, currency: Currency,
                  optionType: OptionType, expiration: date, strike: Decimal,
                  multiplier: Decimal):
@@ -330,8 +402,14 @@ class FutureOption(Option):
                          multiplier=multiplier,
                          symbol=symbol)
 
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        return (self.symbol, self.underlying, self.currency, self.optionType,
+                self.expiration, self.strike, self.multiplier)
+
 
 class Future(Instrument):
+    __slots__ = ('_multiplier', '_expiration')
+
     def __init__(self, symbol: str, currency: Currency, multiplier: Decimal,
                  expiration: date):
         if not multiplier.is_finite() or multiplier <= 0:
@@ -351,6 +429,9 @@ class Future(Instrument):
     def expiration(self) -> date:
         return self._expiration
 
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        return (self.symbol, self.currency, self.multiplier, self.expiration)
+
     def __repr__(self) -> str:
         return '{}(symbol={}, currency={}, multiplier={}, expiration={})'.format(
             repr(type(self)), repr(self.symbol), repr(self.currency),
@@ -358,6 +439,8 @@ class Future(Instrument):
 
 
 class Forex(Instrument):
+    __slots__ = ('_baseCurrency', )
+
     def __init__(self, baseCurrency: Currency, quoteCurrency: Currency):
         if baseCurrency == quoteCurrency:
             raise ValueError(
@@ -377,6 +460,9 @@ class Forex(Instrument):
     def baseCurrency(self) -> Currency:
         return self._baseCurrency
 
+    def _initializerArguments(self) -> Tuple[Any, ...]:
+        return (self.baseCurrency, self.quoteCurrency)
+
     def __repr__(self) -> str:
         return '{}(baseCurrency={}, quoteCurrency={})'.format(
             repr(type(self)), repr(self.baseCurrency),
@@ -451,6 +537,19 @@ class LiveDataProvider(ABC):
     def fetchQuote(self, instrument: Instrument) -> Quote:
         pass
 
+    # Fetches quotes for many instruments at once. Instruments which could not be quoted may be omitted from the result.
+    #
+    # Providers should override this if they can batch requests more efficiently than fetching each quote in turn.
+    def fetchQuotes(self, instruments: Iterable[Instrument]
+                    ) -> Dict[Instrument, Quote]:
+        return {i: self.fetchQuote(i) for i in instruments}
+
+    # Fetches a quote without blocking the event loop.
+    #
+    # Providers backed by asynchronous APIs should override this, so that many quotes can be requested concurrently.
+    async def fetchQuoteAsync(self, instrument: Instrument) -> Quote:
+        return self.fetchQuote(instrument)
+
 
 class Position:
     quantityQuantization = Decimal('0.0001')
@@ -544,25 +643,35 @@ class TradeFlags(Flag):
 
 
 class Trade:
+    validFlags = frozenset([
+        TradeFlags.OPEN, TradeFlags.CLOSE, TradeFlags.OPEN | TradeFlags.DRIP,
+        TradeFlags.OPEN | TradeFlags.ASSIGNED_OR_EXERCISED,
+        TradeFlags.CLOSE | TradeFlags.EXPIRED,
+        TradeFlags.CLOSE | TradeFlags.ASSIGNED_OR_EXERCISED
+    ])
+
     @classmethod
     def quantizeQuantity(cls, quantity: Decimal) -> Decimal:
         return Position.quantizeQuantity(quantity)
 
-    def __init__(self, date: datetime, instrument: Instrument,
-                 quantity: Decimal, amount: Cash, fees: Cash,
-                 flags: TradeFlags):
+    @classmethod
+    def validateFlags(cls, flags: TradeFlags) -> None:
+        if flags not in cls.validFlags:
+            raise ValueError('Invalid combination of flags: {}'.format(flags))
+
+    def __init__(self,
+                 date: datetime,
+                 instrument: Instrument,
+                 quantity: Decimal,
+                 amount: Cash,
+                 fees: Cash,
+                 flags: TradeFlags,
+                 sourceID: Optional[str] = None):
         if not quantity.is_finite():
             raise ValueError(
                 'Trade quantity {} is not a finite number'.format(quantity))
 
-        if flags not in [
-                TradeFlags.OPEN, TradeFlags.CLOSE,
-                TradeFlags.OPEN | TradeFlags.DRIP,
-                TradeFlags.OPEN | TradeFlags.ASSIGNED_OR_EXERCISED,
-                TradeFlags.CLOSE | TradeFlags.EXPIRED,
-                TradeFlags.CLOSE | TradeFlags.ASSIGNED_OR_EXERCISED
-        ]:
-            raise ValueError('Invalid combination of flags: {}'.format(flags))
+        self.validateFlags(flags)
 
         self._date = date
         self._instrument = instrument
@@ -570,6 +679,7 @@ class Trade:
         self._amount = amount
         self._fees = fees
         self._flags = flags
+        self._sourceID = sourceID
         super().__init__()
 
     @property
@@ -607,6 +717,11 @@ class Trade:
     def proceeds(self) -> Cash:
         return self.amount - self.fees
 
+    # An identifier which the broker assigned to this trade, if any. This is used to recognize the same trade imported from more than one source, and does not affect equality.
+    @property
+    def sourceID(self) -> Optional[str]:
+        return self._sourceID
+
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, Trade):
             return False
@@ -636,6 +751,15 @@ class Trade:
             self.date.date(), action, abs(self.quantity), self.instrument,
             self.amount, self.fees)
 
+    # Returns a copy of this trade with different flags. Unlike _replace(), this only validates the new flags, as nothing else has changed.
+    def replacingFlags(self, flags: TradeFlags) -> 'Trade':
+        self.validateFlags(flags)
+
+        trade: Trade = Trade.__new__(Trade)
+        trade.__dict__.update(self.__dict__)
+        trade._flags = flags
+        return trade
+
     def _replace(self, **kwargs: Any) -> 'Trade':
         vals: Dict[str, Any] = {
             k.lstrip('_'): v
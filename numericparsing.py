@@ -0,0 +1,55 @@
+from decimal import Context, Decimal, InvalidOperation, MAX_EMAX, MAX_PREC, MIN_EMIN, ROUND_HALF_EVEN
+from typing import Optional
+
+# Shared by all parsing, instead of entering a new local context per value. Passing it to the Decimal constructor makes invalid input raise, regardless of the thread's current context. (The constructor never rounds.) The precision and exponent limits are as wide as possible, so that scaling values into units is exact too.
+parsingContext = Context(prec=MAX_PREC,
+                         Emax=MAX_EMAX,
+                         Emin=MIN_EMIN,
+                         rounding=ROUND_HALF_EVEN,
+                         traps=[InvalidOperation])
+
+
+# Parses a plain decimal number (e.g., "-12.5"), raising ValueError unless it is finite.
+def parseFiniteDecimal(s: str) -> Decimal:
+    try:
+        value = Decimal(s, parsingContext)
+    except InvalidOperation:
+        raise ValueError('Input is not numeric: {}'.format(s)) from None
+
+    if not value.is_finite():
+        raise ValueError('Input is not numeric: {}'.format(s))
+
+    return value
+
+
+# Parses a monetary amount or quantity as formatted in broker statements, e.g., "$1,234.56", "-$5.00", or "(5.00)" for a negative number. If `notAvailable` is given, it is returned for "N/A"; otherwise, that raises ValueError.
+def parseAmount(s: str, notAvailable: Optional[Decimal] = None) -> Decimal:
+    # Most values only need dollar signs and thousands separators removed, so try that first. This skips `parsingContext`, which costs more than the parse itself: under a context that doesn't trap InvalidOperation, bad input becomes NaN instead, which is caught by the finiteness check. Parenthesized negatives, "N/A", and anything non-finite take the slower, strict path.
+    try:
+        value = Decimal(s.replace(',', '').replace('$', ''))
+    except InvalidOperation:
+        return _parseSpecialAmount(s, notAvailable)
+
+    if not value.is_finite():
+        return _parseSpecialAmount(s, notAvailable)
+
+    return value
+
+
+def _parseSpecialAmount(s: str, notAvailable: Optional[Decimal]) -> Decimal:
+    plain = s.replace(',', '').replace('$', '').strip()
+    if notAvailable is not None and plain == 'N/A':
+        return notAvailable
+
+    if not (plain.startswith('(') and plain.endswith(')')):
+        raise ValueError('Input is not numeric: {}'.format(s))
+
+    try:
+        value = Decimal(plain[1:-1], parsingContext)
+    except InvalidOperation:
+        raise ValueError('Input is not numeric: {}'.format(s)) from None
+
+    if not value.is_finite():
+        raise ValueError('Input is not numeric: {}'.format(s))
+
+    return -value
@@ -0,0 +1,203 @@
+from pathlib import Path
+from types import ModuleType
+from parsetools import ParseErrors, fileDigest
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import sys
+import zlib
+
+T = TypeVar('T')
+
+
+# Identifies the version of a parser by digesting the source of its module, and of the other modules in the same directory (i.e., in bankroll) that it refers to. This way, changing the parser or the model invalidates results cached by an older version, without needing to remember to bump a version number.
+def parserVersion(parse: Callable[..., object]) -> str:
+    module = sys.modules[parse.__module__]
+    moduleFile = inspect.getsourcefile(module)
+    assert moduleFile, 'Expected parser {} to be defined in a source file'.format(
+        parse)
+
+    directory = Path(moduleFile).parent
+    sources: Set[str] = {moduleFile}
+    for value in vars(module).values():
+        dependency = value if isinstance(
+            value, ModuleType) else inspect.getmodule(value)
+        try:
+            dependencyFile = inspect.getsourcefile(
+                dependency) if dependency else None
+        except TypeError:
+            # Built-in module.
+            continue
+
+        if dependencyFile and Path(dependencyFile).parent == directory:
+            sources.add(dependencyFile)
+
+    h = hashlib.sha256()
+    for source in sorted(sources):
+        with open(source, 'rb') as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+
+# Caches the results of parsing broker statements, so unchanged files don't need to be parsed again.
+#
+# Results are keyed by the content of the parsed file, the parser and its version (see parserVersion()), whether parsing was lenient, and whether parse failures were collected (in which case they are stored with the result, to be reported again on a hit). They are stored pickled and compressed, one file per entry. Once the total size of the entries exceeds `maxBytes`, the least recently used are evicted.
+#
+# Entries are usually loaded by a different process than the one which stored them, so cached values must not pickle anything process-specific, such as string hashes (see Instrument.__reduce__()).
+#
+# Only point this at a directory you trust, as loading an entry unpickles it.
+class ParseCache:
+    suffix = '.pickle.z'
+
+    def __init__(self, directory: Path, maxBytes: int = 64 * 1024 * 1024):
+        self._directory = directory
+        self._maxBytes = maxBytes
+        self._versions: Dict[Callable[..., object], str] = {}
+        self._hits = 0
+        self._misses = 0
+        super().__init__()
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    @property
+    def maxBytes(self) -> int:
+        return self._maxBytes
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def _version(self, parse: Callable[..., object]) -> str:
+        version = self._versions.get(parse)
+        if version is None:
+            version = parserVersion(parse)
+            self._versions[parse] = version
+
+        return version
+
+    def entryPath(self,
+                  parse: Callable[..., object],
+                  path: Path,
+                  lenient: bool,
+                  collectingErrors: bool = False) -> Path:
+        parts = [
+            fileDigest(path), parse.__module__, parse.__qualname__,
+            self._version(parse),
+            str(lenient)
+        ]
+        if collectingErrors:
+            parts.append('errors')
+
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+
+        return self._directory / (h.hexdigest() + self.suffix)
+
+    # Returns `parse(path, lenient=lenient)`, from the cache if possible.
+    #
+    # If `errors` is given, it is also passed to the parser, and any failures recorded into it (including those from when a cached result was first parsed).
+    def parse(self,
+              parse: Callable[..., T],
+              path: Path,
+              lenient: bool,
+              errors: Optional[ParseErrors] = None) -> T:
+        entryPath = self.entryPath(parse, path, lenient, errors is not None)
+
+        try:
+            with open(entryPath, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+
+            result: T
+            if errors is not None:
+                (result, recorded) = entry
+                errors.update(recorded)
+            else:
+                result = entry
+
+            # Mark as recently used.
+            os.utime(entryPath)
+            self._hits += 1
+            return result
+        except FileNotFoundError:
+            pass
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError,
+                AttributeError, ImportError) as err:
+            logging.warning(
+                'Ignoring unreadable parse cache entry {}: {}'.format(
+                    entryPath, err))
+
+        self._misses += 1
+        if errors is None:
+            result = parse(path, lenient=lenient)
+            self._store(entryPath, result)
+            return result
+
+        recorded = ParseErrors(maxSamples=errors.maxSamples)
+        result = parse(path, lenient=lenient, errors=recorded)
+        self._store(entryPath, (result, recorded))
+        errors.update(recorded)
+        return result
+
+    def _store(self, entryPath: Path, result: object) -> None:
+        try:
+            data = zlib.compress(
+                pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+            self._directory.mkdir(parents=True, exist_ok=True)
+
+            # Write atomically, so a concurrent reader never sees a partial entry.
+            temporaryPath = entryPath.with_suffix('.tmp{}'.format(os.getpid()))
+            with open(temporaryPath, 'wb') as f:
+                f.write(data)
+            os.replace(temporaryPath, entryPath)
+        except (OSError, pickle.PicklingError) as err:
+            logging.warning('Could not write parse cache entry {}: {}'.format(
+                entryPath, err))
+            return
+
+        self.evict()
+
+    def entries(self) -> List[Path]:
+        if not self._directory.exists():
+            return []
+
+        return list(self._directory.glob('*' + self.suffix))
+
+    # Removes the least recently used entries until the cache fits in `maxBytes`.
+    def evict(self) -> None:
+        stats = []
+        for entry in self.entries():
+            try:
+                stats.append((entry, entry.stat()))
+            except FileNotFoundError:
+                # Removed concurrently.
+                continue
+
+        totalBytes = sum(s.st_size for (_, s) in stats)
+        for (entry, stat) in sorted(stats, key=lambda e: e[1].st_mtime):
+            if totalBytes <= self._maxBytes:
+                break
+
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+
+            totalBytes -= stat.st_size
+
+    def clear(self) -> None:
+        for entry in self.entries():
+            entry.unlink()
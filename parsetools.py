@@ -1,25 +1,151 @@
+from pathlib import Path
 from sys import stderr
-from typing import Callable, Iterable, List, Optional, TypeVar
+from typing import Callable, Counter, Dict, Iterable, List, NamedTuple, Optional, TypeVar
 from warnings import warn
 
+import hashlib
+
 T = TypeVar('T')
 U = TypeVar('U')
 
 
-def lenientParse(xs: Iterable[T], transform: Callable[[T], U],
-                 lenient: bool) -> Iterable[U]:
+class ParseFailure(NamedTuple):
+    parser: str
+    errorType: str
+    message: str
+    input: str
+
+
+# Collects the failures from lenient parsing, instead of warning about each one.
+#
+# Every failure is counted, by exception type and by parser, but only the first `maxSamples` are kept (with their input rendered, truncated to `maxInputLength` characters), so a badly malformed file doesn't spend most of its time formatting rows nobody will read. Collectors can be pickled, to report failures from worker processes, and merged with update().
+class ParseErrors:
+    def __init__(self, maxSamples: int = 10, maxInputLength: int = 200):
+        self._maxSamples = maxSamples
+        self._maxInputLength = maxInputLength
+        self._countsByType: Counter[str] = Counter()
+        self._countsByParser: Counter[str] = Counter()
+        self._samples: List[ParseFailure] = []
+        super().__init__()
+
+    @property
+    def maxSamples(self) -> int:
+        return self._maxSamples
+
+    # The total number of failures recorded.
+    def __len__(self) -> int:
+        return sum(self._countsByParser.values())
+
+    @property
+    def countsByType(self) -> Dict[str, int]:
+        return dict(self._countsByType)
+
+    @property
+    def countsByParser(self) -> Dict[str, int]:
+        return dict(self._countsByParser)
+
+    # The first failures recorded, up to `maxSamples`.
+    @property
+    def samples(self) -> List[ParseFailure]:
+        return list(self._samples)
+
+    def record(self, parser: str, input: object, err: Exception) -> None:
+        errorType = type(err).__name__
+        self._countsByType[errorType] += 1
+        self._countsByParser[parser] += 1
+
+        if len(self._samples) < self._maxSamples:
+            rendered = str(input)
+            if len(rendered) > self._maxInputLength:
+                rendered = rendered[:self._maxInputLength] + '...'
+
+            self._samples.append(
+                ParseFailure(parser=parser,
+                             errorType=errorType,
+                             message=str(err),
+                             input=rendered))
+
+    # Adds the failures recorded by another collector into this one.
+    def update(self, other: 'ParseErrors') -> None:
+        self._countsByType.update(other._countsByType)
+        self._countsByParser.update(other._countsByParser)
+        self._samples.extend(
+            other._samples[:max(0, self._maxSamples - len(self._samples))])
+
+    # Describes the failures in a few lines, suitable for logging at the end of parsing.
+    def summary(self) -> str:
+        total = len(self)
+        if not total:
+            return 'No parse failures'
+
+        lines = [
+            'Skipped {} {} which failed to parse'.format(
+                total, 'input' if total == 1 else 'inputs')
+        ]
+
+        lines.append('By parser:')
+        lines += [
+            '    {}: {}'.format(parser, count)
+            for (parser, count) in self._countsByParser.most_common()
+        ]
+
+        lines.append('By error:')
+        lines += [
+            '    {}: {}'.format(errorType, count)
+            for (errorType, count) in self._countsByType.most_common()
+        ]
+
+        lines.append('First {} of {}:'.format(len(self._samples), total))
+        for sample in self._samples:
+            lines.append('    {}: {}: {}'.format(sample.parser,
+                                                 sample.errorType,
+                                                 sample.message))
+            lines.append('        in {}'.format(sample.input))
+
+        return '\n'.join(lines)
+
+
+# Applies `transform` to each input, optionally skipping (rather than raising) inputs for which it raises ValueError.
+#
+# Skipped inputs are recorded into `errors` if given, attributed to `parser` (by default, the name of `transform`), or otherwise each produces a RuntimeWarning.
+def lenientParse(xs: Iterable[T],
+                 transform: Callable[[T], U],
+                 lenient: bool,
+                 errors: Optional[ParseErrors] = None,
+                 parser: Optional[str] = None) -> Iterable[U]:
+    if parser is None:
+        parser = '{}.{}'.format(
+            getattr(transform, '__module__', None),
+            getattr(transform, '__qualname__',
+                    type(transform).__name__))
+
     def f(input: T) -> Optional[U]:
         try:
             return transform(input)
         except ValueError as err:
-            if lenient:
+            if not lenient:
+                raise
+
+            if errors is not None:
+                assert parser is not None
+                errors.record(parser, input, err)
+            else:
                 warn(
                     'Failed to parse {}: {}'.format(input, err),
                     category=RuntimeWarning,
                     # Pop all the way out of lenientParse() to show the warning
                     stacklevel=4)
-                return None
-            else:
-                raise
 
-    return (y for y in (f(x) for x in xs) if y is not None)
\ No newline at end of file
+            return None
+
+    return (y for y in (f(x) for x in xs) if y is not None)
+
+
+# Returns the SHA-256 digest of a file's contents, for use as a cache key.
+def fileDigest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
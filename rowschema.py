@@ -0,0 +1,188 @@
+from datetime import datetime
+from typing import Any, Callable, Dict, Generic, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Type, TypeVar
+
+T = TypeVar('T', bound=Tuple[Any, ...])
+U = TypeVar('U')
+
+Converter = Callable[[str], Any]
+
+
+# Returns a converter parsing a date (and optionally time) in the given strptime() format.
+def dateConverter(format: str) -> Callable[[str], datetime]:
+    def convert(s: str) -> datetime:
+        return datetime.strptime(s, format)
+
+    return convert
+
+
+# Wraps a converter, so that an empty field converts to `empty` instead.
+def defaultIfEmpty(converter: Callable[[str], U],
+                   empty: Any) -> Callable[[str], Any]:
+    def convert(s: str) -> Any:
+        return converter(s) if s else empty
+
+    return convert
+
+
+def _unreadField(field: str) -> property:
+    def get(self: Tuple[Any, ...]) -> Any:
+        raise AttributeError(
+            '{} is not read by the schema for {}; add it to `needed`'.format(
+                field,
+                type(self).__name__))
+
+    return property(get)
+
+
+# Creates a subclass of `rowType` on which reading any field outside of `needed` raises AttributeError, rather than quietly returning an empty value.
+def _projectedType(rowType: Type[T], needed: Set[str]) -> Type[T]:
+    fields: Sequence[str] = getattr(rowType, '_fields')
+
+    def __repr__(self: Tuple[Any, ...]) -> str:
+        return '{}({})'.format(
+            rowType.__name__, ', '.join('{}={!r}'.format(f, v)
+                                        for (f, v) in zip(fields, self)
+                                        if f in needed))
+
+    namespace: Dict[str, Any] = {
+        f: _unreadField(f)
+        for f in fields if f not in needed
+    }
+    namespace['__slots__'] = ()
+    namespace['__repr__'] = __repr__
+    namespace['__module__'] = rowType.__module__
+
+    projected: Type[T] = type(rowType.__name__, (rowType, ), namespace)
+    return projected
+
+
+# Describes how rows from a broker's export map onto a NamedTuple row type, so that a specialized function to build row values can be generated once, instead of slicing and validating each row generically.
+#
+# Fields are read positionally, in the order declared by the row type (like `rowType._make()`). If `needed` is given, only those fields are read; the rows built are then of a subclass of the row type, on which reading any other field raises AttributeError, so a parser which forgets to list a field fails loudly instead of seeing empty values. Parsers should list exactly the fields they use.
+#
+# `converters` optionally transform the raw string of a field, e.g., into a Decimal, date, or enum. If a converter fails, or a row is too short, ValueError is raised, naming the field and quoting the original row.
+class RowSchema(Generic[T]):
+    def __init__(self,
+                 rowType: Type[T],
+                 needed: Optional[Iterable[str]] = None,
+                 converters: Optional[Dict[str, Converter]] = None):
+        fields: Sequence[str] = getattr(rowType, '_fields')
+        neededFields = set(fields if needed is None else needed)
+        converters = converters or {}
+
+        unknown = (neededFields | set(converters)) - set(fields)
+        if unknown:
+            raise ValueError('Unknown fields for {}: {}'.format(
+                rowType.__name__, sorted(unknown)))
+
+        unread = set(converters) - neededFields
+        if unread:
+            raise ValueError(
+                'Converters given for unread fields of {}: {}'.format(
+                    rowType.__name__, sorted(unread)))
+
+        self._rowType = rowType
+        self._builtType = rowType if neededFields == set(
+            fields) else _projectedType(rowType, neededFields)
+        self._fields = fields
+        self._needed = neededFields
+        self._converters = converters
+        self._fromList: Optional[Callable[[List[str]], T]] = None
+        self._fromMapping: Optional[Callable[[Mapping[str, str]], T]] = None
+        super().__init__()
+
+    @property
+    def rowType(self) -> Type[T]:
+        return self._rowType
+
+    # The fields which are actually read from each row.
+    @property
+    def needed(self) -> List[str]:
+        return [f for f in self._fields if f in self._needed]
+
+    # The number of columns a row must have.
+    @property
+    def width(self) -> int:
+        return max(
+            (i + 1 for (i, f) in enumerate(self._fields) if f in self._needed),
+            default=0)
+
+    # The index of the column holding `field`, for inspecting raw rows (e.g., to skip a row before converting it).
+    def column(self, field: str) -> int:
+        return self._fields.index(field)
+
+    # Explains why building a row failed, by retrying each field on its own. Only called once something has gone wrong, so this needn't be fast.
+    def _failure(self, row: Any, err: Exception) -> ValueError:
+        name = self._rowType.__name__
+        if isinstance(err, IndexError):
+            return ValueError('Expected {} columns for {}, got: {}'.format(
+                self.width, name, row))
+
+        for (i, field) in enumerate(self._fields):
+            converter = self._converters.get(field)
+            if converter is None:
+                continue
+
+            value = row.get(field, '') if isinstance(row, Mapping) else row[i]
+            try:
+                converter(value)
+            except (ValueError, ArithmeticError) as fieldErr:
+                return ValueError(
+                    'Could not read {} of {} from {!r} ({}), in row: {}'.
+                    format(field, name, value, fieldErr, row))
+
+        return ValueError('Could not read {} ({}), from row: {}'.format(
+            name, err, row))
+
+    # Generates the source of a function building the row type from `argument`, where `source` gives the expression reading each field.
+    def _compile(self, source: Callable[[int, str], str],
+                 argument: str) -> Callable[[Any], T]:
+        namespace: Dict[str, Any] = {
+            'new': tuple.__new__,
+            'rowType': self._builtType,
+            'failure': self._failure,
+        }
+
+        values = []
+        for (i, field) in enumerate(self._fields):
+            if field not in self._needed:
+                values.append('None')
+                continue
+
+            value = source(i, field)
+            converter = self._converters.get(field)
+            if converter:
+                name = 'convert_{}'.format(i)
+                namespace[name] = converter
+                value = '{}({})'.format(name, value)
+
+            values.append(value)
+
+        lines = [
+            'def fromRow({}):'.format(argument),
+            '    try:',
+            '        return new(rowType, ({},))'.format(', '.join(values)),
+            '    except (IndexError, ValueError, ArithmeticError) as err:',
+            '        raise failure({}, err) from None'.format(argument),
+        ]
+
+        exec('\n'.join(lines), namespace)
+        fromRow: Callable[[Any], T] = namespace['fromRow']
+        return fromRow
+
+    # Returns a function converting a list of column values into the row type. Extra trailing columns are ignored.
+    def compile(self) -> Callable[[List[str]], T]:
+        if self._fromList is None:
+            self._fromList = self._compile(lambda i, f: 'r[{}]'.format(i),
+                                           argument='r')
+
+        return self._fromList
+
+    # Returns a function converting a mapping of field names to values (e.g., XML attributes) into the row type. Missing fields are treated as empty.
+    def compileMapping(self) -> Callable[[Mapping[str, str]], T]:
+        if self._fromMapping is None:
+            self._fromMapping = self._compile(lambda i, f: 'r.get({!r}, "")'.
+                                              format(f),
+                                              argument='r')
+
+        return self._fromMapping
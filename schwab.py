@@ -1,25 +1,40 @@
 from datetime import date, datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 from model import Cash, Currency, Instrument, Stock, Bond, Option, OptionType, Position, Trade, TradeFlags
-from parsetools import lenientParse
+from numericparsing import parseAmount
+from parsetools import ParseErrors, lenientParse
 from pathlib import Path
-from typing import Dict, List, NamedTuple, Optional
+from rowschema import RowSchema, defaultIfEmpty
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import csv
 import re
 
 
+# Schwab's CSVs format every amount this way, so this repeats the fast path of parseAmount, rather than paying for another call per cell.
 def schwabDecimal(s: str) -> Decimal:
-    if s == 'N/A':
-        return Decimal(0)
-    else:
-        return Decimal(s.replace(',', '').replace('$', ''))
+    try:
+        value = Decimal(s.replace(',', '').replace('$', ''))
+        if value.is_finite():
+            return value
+    except InvalidOperation:
+        pass
+
+    return parseAmount(s, notAvailable=Decimal(0))
+
+
+# Dates may be followed by the date a transaction was effective, e.g., "02/04/2018 as of 02/01/2018".
+def schwabDate(s: str) -> datetime:
+    return datetime.strptime(s[0:10], '%m/%d/%Y')
+
+
+optionSymbolPattern = re.compile(
+    r'^(?P<underlying>[A-Z0-9/]+) (?P<month>\d{2})/(?P<day>\d{2})/(?P<year>\d{4}) (?P<strike>[0-9\.]+) (?P<putCall>P|C)$'
+)
 
 
 def parseOption(symbol: str) -> Option:
-    match = re.match(
-        r'^(?P<underlying>[A-Z0-9/]+) (?P<month>\d{2})/(?P<day>\d{2})/(?P<year>\d{4}) (?P<strike>[0-9\.]+) (?P<putCall>P|C)$',
-        symbol)
+    match = optionSymbolPattern.match(symbol)
     if not match:
         raise ValueError(
             'Could not parse Schwab options symbol: {}'.format(symbol))
@@ -29,25 +44,26 @@ def parseOption(symbol: str) -> Option:
     else:
         optionType = OptionType.CALL
 
-    return Option(underlying=match['underlying'],
-                  currency=Currency.USD,
-                  expiration=date(int(match['year']), int(match['month']),
-                                  int(match['day'])),
-                  optionType=optionType,
-                  strike=Decimal(match['strike']))
+    return Option.interned(underlying=match['underlying'],
+                           currency=Currency.USD,
+                           expiration=date(int(match['year']),
+                                           int(match['month']),
+                                           int(match['day'])),
+                           optionType=optionType,
+                           strike=Decimal(match['strike']))
 
 
 class SchwabPosition(NamedTuple):
     symbol: str
     description: str
-    quantity: str
+    quantity: Decimal
     price: str
     priceChange: str
     priceChangePct: str
     marketValue: str
     dayChange: str
     dayChangePct: str
-    costBasis: str
+    costBasis: Decimal
     gainLoss: str
     gainLossPct: str
     reinvestDividends: str
@@ -62,80 +78,115 @@ class SchwabPosition(NamedTuple):
     securityType: str
 
 
-def parseSchwabPosition(p: SchwabPosition) -> Optional[Position]:
-    if re.match(r'Futures |Cash & Money Market|Account Total', p.symbol):
-        return None
+# The fields read by parseSchwabPosition().
+positionSchema = RowSchema(
+    SchwabPosition,
+    needed=['symbol', 'quantity', 'costBasis', 'securityType'],
+    converters={
+        'quantity': schwabDecimal,
+        'costBasis': schwabDecimal,
+    })
+
+ignoredPositionPattern = re.compile(
+    r'Futures |Cash & Money Market|Account Total')
+stockSecurityTypePattern = re.compile(r'Equity|ETFs')
+optionSecurityTypePattern = re.compile(r'Option')
+bondSecurityTypePattern = re.compile(r'Fixed Income')
 
+
+def parseSchwabPosition(p: SchwabPosition) -> Position:
     instrument: Instrument
-    if re.match(r'Equity|ETFs', p.securityType):
-        instrument = Stock(p.symbol, currency=Currency.USD)
-    elif re.match(r'Option', p.securityType):
+    if stockSecurityTypePattern.match(p.securityType):
+        instrument = Stock.interned(p.symbol, currency=Currency.USD)
+    elif optionSecurityTypePattern.match(p.securityType):
         instrument = parseOption(p.symbol)
-    elif re.match(r'Fixed Income', p.securityType):
-        instrument = Bond(p.symbol, currency=Currency.USD)
+    elif bondSecurityTypePattern.match(p.securityType):
+        instrument = Bond.interned(p.symbol, currency=Currency.USD)
     else:
         raise ValueError('Unrecognized security type: {}'.format(
             p.securityType))
 
     return Position(instrument=instrument,
-                    quantity=schwabDecimal(p.quantity),
+                    quantity=p.quantity,
                     costBasis=Cash(currency=Currency.USD,
-                                   quantity=schwabDecimal(p.costBasis)))
+                                   quantity=p.costBasis))
 
 
-def parsePositions(path: Path, lenient: bool = False) -> List[Position]:
+def parsePositions(path: Path,
+                   lenient: bool = False,
+                   errors: Optional[ParseErrors] = None) -> List[Position]:
     with open(path, newline='') as csvfile:
         reader = csv.reader(csvfile)
 
-        # Filter out header rows, and invalid data
-        rows = map(lambda r: r[0:-1],
-                   filter(lambda r: len(r) > 1 and r[0] != 'Symbol', reader))
+        # Filter out header rows, summary rows (whose values aren't numbers), and invalid data
+        symbol = positionSchema.column('symbol')
+        rows = filter(
+            lambda r: len(r) > 1 and r[symbol] != 'Symbol' and
+            not ignoredPositionPattern.match(r[symbol]), reader)
+        fromRow = positionSchema.compile()
 
         return list(
-            filter(
-                None,
-                lenientParse((SchwabPosition._make(r) for r in rows),
-                             transform=parseSchwabPosition,
-                             lenient=lenient)))
+            lenientParse(rows,
+                         transform=lambda r: parseSchwabPosition(fromRow(r)),
+                         lenient=lenient,
+                         errors=errors,
+                         parser='schwab.parseSchwabPosition'))
 
 
 class SchwabTransaction(NamedTuple):
-    date: str
+    date: datetime
     action: str
     symbol: str
     description: str
-    quantity: str
+    quantity: Optional[Decimal]
     price: str
-    fees: str
-    amount: str
+    fees: Decimal
+    amount: Optional[Decimal]
+
+
+# The fields read by parseSchwabTransaction() and parseTransactions().
+transactionSchema = RowSchema(
+    SchwabTransaction,
+    needed=['date', 'action', 'symbol', 'quantity', 'fees', 'amount'],
+    converters={
+        'date': schwabDate,
+        'quantity': defaultIfEmpty(parseAmount, None),
+        'fees': defaultIfEmpty(schwabDecimal, Decimal(0)),
+        'amount': defaultIfEmpty(schwabDecimal, None),
+    })
+
+optionSuffixPattern = re.compile(r'\s(C|P)$')
+sellActionPattern = re.compile(r'^Sell')
 
 
 def guessInstrumentFromSymbol(symbol: str) -> Instrument:
-    if re.search(r'\s(C|P)$', symbol):
+    if optionSuffixPattern.search(symbol):
         return parseOption(symbol)
     elif Bond.validBondSymbol(symbol):
-        return Bond(symbol, currency=Currency.USD)
+        return Bond.interned(symbol, currency=Currency.USD)
     else:
-        return Stock(symbol, currency=Currency.USD)
+        return Stock.interned(symbol, currency=Currency.USD)
 
 
 def forceParseSchwabTransaction(t: SchwabTransaction,
                                 flags: TradeFlags) -> Trade:
-    quantity = Decimal(t.quantity)
-    if re.match(r'^Sell', t.action):
+    if t.quantity is None:
+        raise ValueError('Missing quantity for {} transaction'.format(
+            t.action))
+
+    quantity = t.quantity
+    if sellActionPattern.match(t.action):
         quantity = -quantity
 
-    fees = Decimal(0)
-    if t.fees:
-        fees = schwabDecimal(t.fees)
+    fees = t.fees
 
     amount = Decimal(0)
-    if t.amount:
+    if t.amount is not None:
         # Schwab automatically deducts the fees, but we need to add them back in for consistency with other brokers
         # (where the denominating currency of these two things may differ)
-        amount = schwabDecimal(t.amount) + fees
+        amount = t.amount + fees
 
-    return Trade(date=datetime.strptime(t.date[0:10], '%m/%d/%Y'),
+    return Trade(date=t.date,
                  instrument=guessInstrumentFromSymbol(t.symbol),
                  quantity=quantity,
                  amount=Cash(currency=Currency.USD, quantity=amount),
@@ -143,25 +194,27 @@ def forceParseSchwabTransaction(t: SchwabTransaction,
                  flags=flags)
 
 
-def parseSchwabTransaction(t: SchwabTransaction) -> Optional[Trade]:
-    ignoredActions = [
-        'Wire Funds',
-        'Wire Funds Received',
-        'MoneyLink Transfer',
-        'MoneyLink Deposit',
-        'Cash Dividend',
-        'Reinvest Dividend',
-        'Long Term Cap Gain Reinvest',
-        'ATM Withdrawal',
-        'Schwab ATM Rebate',
-        'Credit Interest',
-        'Margin Interest',
-        'Service Fee',
-        'Journal',
-        'Misc Cash Entry',
-        'Security Transfer',
-    ]
+# Actions which don't represent trades.
+ignoredActions = frozenset([
+    'Wire Funds',
+    'Wire Funds Received',
+    'MoneyLink Transfer',
+    'MoneyLink Deposit',
+    'Cash Dividend',
+    'Reinvest Dividend',
+    'Long Term Cap Gain Reinvest',
+    'ATM Withdrawal',
+    'Schwab ATM Rebate',
+    'Credit Interest',
+    'Margin Interest',
+    'Service Fee',
+    'Journal',
+    'Misc Cash Entry',
+    'Security Transfer',
+])
 
+
+def parseSchwabTransaction(t: SchwabTransaction) -> Optional[Trade]:
     if t.action in ignoredActions:
         return None
 
@@ -184,27 +237,33 @@ def parseSchwabTransaction(t: SchwabTransaction) -> Optional[Trade]:
 
 
 # Transactions will be ordered from oldest to newest
-def parseTransactions(path: Path, lenient: bool = False) -> List[Trade]:
+def parseTransactions(path: Path,
+                      lenient: bool = False,
+                      errors: Optional[ParseErrors] = None) -> List[Trade]:
     with open(path, newline='') as csvfile:
         reader = csv.reader(csvfile)
 
         # Filter out header row, and invalid data
-        rows = [
-            SchwabTransaction._make(r[0:-1]) for r in reader
-            if len(r) > 1 and r[0] != 'Date'
-        ]
+        rows = [r for r in reader if len(r) > 1 and r[0] != 'Date']
+        fromRow = transactionSchema.compile()
 
+        # Ignored actions are skipped before their values are converted, as they needn't hold trade amounts.
+        action = transactionSchema.column('action')
+        transfers = (fromRow(r) for r in rows
+                     if r[action] == 'Security Transfer')
         inboundTransfers = [
-            forceParseSchwabTransaction(r, flags=TradeFlags.OPEN) for r in rows
-            if r.action == 'Security Transfer' and r.quantity
-            and Decimal(r.quantity) > 0
+            forceParseSchwabTransaction(t, flags=TradeFlags.OPEN)
+            for t in transfers if t.quantity is not None and t.quantity > 0
         ]
 
         trades = filter(
             None,
-            lenientParse(rows,
-                         transform=parseSchwabTransaction,
-                         lenient=lenient))
+            lenientParse(
+                (r for r in rows if r[action] not in ignoredActions),
+                transform=lambda r: parseSchwabTransaction(fromRow(r)),
+                lenient=lenient,
+                errors=errors,
+                parser='schwab.parseSchwabTransaction'))
         return fixUpShortSales(list(trades), inboundTransfers)
 
 
@@ -212,6 +271,14 @@ def fixUpShortSales(trades: List[Trade],
                     inboundTransfers: List[Trade]) -> List[Trade]:
     positionsBySymbol: Dict[str, Decimal] = {}
 
+    # A short sale only needs to know whether some transfer of the same symbol and quantity happened on or after its date, so keep just the latest date of each.
+    latestTransfers: Dict[Tuple[str, Decimal], datetime] = {}
+    for tx in inboundTransfers:
+        key = (tx.instrument.symbol, tx.quantity)
+        latest = latestTransfers.get(key)
+        if latest is None or tx.date > latest:
+            latestTransfers[key] = tx.date
+
     def f(t: Trade) -> Trade:
         symbol = t.instrument.symbol
 
@@ -222,18 +289,16 @@ def fixUpShortSales(trades: List[Trade],
         # TODO: How should this work if the quantity is greater than the position?
         if pos < 0 and t.quantity > 0 and t.quantity <= abs(
                 pos) and t.flags & TradeFlags.OPEN:
-            return t._replace(flags=(t.flags ^ TradeFlags.OPEN)
-                              | TradeFlags.CLOSE)
+            return t.replacingFlags((t.flags ^ TradeFlags.OPEN)
+                                    | TradeFlags.CLOSE)
         # Schwab records restricted stock sales as short selling followed by a security transfer.
         # If we find a short sale, see if there's a later transfer, and if so, record as closing a position.
         elif t.quantity < 0 and t.flags & TradeFlags.OPEN:
-            txs = (tx for tx in reversed(inboundTransfers)
-                   if tx.date >= t.date and tx.instrument.symbol ==
-                   t.instrument.symbol and tx.quantity == abs(t.quantity))
+            latest = latestTransfers.get((symbol, -t.quantity))
 
-            if next(txs, None):
-                return t._replace(flags=(t.flags ^ TradeFlags.OPEN)
-                                  | TradeFlags.CLOSE)
+            if latest is not None and latest >= t.date:
+                return t.replacingFlags((t.flags ^ TradeFlags.OPEN)
+                                        | TradeFlags.CLOSE)
             else:
                 return t
         else:
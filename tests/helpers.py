@@ -2,8 +2,13 @@ from datetime import date, datetime
 from decimal import Decimal
 from hypothesis.strategies import builds, dates, datetimes, decimals, from_regex, from_type, just, lists, integers, none, one_of, register_type_strategy, sampled_from, text, SearchStrategy
 from model import Cash, Currency, Instrument, Stock, Bond, Option, OptionType, FutureOption, Future, Forex, Position, Trade, TradeFlags, Quote
+from pathlib import Path
 from typing import List, Optional, TypeVar
 
+import os
+import subprocess
+import sys
+
 T = TypeVar('T')
 
 
@@ -230,9 +235,60 @@ register_type_strategy(
 register_type_strategy(Quote, uniformCurrencyQuotes())
 
 
+# Lists of positions across a few instruments, so that many of them share an instrument.
+def positionsInFewInstruments(maxInstruments: int = 3
+                              ) -> SearchStrategy[List[Position]]:
+    return lists(from_type(Instrument), min_size=1,
+                 max_size=maxInstruments).flatmap(lambda instruments: lists(
+                     sampled_from(instruments).flatmap(lambda i: positions(
+                         instrument=just(i),
+                         costBasis=cash(currency=just(i.currency))))))
+
+
 def cashUSD(amount: Decimal) -> Cash:
     return Cash(currency=Currency.USD, quantity=amount)
 
 
 def splitAndStripCSVString(s: str) -> List[str]:
     return list(elem.strip() for elem in s.split(","))
+
+
+# One of each kind of instrument, built the same way in any process.
+def sampleInstruments() -> List[Instrument]:
+    return [
+        Stock('AAPL', Currency.USD),
+        Bond('912828U40', Currency.USD),
+        Option(underlying='SPY',
+               currency=Currency.USD,
+               optionType=OptionType.PUT,
+               expiration=date(2019, 1, 25),
+               strike=Decimal('250.5')),
+        FutureOption(symbol='GBUJ9 C1300',
+                     underlying='GBM9',
+                     currency=Currency.USD,
+                     optionType=OptionType.CALL,
+                     expiration=date(2019, 4, 5),
+                     strike=Decimal('1.3'),
+                     multiplier=Decimal(62500)),
+        Future(symbol='ESM9',
+               currency=Currency.USD,
+               multiplier=Decimal(50),
+               expiration=date(2019, 6, 21)),
+        Forex(baseCurrency=Currency.GBP, quoteCurrency=Currency.USD),
+    ]
+
+
+# Runs Python source in a fresh interpreter, with the given PYTHONHASHSEED (so string hashes differ from this process), and returns what it wrote to stdout. The repository and this directory are importable.
+def runWithHashSeed(source: str, hashSeed: int) -> bytes:
+    testsDirectory = Path(__file__).parent
+    env = dict(os.environ,
+               PYTHONHASHSEED=str(hashSeed),
+               PYTHONPATH=os.pathsep.join(
+                   [str(testsDirectory.parent),
+                    str(testsDirectory)]))
+
+    return subprocess.run([sys.executable, '-c', source],
+                          cwd=str(testsDirectory.parent),
+                          env=env,
+                          stdout=subprocess.PIPE,
+                          check=True).stdout
@@ -1,12 +1,16 @@
-from analysis import realizedBasisForSymbol, liveValuesForPositions
-from datetime import datetime, date
+from analysis import realizedBasisForSymbol, realizedBasisBySymbol, liveValuesForPositions, liveValuesForPositionsAsync, CachingDataProvider, LiveValueTracker
+from datetime import datetime, date, timedelta
 from decimal import Decimal
 from hypothesis import given, reproduce_failure, seed
 from hypothesis.strategies import builds, composite, dates, datetimes, decimals, from_type, iterables, just, lists, one_of, text, tuples, SearchStrategy
 from model import Cash, Currency, Instrument, Stock, Option, OptionType, Quote, Trade, TradeFlags, LiveDataProvider, Position
+from pathlib import Path
 from typing import Any, Dict, Iterable, List, Tuple, no_type_check
+from unittest import mock
 
+import asyncio
 import helpers
+import ibkr
 import unittest
 
 
@@ -48,12 +52,31 @@ def positionAndQuote(
 class StubDataProvider(LiveDataProvider):
     def __init__(self, quotes: Dict[Instrument, Quote]):
         self._quotes = quotes
+        self.fetchCount = 0
         super().__init__()
 
     def fetchQuote(self, instrument: Instrument) -> Quote:
+        self.fetchCount += 1
         return self._quotes[instrument]
 
 
+class ConcurrencyTrackingDataProvider(StubDataProvider):
+    def __init__(self, quotes: Dict[Instrument, Quote]):
+        self.inFlight = 0
+        self.maxInFlight = 0
+        super().__init__(quotes)
+
+    async def fetchQuoteAsync(self, instrument: Instrument) -> Quote:
+        self.inFlight += 1
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+
+        try:
+            await asyncio.sleep(0)
+            return self.fetchQuote(instrument)
+        finally:
+            self.inFlight -= 1
+
+
 class TestAnalysis(unittest.TestCase):
     def test_realizedBasis(self) -> None:
         trades = [
@@ -110,6 +133,71 @@ class TestAnalysis(unittest.TestCase):
         if realizedBasis:
             self.assertEqual(realizedBasis.quantity, -summed)
 
+    def test_realizedBasisBySymbolOnlyForGivenSymbols(self) -> None:
+        # Includes a forex trade whose fees are in another currency than its amount, so its basis can't be summed.
+        trades = ibkr.parseTrades(Path('tests/ibkr_trades.xml'))
+        symbols = set(t.instrument.symbol
+                      for t in trades) - {'GBPAUD'} | {'NONE'}
+
+        bases = realizedBasisBySymbol(trades, symbols=symbols)
+        self.assertNotIn('GBPAUD', bases)
+        for symbol in symbols:
+            self.assertEqual(bases.get(symbol),
+                             realizedBasisForSymbol(symbol, trades))
+
+    def test_realizedBasisBySymbol(self) -> None:
+        trades = [
+            Trade(date=datetime.now(),
+                  instrument=Stock('SPY', Currency.USD),
+                  quantity=Decimal('5'),
+                  amount=helpers.cashUSD(Decimal('-999')),
+                  fees=helpers.cashUSD(Decimal('1')),
+                  flags=TradeFlags.OPEN),
+            Trade(date=datetime.now(),
+                  instrument=Option(underlying='SPY',
+                                    currency=Currency.USD,
+                                    optionType=OptionType.CALL,
+                                    expiration=date(2019, 1, 25),
+                                    strike=Decimal('123')),
+                  quantity=Decimal('1'),
+                  amount=helpers.cashUSD(Decimal('101')),
+                  fees=helpers.cashUSD(Decimal('1')),
+                  flags=TradeFlags.OPEN),
+            Trade(date=datetime.now(),
+                  instrument=Stock('QQQ', Currency.USD),
+                  quantity=Decimal('1'),
+                  amount=helpers.cashUSD(Decimal('-150')),
+                  fees=helpers.cashUSD(Decimal('0')),
+                  flags=TradeFlags.OPEN),
+        ]
+
+        bases = realizedBasisBySymbol(trades)
+        self.assertEqual(
+            bases, {
+                'SPY': helpers.cashUSD(Decimal('900')),
+                'SPY   190125C00123000': helpers.cashUSD(Decimal('-100')),
+                'QQQ': helpers.cashUSD(Decimal('150')),
+            })
+
+    # pylint: disable=no-value-for-parameter
+    @given(
+        lists(helpers.cashAmounts(),
+              max_size=20).flatmap(lambda ds: tradesForAmounts(amounts=ds,
+                                                               symbol='SPY')),
+        lists(helpers.cashAmounts(),
+              max_size=20).flatmap(lambda ds: tradesForAmounts(amounts=ds,
+                                                               symbol='QQQ')))
+    def test_realizedBasisBySymbolMatchesRealizedBasisForSymbol(
+            self, spyTrades: Iterable[Trade],
+            qqqTrades: Iterable[Trade]) -> None:
+        trades = list(spyTrades) + list(qqqTrades)
+        bases = realizedBasisBySymbol(trades)
+
+        symbols = set(t.instrument.symbol for t in trades) | {'SPY', 'QQQ'}
+        for symbol in symbols:
+            self.assertEqual(bases.get(symbol),
+                             realizedBasisForSymbol(symbol, trades))
+
     @given(lists(positionAndQuote(), min_size=1, max_size=3))
     def test_liveValuesForPositions(self,
                                     i: List[Tuple[Position, Quote]]) -> None:
@@ -142,3 +230,201 @@ class TestAnalysis(unittest.TestCase):
             highest = max(valuesPerPrice, default=None)
             if highest is not None:
                 self.assertLessEqual(value, highest)
+
+    @given(lists(positionAndQuote(), min_size=1, max_size=3))
+    def test_liveValuesForPositionsAsyncMatchesSync(
+            self, i: List[Tuple[Position, Quote]]) -> None:
+        quotesByInstrument = {p.instrument: q for (p, q) in i}
+        dataProvider = StubDataProvider(quotesByInstrument)
+        positions = [p for (p, _) in i]
+
+        values = asyncio.get_event_loop().run_until_complete(
+            liveValuesForPositionsAsync(positions, dataProvider))
+        self.assertEqual(values,
+                         liveValuesForPositions(positions, dataProvider))
+
+    def test_liveValuesForPositionsProgressTracksFetch(self) -> None:
+        positions = [
+            Position(instrument=Stock(symbol, Currency.USD),
+                     quantity=Decimal('10'),
+                     costBasis=helpers.cashUSD(Decimal('100')))
+            for symbol in ['SPY', 'QQQ', 'SPY']
+        ]
+
+        progressBar = mock.Mock()
+        dataProvider = StubDataProvider({
+            p.instrument: Quote(bid=helpers.cashUSD(Decimal('5')))
+            for p in positions
+        })
+
+        callsDuringFetch: List[Any] = []
+
+        def fetchQuotes(instruments: Iterable[Instrument]
+                        ) -> Dict[Instrument, Quote]:
+            callsDuringFetch.extend(progressBar.method_calls)
+            return LiveDataProvider.fetchQuotes(dataProvider, instruments)
+
+        with mock.patch.object(dataProvider,
+                               'fetchQuotes',
+                               side_effect=fetchQuotes):
+            liveValuesForPositions(positions,
+                                   dataProvider,
+                                   progressBar=progressBar)
+
+        self.assertEqual(callsDuringFetch, [mock.call.start()])
+        self.assertEqual(progressBar.max, 2)
+        self.assertEqual(progressBar.method_calls, [
+            mock.call.start(),
+            mock.call.next(2),
+            mock.call.finish(),
+        ])
+
+    def test_liveValuesForPositionsAsyncLimitsConcurrency(self) -> None:
+        positions = [
+            Position(instrument=Stock(symbol, Currency.USD),
+                     quantity=Decimal('10'),
+                     costBasis=helpers.cashUSD(Decimal('100')))
+            for symbol in ['SPY', 'QQQ', 'VTI', 'VT', 'VWO', 'BND']
+        ]
+
+        dataProvider = ConcurrencyTrackingDataProvider({
+            p.instrument: Quote(bid=helpers.cashUSD(Decimal('5')))
+            for p in positions
+        })
+
+        values = asyncio.get_event_loop().run_until_complete(
+            liveValuesForPositionsAsync(positions,
+                                        dataProvider,
+                                        maxConcurrentRequests=2))
+
+        self.assertEqual(dataProvider.maxInFlight, 2)
+        self.assertEqual(dataProvider.fetchCount, len(positions))
+        for p in positions:
+            self.assertEqual(values[p], helpers.cashUSD(Decimal('50')))
+
+
+class TestLiveValueTracker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.spy = Position(instrument=Stock('SPY', Currency.USD),
+                            quantity=Decimal('10'),
+                            costBasis=helpers.cashUSD(Decimal('2500')))
+        self.qqq = Position(instrument=Stock('QQQ', Currency.USD),
+                            quantity=Decimal('-5'),
+                            costBasis=helpers.cashUSD(Decimal('-800')))
+        self.gaw = Position(instrument=Stock('GAW', Currency.GBP),
+                            quantity=Decimal('100'),
+                            costBasis=Cash(currency=Currency.GBP,
+                                           quantity=Decimal('3000')))
+        self.tracker = LiveValueTracker([self.spy, self.qqq, self.gaw])
+
+    def test_updateRevaluesOnlyAffectedPosition(self) -> None:
+        self.tracker.update(
+            self.spy.instrument,
+            Quote(bid=helpers.cashUSD(Decimal('280')),
+                  ask=helpers.cashUSD(Decimal('281'))))
+        self.assertEqual(self.tracker.values,
+                         {self.spy: helpers.cashUSD(Decimal('2800'))})
+
+        self.tracker.update(
+            self.qqq.instrument,
+            Quote(bid=helpers.cashUSD(Decimal('170')),
+                  ask=helpers.cashUSD(Decimal('171'))))
+        self.assertEqual(self.tracker.values[self.spy],
+                         helpers.cashUSD(Decimal('2800')))
+        self.assertEqual(self.tracker.values[self.qqq],
+                         helpers.cashUSD(Decimal('-855')))
+        self.assertEqual(self.tracker.totals,
+                         {Currency.USD: helpers.cashUSD(Decimal('1945'))})
+
+    def test_totalsTrackLatestQuotes(self) -> None:
+        self.tracker.update(self.spy.instrument,
+                            Quote(bid=helpers.cashUSD(Decimal('280'))))
+        self.tracker.update(self.spy.instrument,
+                            Quote(bid=helpers.cashUSD(Decimal('270'))))
+        self.tracker.update(
+            self.gaw.instrument,
+            Quote(last=Cash(currency=Currency.GBP, quantity=Decimal('31'))))
+
+        self.assertEqual(
+            self.tracker.totals, {
+                Currency.USD:
+                helpers.cashUSD(Decimal('2700')),
+                Currency.GBP:
+                Cash(currency=Currency.GBP, quantity=Decimal('3100')),
+            })
+
+    def test_emptyQuoteRemovesValue(self) -> None:
+        self.tracker.update(self.spy.instrument,
+                            Quote(bid=helpers.cashUSD(Decimal('280'))))
+        self.tracker.update(self.spy.instrument, Quote())
+
+        self.assertEqual(self.tracker.values, {})
+        self.assertEqual(self.tracker.totals,
+                         {Currency.USD: helpers.cashUSD(Decimal('0'))})
+
+
+class TestCachingDataProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.spy = Stock('SPY', Currency.USD)
+        self.qqq = Stock('QQQ', Currency.USD)
+        self.quotes = {
+            self.spy: Quote(bid=helpers.cashUSD(Decimal('280'))),
+            self.qqq: Quote(bid=helpers.cashUSD(Decimal('170'))),
+        }
+        self.inner = StubDataProvider(self.quotes)
+
+    def clock(self) -> float:
+        return self.now
+
+    def test_cachesWithinTTL(self) -> None:
+        provider = CachingDataProvider(self.inner,
+                                       ttl=timedelta(seconds=60),
+                                       clock=self.clock)
+
+        self.assertEqual(provider.fetchQuote(self.spy), self.quotes[self.spy])
+        self.now = 59
+        self.assertEqual(provider.fetchQuote(self.spy), self.quotes[self.spy])
+
+        self.assertEqual(self.inner.fetchCount, 1)
+        self.assertEqual(provider.hits, 1)
+        self.assertEqual(provider.misses, 1)
+
+    def test_expiresAfterTTL(self) -> None:
+        provider = CachingDataProvider(self.inner,
+                                       ttl=timedelta(seconds=60),
+                                       clock=self.clock)
+
+        provider.fetchQuote(self.spy)
+        self.now = 60
+        provider.fetchQuote(self.spy)
+
+        self.assertEqual(self.inner.fetchCount, 2)
+        self.assertEqual(provider.hits, 0)
+        self.assertEqual(provider.misses, 2)
+
+    def test_evictsLeastRecentlyUsed(self) -> None:
+        provider = CachingDataProvider(self.inner,
+                                       ttl=timedelta(seconds=60),
+                                       maxEntries=1,
+                                       clock=self.clock)
+
+        provider.fetchQuote(self.spy)
+        provider.fetchQuote(self.qqq)
+        provider.fetchQuote(self.spy)
+
+        self.assertEqual(self.inner.fetchCount, 3)
+        self.assertEqual(provider.hits, 0)
+
+    def test_fetchQuotesOnlyFetchesMisses(self) -> None:
+        provider = CachingDataProvider(self.inner,
+                                       ttl=timedelta(seconds=60),
+                                       clock=self.clock)
+
+        provider.fetchQuote(self.spy)
+        quotes = provider.fetchQuotes([self.spy, self.qqq])
+
+        self.assertEqual(quotes, self.quotes)
+        self.assertEqual(self.inner.fetchCount, 2)
+        self.assertEqual(provider.hits, 1)
+        self.assertEqual(provider.misses, 2)
@@ -0,0 +1,107 @@
+from argparse import Namespace
+from bankroll import combinePositions, parseFile, watchPositions
+from contextlib import redirect_stdout
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from hypothesis import assume, given
+from model import Cash, Currency, Instrument, Position, Quote, Stock
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List
+from unittest import mock
+
+import asyncio
+import fidelity
+import helpers
+import io
+import multiprocessing
+import os
+import unittest
+
+
+# The straightforward implementation of combinePositions(), for comparison.
+#
+# Instruments which are unequal can still tie when sorted (e.g., a future and a future option with the same symbol), so group by equality rather than with groupby() over sorted positions.
+def combinePositionsPairwise(positions: List[Position]) -> List[Position]:
+    groups: Dict[Instrument, List[Position]] = {}
+    for p in positions:
+        groups.setdefault(p.instrument, []).append(p)
+
+    return [
+        reduce(lambda a, b: a.combine(b), groups[i])
+        for i in sorted(groups.keys())
+    ]
+
+
+class TestCombinePositions(unittest.TestCase):
+    @given(helpers.positionsInFewInstruments())
+    def test_matchesPairwiseCombine(self, positions: List[Position]) -> None:
+        try:
+            expected = combinePositionsPairwise(positions)
+        except ValueError:
+            # An intermediate combination had zero quantity but some cost basis.
+            assume(False)
+            return
+
+        combined = combinePositions(positions)
+        self.assertEqual(combined, expected)
+        self.assertEqual([p.costBasis for p in combined],
+                         [p.costBasis for p in expected])
+
+
+class TestParseFile(unittest.TestCase):
+    # Spawned workers (the default on macOS) return results pickled from a process with different string hashes.
+    def test_spawnedWorkerResultsMatchFreshlyParsed(self) -> None:
+        path = Path('tests/fidelity_positions.csv')
+        hashSeed = '1' if os.environ.get('PYTHONHASHSEED') != '1' else '2'
+
+        with mock.patch.dict(os.environ, PYTHONHASHSEED=hashSeed):
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=multiprocessing.get_context(
+                                         'spawn')) as executor:
+                (loaded, errors) = executor.submit(parseFile,
+                                                   fidelity.parsePositions,
+                                                   path, False, None).result()
+
+        self.assertEqual(len(errors), 0)
+
+        fresh = fidelity.parsePositions(path)
+        freshByInstrument = {p.instrument: p for p in fresh}
+        for p in loaded:
+            self.assertEqual(freshByInstrument[p.instrument], p)
+
+        self.assertEqual(combinePositions(loaded + fresh),
+                         combinePositions(fresh + fresh))
+
+
+class FakeStreamingProvider:
+    def __init__(self) -> None:
+        self.subscribed: List[Instrument] = []
+
+    async def subscribeQuotes(self, instruments: Iterable[Instrument],
+                              onQuote: Callable[[Instrument, Quote], None],
+                              **kwargs: Any) -> None:
+        self.subscribed = list(instruments)
+
+    async def unsubscribeQuotes(self) -> None:
+        self.subscribed = []
+
+
+class TestWatchPositions(unittest.TestCase):
+    def test_cancellingUnsubscribes(self) -> None:
+        args = Namespace(refresh_interval=60,
+                         live_value=True,
+                         watch=True,
+                         realized_basis=False)
+        provider = FakeStreamingProvider()
+        loop = asyncio.get_event_loop()
+
+        with redirect_stdout(io.StringIO()):
+            watch = loop.create_task(watchPositions(args, provider,
+                                                    {}))  # type: ignore
+            loop.run_until_complete(asyncio.sleep(0))
+            watch.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(watch)
+
+        self.assertEqual(provider.subscribed, [])
@@ -1,9 +1,12 @@
 from itertools import groupby
 from pathlib import Path
-from csvsectionslicer import parseSectionsForCSV, CSVSectionCriterion, CSVSectionResult
+from tempfile import TemporaryDirectory
+from typing import List
+from csvsectionslicer import indexSectionsForCSV, parseSectionAtOffsets, parseSectionsForCSV, streamSectionsForCSV, CSVSectionCriterion, CSVSectionOffsets, CSVSectionResult, CSVSectionRow
 
-import unittest
 import helpers
+import json
+import unittest
 
 
 class TestFidelityPositionSections(unittest.TestCase):
@@ -218,3 +221,250 @@ class TestVanguardSections(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestStreamingSections(unittest.TestCase):
+    def test_streamMatchesParse(self) -> None:
+        criteria = [
+            CSVSectionCriterion(startSectionRowMatch=["Stocks"],
+                                endSectionRowMatch=[""],
+                                rowFilter=lambda r: r[0:7]),
+            CSVSectionCriterion(startSectionRowMatch=["Bonds"],
+                                endSectionRowMatch=[""],
+                                rowFilter=lambda r: r[0:7]),
+            CSVSectionCriterion(startSectionRowMatch=["Options"],
+                                endSectionRowMatch=["", ""],
+                                rowFilter=lambda r: r[1:7]),
+        ]
+
+        with open(Path('tests/fidelity_positions.csv'), newline='') as csvfile:
+            sections = parseSectionsForCSV(csvfile, criteria)
+
+        with open(Path('tests/fidelity_positions.csv'), newline='') as csvfile:
+            rows = list(streamSectionsForCSV(csvfile, criteria))
+
+        self.assertEqual(rows, [
+            CSVSectionRow(criterion=sec.criterion, row=r) for sec in sections
+            for r in sec.rows
+        ])
+
+    def test_streamIsLazy(self) -> None:
+        lines = iter(['Start', 'a,b', 'c,d', '', 'ignored'])
+        criterion = CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                        endSectionRowMatch=[])
+
+        rows = streamSectionsForCSV(lines, [criterion])
+        self.assertEqual(next(rows).row, ['a', 'b'])
+        self.assertEqual(next(lines), 'c,d')
+
+    def test_unterminatedSection(self) -> None:
+        criterion = CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                        endSectionRowMatch=['End'])
+
+        self.assertEqual(
+            parseSectionsForCSV(iter(['Start', 'a,b', 'c,d']), [criterion]),
+            [])
+        self.assertEqual([
+            r.row for r in streamSectionsForCSV(iter(['Start', 'a,b', 'c,d']),
+                                                [criterion])
+        ], [['a', 'b'], ['c', 'd']])
+
+
+class TestUnorderedSections(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lines = [
+            'Options', 'o1', '', 'Stocks', 's1', 's2', '', 'Bonds', 'b1', ''
+        ]
+        self.stocks = CSVSectionCriterion(startSectionRowMatch=['Stocks'],
+                                          endSectionRowMatch=[])
+        self.bonds = CSVSectionCriterion(startSectionRowMatch=['Bonds'],
+                                         endSectionRowMatch=[])
+        self.options = CSVSectionCriterion(startSectionRowMatch=['Options'],
+                                           endSectionRowMatch=[])
+
+    def test_orderedSkipsOutOfOrderSections(self) -> None:
+        sections = parseSectionsForCSV(iter(self.lines),
+                                       [self.stocks, self.bonds, self.options])
+
+        self.assertEqual([s.criterion for s in sections],
+                         [self.stocks, self.bonds])
+
+    def test_unorderedFindsAllSections(self) -> None:
+        sections = parseSectionsForCSV(iter(self.lines),
+                                       [self.stocks, self.bonds, self.options],
+                                       ordered=False)
+
+        self.assertEqual(sections, [
+            CSVSectionResult(criterion=self.options, rows=[['o1']]),
+            CSVSectionResult(criterion=self.stocks, rows=[['s1'], ['s2']]),
+            CSVSectionResult(criterion=self.bonds, rows=[['b1']]),
+        ])
+
+    def test_unorderedMatchesEachCriterionOnce(self) -> None:
+        rows = streamSectionsForCSV(iter(self.lines + ['Stocks', 's3', '']),
+                                    [self.stocks, self.options],
+                                    ordered=False)
+
+        self.assertEqual([r.row for r in rows], [['o1'], ['s1'], ['s2']])
+
+    def test_unorderedSharedLeadingCell(self) -> None:
+        lines = ['Account, Trade Date', 't1', '', 'Account, Name', 'p1', '']
+        positions = CSVSectionCriterion(
+            startSectionRowMatch=['Account', 'Name'], endSectionRowMatch=[])
+        trades = CSVSectionCriterion(
+            startSectionRowMatch=['Account', 'Trade Date'],
+            endSectionRowMatch=[])
+
+        sections = parseSectionsForCSV(iter(lines), [positions, trades],
+                                       ordered=False)
+
+        self.assertEqual(sections, [
+            CSVSectionResult(criterion=trades, rows=[['t1']]),
+            CSVSectionResult(criterion=positions, rows=[['p1']]),
+        ])
+
+
+class TestSectionOffsets(unittest.TestCase):
+    def assertIndexMatchesParse(self,
+                                path: Path,
+                                criteria: List[CSVSectionCriterion],
+                                ordered: bool = True) -> None:
+        with open(path, newline='') as csvfile:
+            sections = parseSectionsForCSV(csvfile, criteria, ordered=ordered)
+
+        offsets = indexSectionsForCSV(path, criteria, ordered=ordered)
+        self.assertEqual([
+            CSVSectionResult(criterion=criteria[o.criterionIndex],
+                             rows=parseSectionAtOffsets(
+                                 path, criteria[o.criterionIndex], o))
+            for o in offsets
+        ], sections)
+
+    def test_fidelityPositions(self) -> None:
+        self.assertIndexMatchesParse(Path('tests/fidelity_positions.csv'), [
+            CSVSectionCriterion(startSectionRowMatch=["Options"],
+                                endSectionRowMatch=["", ""],
+                                rowFilter=lambda r: r[1:7]),
+            CSVSectionCriterion(startSectionRowMatch=["Stocks"],
+                                endSectionRowMatch=[""],
+                                rowFilter=lambda r: r[0:7]),
+            CSVSectionCriterion(startSectionRowMatch=["Bonds"],
+                                endSectionRowMatch=[""]),
+        ],
+                                     ordered=False)
+
+    def test_fidelityTransactions(self) -> None:
+        self.assertIndexMatchesParse(Path('tests/fidelity_transactions.csv'), [
+            CSVSectionCriterion(
+                startSectionRowMatch=["Run Date", "Account", "Action"],
+                endSectionRowMatch=[])
+        ])
+
+    def test_vanguard(self) -> None:
+        self.assertIndexMatchesParse(
+            Path('tests/vanguard_positions_and_transactions.csv'), [
+                CSVSectionCriterion(
+                    startSectionRowMatch=["Account Number", "Investment Name"],
+                    endSectionRowMatch=[],
+                    rowFilter=lambda r: r[1:6]),
+                CSVSectionCriterion(
+                    startSectionRowMatch=["Account Number", "Trade Date"],
+                    endSectionRowMatch=[],
+                    rowFilter=lambda r: r[1:-1]),
+            ])
+
+    def assertIndexMatchesStream(self, lines: List[str],
+                                 criteria: List[CSVSectionCriterion]) -> None:
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'sections.csv'
+            with open(path, 'w', newline='') as f:
+                f.write(''.join(l + '\r\n' for l in lines))
+
+            rows = [
+                r for o in indexSectionsForCSV(path, criteria) for r in
+                parseSectionAtOffsets(path, criteria[o.criterionIndex], o)
+            ]
+
+        self.assertEqual(
+            rows, [r.row for r in streamSectionsForCSV(iter(lines), criteria)])
+
+    def test_unterminatedSection(self) -> None:
+        self.assertIndexMatchesStream(['x', 'Start', 'a,b', 'c,d'], [
+            CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                endSectionRowMatch=['End'])
+        ])
+
+    def test_restartedSection(self) -> None:
+        self.assertIndexMatchesStream(
+            ['Start', 'a,b', 'Start', 'c,d', 'End', 'Next', 'e', 'End'], [
+                CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                    endSectionRowMatch=['End']),
+                CSVSectionCriterion(startSectionRowMatch=['Next'],
+                                    endSectionRowMatch=['End'])
+            ])
+
+    def test_quotedNewlines(self) -> None:
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'quoted.csv'
+            with open(path, 'w', newline='') as f:
+                f.write('"Start"\r\n'
+                        '"multi\r\nline ""quoted""",b\r\n'
+                        '"\r\nEnd",not the end\r\n'
+                        'End,c\r\n'
+                        'after\r\n')
+
+            criterion = CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                            endSectionRowMatch=['End'])
+            offsets = indexSectionsForCSV(path, [criterion])
+
+            self.assertEqual(len(offsets), 1)
+            self.assertEqual(
+                parseSectionAtOffsets(path, criterion, offsets[0]),
+                [['multi\r\nline "quoted"', 'b'], ['\r\nEnd', 'not the end']])
+
+    def test_cachedIndex(self) -> None:
+        criteria = [
+            CSVSectionCriterion(startSectionRowMatch=['Start'],
+                                endSectionRowMatch=[])
+        ]
+
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'sections.csv'
+            cacheDirectory = Path(d) / 'cache'
+            with open(path, 'w', newline='') as f:
+                f.write('Start\na\n\n')
+
+            offsets = indexSectionsForCSV(path,
+                                          criteria,
+                                          cacheDirectory=cacheDirectory)
+            cacheFiles = list(cacheDirectory.iterdir())
+            self.assertEqual(len(cacheFiles), 1)
+
+            # Tamper with the cache to show that it is used.
+            with open(cacheFiles[0]) as f:
+                cached = json.load(f)
+            for key in cached:
+                cached[key] = [[0, 0, 0]]
+            with open(cacheFiles[0], 'w') as f:
+                json.dump(cached, f)
+
+            self.assertEqual(
+                indexSectionsForCSV(path,
+                                    criteria,
+                                    cacheDirectory=cacheDirectory),
+                [CSVSectionOffsets(0, 0, 0)])
+
+            # A different set of criteria isn't served from the cache.
+            self.assertEqual(
+                indexSectionsForCSV(path,
+                                    criteria,
+                                    ordered=False,
+                                    cacheDirectory=cacheDirectory), offsets)
+
+            # Nor is a changed file.
+            with open(path, 'a', newline='') as f:
+                f.write('\n')
+            self.assertEqual(
+                indexSectionsForCSV(path,
+                                    criteria,
+                                    cacheDirectory=cacheDirectory), offsets)
@@ -0,0 +1,64 @@
+from dedup import deduplicateTrades, tradeFingerprint
+from datetime import datetime
+from decimal import Decimal
+from model import Cash, Currency, Stock, Trade, TradeFlags
+from pathlib import Path
+from typing import Optional
+
+import fidelity
+import ibkr
+import unittest
+
+
+def stockTrade(quantity: Decimal, sourceID: Optional[str] = None) -> Trade:
+    return Trade(date=datetime(2019, 1, 1),
+                 instrument=Stock('SPY', Currency.USD),
+                 quantity=quantity,
+                 amount=Cash(currency=Currency.USD, quantity=-quantity * 250),
+                 fees=Cash(currency=Currency.USD, quantity=Decimal(1)),
+                 flags=TradeFlags.OPEN,
+                 sourceID=sourceID)
+
+
+class TestDeduplicateTrades(unittest.TestCase):
+    def test_fingerprintPrefersSourceID(self) -> None:
+        self.assertEqual(tradeFingerprint(stockTrade(Decimal(1), 'IB:1|2')),
+                         'IB:1|2')
+        self.assertEqual(tradeFingerprint(stockTrade(Decimal(1))),
+                         tradeFingerprint(stockTrade(Decimal(1))))
+        self.assertNotEqual(tradeFingerprint(stockTrade(Decimal(1))),
+                            tradeFingerprint(stockTrade(Decimal(2))))
+
+    def test_overlappingIBSources(self) -> None:
+        trades = ibkr.parseTrades(Path('tests/ibkr_trades.xml'))
+        self.assertTrue(all(t.sourceID for t in trades))
+
+        result = deduplicateTrades([('archive', trades[:8]),
+                                    ('download', trades[3:])])
+        self.assertEqual(result.trades, trades)
+        self.assertEqual(result.duplicatesBySource, {'download': 5})
+
+    def test_overlappingSourcesWithoutIDs(self) -> None:
+        trades = fidelity.parseTransactions(
+            Path('tests/fidelity_transactions.csv'))
+        self.assertTrue(all(t.sourceID is None for t in trades))
+
+        result = deduplicateTrades([('a', trades), ('b', []), ('c', trades)])
+        self.assertEqual(result.trades, trades)
+        self.assertEqual(result.duplicatesBySource, {'c': len(trades)})
+
+    def test_identicalTradesInOneSourceAreKept(self) -> None:
+        trade = stockTrade(Decimal(1))
+
+        result = deduplicateTrades([('a', [trade, trade]),
+                                    ('b', [trade, trade, trade])])
+        self.assertEqual(result.trades, [trade] * 3)
+        self.assertEqual(result.duplicatesBySource, {'b': 2})
+
+    def test_sameIDsAcrossSourcesWithDifferentDetails(self) -> None:
+        first = stockTrade(Decimal(1), 'IB:1|2')
+        second = stockTrade(Decimal(2), 'IB:1|2')
+
+        result = deduplicateTrades([('a', [first]), ('b', [second])])
+        self.assertEqual(result.trades, [first])
+        self.assertEqual(result.duplicatesBySource, {'b': 1})
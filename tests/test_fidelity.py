@@ -1,8 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 from decimal import Decimal
 from itertools import groupby
 from model import Cash, Currency, Stock, Bond, Option, OptionType, Position, Trade, TradeFlags
+from parsetools import ParseErrors
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 import fidelity
 import helpers
@@ -18,6 +21,64 @@ class TestFidelityPositions(unittest.TestCase):
     def test_positionValidity(self) -> None:
         self.assertEqual(len(self.positions), 6)
 
+    def test_parallelSectionsMatchSerial(self) -> None:
+        with ProcessPoolExecutor(max_workers=3) as executor:
+            positions = fidelity.parsePositions(
+                Path('tests/fidelity_positions.csv'), executor=executor)
+
+        positions.sort(key=lambda p: p.instrument)
+        self.assertEqual(positions, self.positions)
+
+    def test_parallelSectionsMatchSerialForUnterminatedSection(self) -> None:
+        source = Path('tests/fidelity_positions.csv').read_text()
+        # Truncate the file in the middle of the options section.
+        truncated = source[:source.index('SubTotal of Options')]
+        truncated = truncated[:truncated.rindex(',,,,,,,,,,,,,,')]
+
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'positions.csv'
+            path.write_text(truncated)
+
+            serial = fidelity.parsePositions(path)
+            with ProcessPoolExecutor(max_workers=3) as executor:
+                parallel = fidelity.parsePositions(path, executor=executor)
+
+        self.assertEqual(len(serial), len(self.positions))
+        self.assertEqual(sorted(parallel, key=lambda p: p.instrument),
+                         sorted(serial, key=lambda p: p.instrument))
+
+    def test_lenientParsingRecordsErrors(self) -> None:
+        source = Path('tests/fidelity_positions.csv').read_text()
+        malformed = source.replace('AAPL,APPLE INC EAI: $2.97 EY: 1.85%,100,',
+                                   'AAPL,APPLE INC EAI: $2.97 EY: 1.85%,x,')
+        self.assertNotEqual(source, malformed)
+
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'positions.csv'
+            path.write_text(malformed)
+
+            with self.assertRaises(ValueError):
+                fidelity.parsePositions(path)
+
+            serialErrors = ParseErrors()
+            serial = fidelity.parsePositions(path,
+                                             lenient=True,
+                                             errors=serialErrors)
+
+            parallelErrors = ParseErrors()
+            with ProcessPoolExecutor(max_workers=3) as executor:
+                parallel = fidelity.parsePositions(path,
+                                                   lenient=True,
+                                                   executor=executor,
+                                                   errors=parallelErrors)
+
+        for (positions, errors) in [(serial, serialErrors),
+                                    (parallel, parallelErrors)]:
+            self.assertEqual(len(positions), 5)
+            self.assertEqual(errors.countsByParser,
+                             {'fidelity.parseFidelityPosition': 1})
+            self.assertIn('AAPL', errors.samples[0].input)
+
     def test_tBill(self) -> None:
         self.assertEqual(self.positions[0].instrument,
                          Bond('942792RU5', Currency.USD))
@@ -1,15 +1,21 @@
-from datetime import date
+from datetime import date, timedelta
 from decimal import Decimal
 from hypothesis import given, reproduce_failure
 from hypothesis.strategies import builds, dates, decimals, from_regex, from_type, lists, one_of, sampled_from, text
 from itertools import groupby
-from model import Cash, Currency, Position, Instrument, Stock, Bond, Option, OptionType, Forex, Future, FutureOption, Trade, TradeFlags
+from model import Cash, Currency, Position, Instrument, Quote, Stock, Bond, Option, OptionType, Forex, Future, FutureOption, Trade, TradeFlags
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from unittest import mock
 
+import asyncio
 import helpers
 import ib_insync as IB
 import ibkr
+import json
 import logging
+import time
 import unittest
 
 
@@ -26,6 +32,21 @@ class TestIBKRTrades(unittest.TestCase):
     def test_tradeValidity(self) -> None:
         self.assertGreater(len(self.trades), 0)
 
+    def test_streamingMatchesFlexReport(self) -> None:
+        path = Path('tests/ibkr_trades.xml')
+        self.assertEqual(
+            ibkr.parseTrades(path),
+            ibkr.tradesFromReport(IB.FlexReport(path=path), lenient=False))
+
+    def test_streamingFromFile(self) -> None:
+        with open('tests/ibkr_trades.xml', 'rb') as f:
+            confirms = list(ibkr.streamTradeConfirms(f))
+
+        self.assertEqual(len(confirms), len(self.trades))
+        self.assertTrue(all(c.symbol for c in confirms))
+        with self.assertRaises(AttributeError):
+            confirms[0].orderID
+
     def test_buyGBPStock(self) -> None:
         symbol = 'GAW'
         ts = self.tradesBySymbol[symbol]
@@ -198,6 +219,97 @@ class TestIBKRTrades(unittest.TestCase):
         self.assertEqual(ts[0].flags, TradeFlags.OPEN)
 
 
+class TestTradeStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name) / 'trades.jsonl'
+        self.confirms = list(
+            ibkr.streamTradeConfirms(Path('tests/ibkr_trades.xml')))
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_mergeSkipsKnownTrades(self) -> None:
+        store = ibkr.TradeStore(self.path)
+        self.assertEqual(len(store.merge(self.confirms[:5])), 5)
+        self.assertEqual(len(store.merge(self.confirms)),
+                         len(self.confirms) - 5)
+        self.assertEqual(store.merge(self.confirms), [])
+        self.assertEqual(len(store), len(self.confirms))
+
+    def test_mergeWithoutIDsSkipsReloadedTrades(self) -> None:
+        report = IB.FlexReport(path='tests/ibkr_trades.xml')
+        confirms = [
+            ibkr.IBTradeConfirm(**t.__dict__)._replace(tradeID='', execID='')
+            for t in report.extract('TradeConfirm', parseNumbers=False)
+        ]
+
+        ibkr.TradeStore(self.path).merge(confirms)
+        lines = self.path.read_text().splitlines()
+
+        store = ibkr.TradeStore(self.path)
+        self.assertEqual(len(store), len(confirms))
+        self.assertEqual(store.merge(confirms), [])
+        self.assertEqual(len(store), len(confirms))
+        self.assertEqual(self.path.read_text().splitlines(), lines)
+
+    def test_storeIsReloaded(self) -> None:
+        ibkr.TradeStore(self.path).merge(self.confirms)
+
+        store = ibkr.TradeStore(self.path)
+        self.assertEqual(store.confirms(), self.confirms)
+        self.assertEqual(store.trades(),
+                         ibkr.parseTrades(Path('tests/ibkr_trades.xml')))
+
+    def test_onlyNewConfirmsAreParsed(self) -> None:
+        ibkr.TradeStore(self.path).merge(self.confirms[:5])
+
+        # Add confirmations without parsing them, as another copy of bankroll might have.
+        with open(self.path, 'a') as f:
+            for confirm in self.confirms[5:]:
+                f.write(
+                    json.dumps(
+                        {k: v
+                         for (k, v) in confirm._asdict().items() if v}))
+                f.write('\n')
+
+        with mock.patch.object(
+                ibkr, 'parseKeyedTradeConfirm',
+                wraps=ibkr.parseKeyedTradeConfirm) as parseKeyed:
+            trades = ibkr.TradeStore(self.path).trades()
+            self.assertEqual(parseKeyed.call_count, len(self.confirms) - 5)
+
+            self.assertEqual(ibkr.TradeStore(self.path).trades(), trades)
+            self.assertEqual(parseKeyed.call_count, len(self.confirms) - 5)
+
+        self.assertEqual(trades,
+                         ibkr.parseTrades(Path('tests/ibkr_trades.xml')))
+
+    def test_changedParserReparses(self) -> None:
+        ibkr.TradeStore(self.path).merge(self.confirms)
+
+        with mock.patch.object(ibkr, 'parserVersion', return_value='other'):
+            with mock.patch.object(
+                    ibkr,
+                    'parseKeyedTradeConfirm',
+                    wraps=ibkr.parseKeyedTradeConfirm) as parseKeyed:
+                ibkr.TradeStore(self.path).trades()
+
+        self.assertEqual(parseKeyed.call_count, len(self.confirms))
+
+    def test_interruptedWriteIsIgnored(self) -> None:
+        ibkr.TradeStore(self.path).merge(self.confirms[:3])
+        with open(self.path, 'a') as f:
+            f.write('{"symbol": "AA')
+
+        with self.assertLogs(level='WARNING'):
+            store = ibkr.TradeStore(self.path)
+        self.assertEqual(len(store), 3)
+
+        store.merge(self.confirms[3:])
+        self.assertEqual(ibkr.TradeStore(self.path).confirms(), self.confirms)
+
+
 class TestIBKRParsing(unittest.TestCase):
     validSymbols = text(min_size=1)
     validCurrencies = from_type(Currency).map(lambda c: c.name)
@@ -372,5 +484,404 @@ class TestIBKRParsing(unittest.TestCase):
         self.validatePositionContract(position, parsedPosition.instrument)
 
 
+class StubIBClient:
+    def __init__(self) -> None:
+        self.qualifyCalls = 0
+        self.tickerCalls = 0
+        self.marketDataTypeCalls = 0
+        self.linesInFlight = 0
+        self.maxLinesInFlight = 0
+        self.subscriptions: List[IB.Contract] = []
+        self.streamingTickers: List[IB.Ticker] = []
+
+    def reqMarketDataType(self, marketDataType: int) -> None:
+        self.marketDataTypeCalls += 1
+
+    def qualifyContracts(self, *contracts: IB.Contract) -> List[IB.Contract]:
+        self.qualifyCalls += 1
+        for (i, c) in enumerate(contracts):
+            c.conId = i + 1
+
+        return list(contracts)
+
+    def reqTickers(self, *contracts: IB.Contract) -> List[IB.Ticker]:
+        self.tickerCalls += 1
+        return [
+            IB.Ticker(contract=c, bid=10.0, bidSize=1, ask=11.0, askSize=1)
+            for c in contracts
+        ]
+
+    async def qualifyContractsAsync(self, *contracts: IB.Contract
+                                    ) -> List[IB.Contract]:
+        return self.qualifyContracts(*contracts)
+
+    async def reqTickersAsync(self,
+                              *contracts: IB.Contract) -> List[IB.Ticker]:
+        self.linesInFlight += len(contracts)
+        self.maxLinesInFlight = max(self.maxLinesInFlight, self.linesInFlight)
+
+        try:
+            await asyncio.sleep(0)
+            return self.reqTickers(*contracts)
+        finally:
+            self.linesInFlight -= len(contracts)
+
+    def reqMktData(self, contract: IB.Contract) -> IB.Ticker:
+        self.subscriptions.append(contract)
+        self.streamingTickers.append(IB.Ticker(contract=contract))
+        return self.streamingTickers[-1]
+
+    def cancelMktData(self, contract: IB.Contract) -> None:
+        self.subscriptions.remove(contract)
+
+
+class TestIBDataProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = StubIBClient()
+        self.dataProvider = ibkr.IBDataProvider(client=self.client)
+
+    def test_fetchQuote(self) -> None:
+        quote = self.dataProvider.fetchQuote(Stock('AAPL', Currency.USD))
+        self.assertEqual(quote.bid,
+                         Cash(currency=Currency.USD, quantity=Decimal('10')))
+        self.assertEqual(quote.ask,
+                         Cash(currency=Currency.USD, quantity=Decimal('11')))
+        self.assertIsNone(quote.last)
+        self.assertIsNone(quote.close)
+
+    def test_fetchQuoteAsync(self) -> None:
+        instrument = Stock('AAPL', Currency.USD)
+        quote = asyncio.get_event_loop().run_until_complete(
+            self.dataProvider.fetchQuoteAsync(instrument))
+        self.assertEqual(quote, self.dataProvider.fetchQuote(instrument))
+
+    def test_fetchQuotesIsBatched(self) -> None:
+        instruments = [
+            Stock('AAPL', Currency.USD),
+            Stock('GAW', Currency.GBP),
+            Bond('912796RA4', Currency.USD),
+        ]
+
+        quotes = self.dataProvider.fetchQuotes(instruments)
+        self.assertEqual(self.client.qualifyCalls, 1)
+        self.assertEqual(self.client.tickerCalls, 1)
+
+        self.assertEqual(set(quotes.keys()), set(instruments))
+        for i in instruments:
+            self.assertEqual(quotes[i].bid,
+                             Cash(currency=i.currency, quantity=Decimal('10')))
+
+    def test_concurrentFetchesQualifyInOneBatch(self) -> None:
+        instruments = [
+            Stock(symbol, Currency.USD)
+            for symbol in ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'FB']
+        ]
+
+        async def fetchAll() -> List[Quote]:
+            return await asyncio.gather(*(self.dataProvider.fetchQuoteAsync(i)
+                                          for i in instruments))
+
+        with mock.patch.object(ibkr.ContractCache,
+                               'save',
+                               autospec=True,
+                               side_effect=ibkr.ContractCache.save) as save:
+            quotes = asyncio.get_event_loop().run_until_complete(fetchAll())
+
+        self.assertEqual(len(quotes), len(instruments))
+        self.assertEqual(self.client.qualifyCalls, 1)
+        self.assertEqual(save.call_count, 1)
+
+        # Cached now, so there's nothing left to qualify or save.
+        self.dataProvider.fetchQuotes(instruments)
+        self.assertEqual(self.client.qualifyCalls, 1)
+
+    def test_marketDataTypeSetOnce(self) -> None:
+        self.dataProvider.fetchQuote(Stock('AAPL', Currency.USD))
+        self.dataProvider.fetchQuote(Stock('GAW', Currency.GBP))
+        self.assertEqual(self.client.marketDataTypeCalls, 1)
+
+    def test_subscribeQuotes(self) -> None:
+        instrument = Stock('AAPL', Currency.USD)
+        received: List[Quote] = []
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(
+            self.dataProvider.subscribeQuotes(
+                [instrument], onQuote=lambda i, q: received.append(q)))
+        self.assertEqual(len(self.client.subscriptions), 1)
+
+        ticker = self.client.streamingTickers[0]
+        ticker.last = 12.5
+        ticker.lastSize = 100
+        ticker.updateEvent.emit(ticker)
+
+        self.assertEqual(received, [
+            Quote(last=Cash(currency=Currency.USD, quantity=Decimal('12.5')))
+        ])
+
+        loop.run_until_complete(self.dataProvider.unsubscribeQuotes())
+        self.assertEqual(self.client.subscriptions, [])
+
+        ticker.updateEvent.emit(ticker)
+        self.assertEqual(len(received), 1)
+
+    def test_subscribeQuotesPollsBeyondLineLimit(self) -> None:
+        self.dataProvider = ibkr.IBDataProvider(
+            client=self.client,
+            scheduler=ibkr.MarketDataScheduler(self.client, maxLines=4))
+        self.dataProvider.pollingLines = 2
+
+        instruments = [
+            Stock(symbol, Currency.USD)
+            for symbol in ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'FB']
+        ]
+        received: Dict[Instrument, Quote] = {}
+
+        async def subscribe() -> None:
+            polled = asyncio.Event()
+
+            def onQuote(i: Instrument, q: Quote) -> None:
+                received[i] = q
+                if len(received) == 3:
+                    polled.set()
+
+            await self.dataProvider.subscribeQuotes(
+                instruments,
+                onQuote=onQuote,
+                pollInterval=timedelta(seconds=60))
+            await asyncio.wait_for(polled.wait(), timeout=5)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(subscribe())
+
+        self.assertEqual(len(self.client.subscriptions), 2)
+        self.assertEqual(self.dataProvider.scheduler.streamingLines, 2)
+        self.assertEqual(set(received.keys()), set(instruments[2:]))
+        self.assertLessEqual(self.client.maxLinesInFlight, 2)
+
+        loop.run_until_complete(self.dataProvider.unsubscribeQuotes())
+        self.assertEqual(self.client.subscriptions, [])
+        self.assertEqual(self.dataProvider.scheduler.linesInUse, 0)
+
+
+class TestMarketDataScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = StubIBClient()
+        self.contracts = [
+            IB.Stock(symbol=symbol, exchange='SMART', currency='USD')
+            for symbol in ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'FB']
+        ]
+
+        for (i, c) in enumerate(self.contracts):
+            c.conId = i + 1
+
+    def test_snapshotLimitsLines(self) -> None:
+        scheduler = ibkr.MarketDataScheduler(self.client, maxLines=2)
+        tickers = asyncio.get_event_loop().run_until_complete(
+            scheduler.snapshot(*self.contracts))
+
+        self.assertEqual([t.contract for t in tickers], self.contracts)
+        self.assertEqual(self.client.maxLinesInFlight, 2)
+        self.assertEqual(self.client.tickerCalls, 3)
+        self.assertEqual(scheduler.linesInUse, 0)
+
+    def test_throttlesMessages(self) -> None:
+        interval = timedelta(milliseconds=50)
+        scheduler = ibkr.MarketDataScheduler(self.client,
+                                             maxMessages=2,
+                                             interval=interval)
+
+        start = time.monotonic()
+        asyncio.get_event_loop().run_until_complete(
+            scheduler.qualify(*self.contracts))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(self.client.qualifyCalls, 3)
+        self.assertGreaterEqual(elapsed, 2 * interval.total_seconds())
+
+    def test_subscriptionsHoldLinesUntilCancelled(self) -> None:
+        scheduler = ibkr.MarketDataScheduler(self.client, maxLines=2)
+        loop = asyncio.get_event_loop()
+
+        loop.run_until_complete(scheduler.subscribe(self.contracts[0]))
+        loop.run_until_complete(scheduler.subscribe(self.contracts[1]))
+        self.assertEqual(scheduler.linesInUse, 2)
+
+        # Resubscribing to the same contract does not use another line.
+        loop.run_until_complete(scheduler.subscribe(self.contracts[0]))
+        self.assertEqual(scheduler.linesInUse, 2)
+
+        loop.run_until_complete(scheduler.unsubscribe(self.contracts[0]))
+        self.assertEqual(scheduler.linesInUse, 1)
+        self.assertEqual(self.client.subscriptions, [self.contracts[1]])
+
+        loop.run_until_complete(scheduler.unsubscribeAll())
+        self.assertEqual(scheduler.linesInUse, 0)
+        self.assertEqual(self.client.subscriptions, [])
+
+    def test_subscribeFailsWithoutFreeLines(self) -> None:
+        scheduler = ibkr.MarketDataScheduler(self.client, maxLines=2)
+        loop = asyncio.get_event_loop()
+
+        loop.run_until_complete(scheduler.subscribe(self.contracts[0]))
+        loop.run_until_complete(scheduler.subscribe(self.contracts[1]))
+
+        with self.assertRaises(ValueError):
+            loop.run_until_complete(scheduler.subscribe(self.contracts[2]))
+        with self.assertRaises(ValueError):
+            loop.run_until_complete(scheduler.snapshot(self.contracts[2]))
+
+        self.assertEqual(scheduler.linesInUse, 2)
+        self.assertEqual(scheduler.streamingLines, 2)
+
+    def test_snapshotUsesLinesLeftBySubscriptions(self) -> None:
+        scheduler = ibkr.MarketDataScheduler(self.client, maxLines=3)
+        loop = asyncio.get_event_loop()
+
+        loop.run_until_complete(scheduler.subscribe(self.contracts[0]))
+        loop.run_until_complete(scheduler.subscribe(self.contracts[1]))
+        tickers = loop.run_until_complete(
+            scheduler.snapshot(*self.contracts[2:]))
+
+        self.assertEqual([t.contract for t in tickers], self.contracts[2:])
+        self.assertEqual(self.client.maxLinesInFlight, 1)
+        self.assertEqual(scheduler.linesInUse, 2)
+
+
+class TestContractCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempDir = TemporaryDirectory()
+        self.path = Path(self.tempDir.name) / 'contracts.json'
+
+    def tearDown(self) -> None:
+        self.tempDir.cleanup()
+
+    def test_qualifiedContractsPersist(self) -> None:
+        instruments = [
+            Stock('AAPL', Currency.USD),
+            Option(underlying='SPY',
+                   currency=Currency.USD,
+                   optionType=OptionType.CALL,
+                   expiration=date.today() + timedelta(days=30),
+                   strike=Decimal('250')),
+        ]
+
+        client = StubIBClient()
+        ibkr.IBDataProvider(client=client,
+                            contractCache=ibkr.ContractCache(
+                                self.path)).fetchQuotes(instruments)
+        self.assertEqual(client.qualifyCalls, 1)
+
+        client = StubIBClient()
+        quotes = ibkr.IBDataProvider(client=client,
+                                     contractCache=ibkr.ContractCache(
+                                         self.path)).fetchQuotes(instruments)
+        self.assertEqual(client.qualifyCalls, 0)
+        self.assertEqual(client.tickerCalls, 1)
+        self.assertEqual(set(quotes.keys()), set(instruments))
+
+    def test_cachedContractMatchesQualified(self) -> None:
+        instrument = Stock('AAPL', Currency.USD)
+        con = IB.Stock(symbol='AAPL',
+                       exchange='SMART',
+                       currency='USD',
+                       conId=265598,
+                       primaryExchange='NASDAQ')
+
+        cache = ibkr.ContractCache(self.path)
+        cache.set(instrument, con)
+        cache.save()
+
+        cached = ibkr.ContractCache(self.path).get(instrument)
+        self.assertIsNotNone(cached)
+        if cached:
+            self.assertEqual(cached.conId, 265598)
+            self.assertEqual(cached.secType, 'STK')
+            self.assertEqual(cached.primaryExchange, 'NASDAQ')
+
+    def test_expiredContractsDropped(self) -> None:
+        expired = Option(underlying='SPY',
+                         currency=Currency.USD,
+                         optionType=OptionType.PUT,
+                         expiration=date.today() - timedelta(days=1),
+                         strike=Decimal('250'))
+        con = ibkr.contract(expired)
+        con.conId = 1
+
+        cache = ibkr.ContractCache(self.path)
+        cache.set(expired, con)
+        cache.save()
+        self.assertIsNotNone(cache.get(expired))
+
+        self.assertIsNone(ibkr.ContractCache(self.path).get(expired))
+
+    def test_malformedEntriesDropped(self) -> None:
+        instrument = Stock('AAPL', Currency.USD)
+        cache = ibkr.ContractCache(self.path)
+        cache.set(instrument, ibkr.contract(instrument))
+        cache.save()
+
+        entries = json.loads(self.path.read_text())
+        entries.update({
+            'noExpiration': {
+                'contract': {}
+            },
+            'badExpiration': {
+                'expiration': 20190322,
+                'contract': {}
+            },
+            'noContract': {
+                'expiration': None
+            },
+            'unknownField': {
+                'expiration': None,
+                'contract': {
+                    'bogus': 1
+                }
+            },
+            'notAnEntry': [],
+        })
+        self.path.write_text(json.dumps(entries))
+
+        with self.assertLogs(level=logging.WARNING):
+            cache = ibkr.ContractCache(self.path)
+        self.assertEqual(len(cache), 1)
+        self.assertIsNotNone(cache.get(instrument))
+
+    def test_unreadableCacheIgnored(self) -> None:
+        for contents in ['{"truncated": {"expir', '[]']:
+            self.path.write_text(contents)
+            with self.assertLogs(level=logging.WARNING):
+                self.assertEqual(len(ibkr.ContractCache(self.path)), 0)
+
+    def test_saveIsAtomic(self) -> None:
+        instrument = Stock('AAPL', Currency.USD)
+        cache = ibkr.ContractCache(self.path)
+        cache.set(instrument, ibkr.contract(instrument))
+        cache.save()
+        saved = self.path.read_text()
+
+        cache.set(Stock('MSFT', Currency.USD),
+                  ibkr.contract(Stock('MSFT', Currency.USD)))
+        with mock.patch.object(ibkr.json, 'dump', side_effect=OSError):
+            with self.assertLogs(level=logging.WARNING):
+                cache.save()
+
+        self.assertEqual(self.path.read_text(), saved)
+
+    def test_keyDistinguishesStrikes(self) -> None:
+        a, b = [
+            Option(underlying='SPY',
+                   currency=Currency.USD,
+                   optionType=OptionType.PUT,
+                   expiration=date(2019, 3, 22),
+                   strike=strike)
+            for strike in [Decimal('1'), Decimal('2')]
+        ]
+
+        self.assertNotEqual(ibkr.ContractCache.key(a),
+                            ibkr.ContractCache.key(b))
+
+
 if __name__ == '__main__':
     unittest.main()
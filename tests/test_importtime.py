@@ -0,0 +1,51 @@
+from pathlib import Path
+from typing import Dict
+
+import subprocess
+import sys
+import unittest
+
+
+# Runs `python -X importtime` on a fresh interpreter, returning the cumulative import time of each module in microseconds.
+def importTimes(module: str) -> Dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=str(Path(__file__).parent.parent),
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True)
+
+    times: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        (_, cumulative, name) = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+# The CLI is run frequently from scripts, so its startup time matters. These tests check that broker modules aren't imported up front, and that importing the CLI stays within a time budget.
+@unittest.skipIf(sys.version_info < (3, 7), 'requires -X importtime')
+class TestImportTime(unittest.TestCase):
+    # Generous, to allow for slow machines; importing the broker modules alone takes several times this long.
+    budgetMicroseconds = 100000
+
+    # Modules which should only be imported when the options using them are given.
+    lazyModules = [
+        'ib_insync', 'ibkr', 'fidelity', 'schwab', 'vanguard', 'analysis',
+        'progress', 'parsecache', 'multiprocessing', 'numpy'
+    ]
+
+    def test_brokerModulesImportedLazily(self) -> None:
+        times = importTimes('bankroll')
+        self.assertIn('bankroll', times)
+
+        for module in self.lazyModules:
+            self.assertNotIn(module, times)
+
+    def test_importTimeWithinBudget(self) -> None:
+        # Take the best of several runs, to reduce noise.
+        best = min(importTimes('bankroll')['bankroll'] for _ in range(3))
+        self.assertLess(best, self.budgetMicroseconds)
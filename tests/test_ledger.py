@@ -0,0 +1,172 @@
+from datetime import date, datetime
+from decimal import Decimal
+from bankroll import combinePositions
+from hypothesis import assume, given
+from hypothesis.strategies import lists, sampled_from
+from ledger import CashArray, PositionLedger, TradeLedger
+from model import Cash, Currency, Future, Instrument, Position, Stock, Trade, TradeFlags
+from typing import Dict, List
+
+import helpers
+import numpy as np
+import unittest
+
+validFlags = sampled_from([
+    TradeFlags.OPEN, TradeFlags.CLOSE, TradeFlags.OPEN | TradeFlags.DRIP,
+    TradeFlags.CLOSE | TradeFlags.EXPIRED
+])
+
+
+def stockTrade(symbol: str, day: int, quantity: Decimal,
+               amount: Decimal) -> Trade:
+    return Trade(date=datetime(2019, 1, day),
+                 instrument=Stock(symbol, Currency.USD),
+                 quantity=quantity,
+                 amount=helpers.cashUSD(amount),
+                 fees=helpers.cashUSD(Decimal('1')),
+                 flags=TradeFlags.OPEN)
+
+
+class TestCashArray(unittest.TestCase):
+    @given(lists(helpers.cash()))
+    def test_roundtrip(self, values: List[Cash]) -> None:
+        array = CashArray.fromCash(values)
+        self.assertEqual(len(array), len(values))
+        self.assertEqual(array.toCash(), values)
+
+    @given(lists(helpers.cash()))
+    def test_sumByCurrency(self, values: List[Cash]) -> None:
+        expected: Dict[Currency, Cash] = {}
+        for v in values:
+            expected[v.currency] = expected.get(
+                v.currency, Cash(v.currency, Decimal(0))) + v
+
+        self.assertEqual(CashArray.fromCash(values).sumByCurrency(), expected)
+
+
+class TestTradeLedger(unittest.TestCase):
+    @given(lists(helpers.trades(flags=validFlags)))
+    def test_roundtrip(self, trades: List[Trade]) -> None:
+        ledger = TradeLedger(trades)
+        self.assertEqual(len(ledger), len(trades))
+        self.assertEqual(ledger.toTrades(), trades)
+
+        if trades:
+            self.assertEqual(ledger[0], trades[0])
+
+    @given(lists(helpers.trades(flags=validFlags)))
+    def test_quantityByInstrument(self, trades: List[Trade]) -> None:
+        expected: Dict[Instrument, Decimal] = {}
+        for t in trades:
+            expected[t.instrument] = expected.get(t.instrument,
+                                                  Decimal(0)) + t.quantity
+
+        self.assertEqual(TradeLedger(trades).quantityByInstrument(), expected)
+
+    def test_amountByInstrument(self) -> None:
+        trades = [
+            stockTrade('SPY', 1, Decimal('10'), Decimal('-2500.25')),
+            stockTrade('VTI', 2, Decimal('5'), Decimal('-700')),
+            stockTrade('SPY', 3, Decimal('-4'), Decimal('1010.10')),
+        ]
+
+        self.assertEqual(
+            TradeLedger(trades).amountByInstrument(), {
+                Stock('SPY', Currency.USD): helpers.cashUSD(
+                    Decimal('-1490.15')),
+                Stock('VTI', Currency.USD): helpers.cashUSD(Decimal('-700')),
+            })
+
+    def test_amountByInstrumentRejectsMixedCurrencies(self) -> None:
+        spy = Stock('SPY', Currency.USD)
+        trades = [
+            stockTrade('SPY', 1, Decimal('10'), Decimal('-2500')),
+            Trade(date=datetime(2019, 1, 2),
+                  instrument=spy,
+                  quantity=Decimal('1'),
+                  amount=Cash(Currency.EUR, Decimal('-200')),
+                  fees=helpers.cashUSD(Decimal('0')),
+                  flags=TradeFlags.OPEN),
+        ]
+
+        with self.assertRaises(ValueError):
+            TradeLedger(trades).amountByInstrument()
+
+    def test_filterAndSort(self) -> None:
+        trades = [
+            stockTrade('SPY', 3, Decimal('10'), Decimal('-2500')),
+            stockTrade('VTI', 1, Decimal('5'), Decimal('-700')),
+            stockTrade('SPY', 2, Decimal('-4'), Decimal('1000')),
+        ]
+
+        ledger = TradeLedger(trades)
+        spy = ledger.filter(ledger.instrumentMask(Stock('SPY', Currency.USD)))
+        self.assertEqual(spy.toTrades(), [trades[0], trades[2]])
+        self.assertEqual(spy.sortedByDate().toTrades(), [trades[2], trades[0]])
+        self.assertEqual(
+            ledger.sortedByDate(reverse=True).toTrades(),
+            [trades[0], trades[2], trades[1]])
+
+        missing = ledger.instrumentMask(Stock('QQQ', Currency.USD))
+        self.assertEqual(len(ledger.filter(missing)), 0)
+
+        with self.assertRaises(ValueError):
+            ledger.filter(np.array([True]))
+
+    def test_flagsMask(self) -> None:
+        trades = [
+            stockTrade('SPY', 1, Decimal('10'), Decimal('-2500')),
+            Trade(date=datetime(2019, 1, 2),
+                  instrument=Stock('SPY', Currency.USD),
+                  quantity=Decimal('-10'),
+                  amount=helpers.cashUSD(Decimal('2600')),
+                  fees=helpers.cashUSD(Decimal('1')),
+                  flags=TradeFlags.CLOSE),
+        ]
+
+        ledger = TradeLedger(trades)
+        self.assertEqual(
+            ledger.filter(ledger.flagsMask(TradeFlags.CLOSE)).toTrades(),
+            [trades[1]])
+
+
+class TestPositionLedger(unittest.TestCase):
+    @given(helpers.positionsInFewInstruments())
+    def test_roundtrip(self, positions: List[Position]) -> None:
+        ledger = PositionLedger(positions)
+        self.assertEqual(len(ledger), len(positions))
+        self.assertEqual(ledger.toPositions(), positions)
+
+    def test_equalInstrumentsKeepTheirMultipliers(self) -> None:
+        positions = [
+            Position(instrument=Future.interned('ESZ9', Currency.USD,
+                                                Decimal(multiplier),
+                                                date(2019, 12, 20)),
+                     quantity=Decimal('2'),
+                     costBasis=helpers.cashUSD(Decimal('300000')))
+            for multiplier in ['50', '5', '50']
+        ]
+        self.assertEqual(positions[0].instrument, positions[1].instrument)
+
+        ledger = PositionLedger(positions)
+        self.assertEqual(
+            [p.instrument.multiplier for p in ledger.toPositions()],
+            [Decimal('50'), Decimal('5'),
+             Decimal('50')])
+        self.assertEqual(ledger.combined().toPositions(),
+                         combinePositions(positions))
+
+    @given(helpers.positionsInFewInstruments())
+    def test_combinedMatchesCombinePositions(self, positions: List[Position]
+                                             ) -> None:
+        try:
+            expected = combinePositions(positions)
+        except ValueError:
+            # Combined to zero quantity, but some cost basis.
+            assume(False)
+            return
+
+        combined = PositionLedger(positions).combined().toPositions()
+        self.assertEqual(combined, expected)
+        self.assertEqual([p.costBasis for p in combined],
+                         [p.costBasis for p in expected])
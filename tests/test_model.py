@@ -1,11 +1,13 @@
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal, ROUND_UP
 from hypothesis import assume, given, reproduce_failure
 from hypothesis.strategies import dates, decimals, from_type, integers, lists, one_of, sampled_from, text
-from model import Cash, Currency, Instrument, Bond, Stock, Option, OptionType, FutureOption, Future, Position, Quote, Trade
+from model import Cash, Currency, Instrument, Bond, Stock, Option, OptionType, FutureOption, Future, Position, Quote, Trade, TradeFlags
 from typing import List, Optional, TypeVar
 
 import helpers
+import os
+import pickle
 import unittest
 
 T = TypeVar('T', Decimal, int)
@@ -145,6 +147,20 @@ class TestCash(unittest.TestCase):
             cashB,
             msg='{} not greater than itself minus {}: {}'.format(a, b, a - b))
 
+    @given(sampled_from(Currency), helpers.cashAmounts())
+    def test_cashQuantityIsQuantized(self, cur: Currency, a: Decimal) -> None:
+        cash = Cash(currency=cur, quantity=a)
+        self.assertEqual(cash.quantity, Cash.quantize(a))
+        self.assertEqual(cash.quantity.as_tuple().exponent,
+                         Cash.quantization.as_tuple().exponent)
+
+    @given(from_type(Cash))
+    def test_negateCash(self, cashA: Cash) -> None:
+        self.assertEqual((-cashA).quantity, -cashA.quantity)
+        self.assertEqual(abs(cashA).quantity, abs(cashA.quantity))
+        self.assertEqual(cashA + -cashA,
+                         Cash(currency=cashA.currency, quantity=Decimal(0)))
+
 
 class TestPosition(unittest.TestCase):
     @given(from_type(Position))
@@ -217,6 +233,59 @@ class TestInstrument(unittest.TestCase):
         assume(type(a) != type(b))
         self.assertNotEqual(a, b)
 
+    @given(text(min_size=1), sampled_from(Currency))
+    def test_internedStockIsShared(self, symbol: str, cur: Currency) -> None:
+        a = Stock.interned(symbol, cur)
+        self.assertIs(Stock.interned(symbol, cur), a)
+        self.assertEqual(a, Stock(symbol, cur))
+        self.assertEqual(hash(a), hash(Stock(symbol, cur)))
+
+    @given(from_type(Instrument))
+    def test_instrumentPickles(self, i: Instrument) -> None:
+        unpickled = pickle.loads(pickle.dumps(i))
+        self.assertEqual(unpickled, i)
+        self.assertEqual(hash(unpickled), hash(i))
+        self.assertEqual(repr(unpickled), repr(i))
+        self.assertEqual(unpickled.multiplier, i.multiplier)
+
+    def test_instrumentsPickledByAnotherProcess(self) -> None:
+        pickled = helpers.runWithHashSeed(
+            'import helpers, pickle, sys\n'
+            'sys.stdout.buffer.write(pickle.dumps(helpers.sampleInstruments()))',
+            hashSeed=1 if os.environ.get('PYTHONHASHSEED') != '1' else 2)
+
+        fresh = helpers.sampleInstruments()
+        unpickled = pickle.loads(pickled)
+        self.assertEqual(unpickled, fresh)
+        self.assertEqual([hash(i) for i in unpickled],
+                         [hash(i) for i in fresh])
+        self.assertEqual(len(set(unpickled) | set(fresh)), len(fresh))
+
+    def test_internedDistinguishesTypes(self) -> None:
+        stock = Stock.interned('912828U40', Currency.USD)
+        bond = Bond.interned('912828U40', Currency.USD)
+        self.assertIsNot(stock, bond)
+        self.assertNotEqual(stock, bond)
+
+    def test_internedOption(self) -> None:
+        o = Option.interned(underlying='SPX',
+                            currency=Currency.USD,
+                            optionType=OptionType.PUT,
+                            expiration=date(2014, 11, 22),
+                            strike=Decimal('19.50'))
+        self.assertIs(
+            Option.interned(underlying='SPX',
+                            currency=Currency.USD,
+                            optionType=OptionType.PUT,
+                            expiration=date(2014, 11, 22),
+                            strike=Decimal('19.50')), o)
+        self.assertIsNot(
+            Option.interned(underlying='SPX',
+                            currency=Currency.USD,
+                            optionType=OptionType.CALL,
+                            expiration=date(2014, 11, 22),
+                            strike=Decimal('19.50')), o)
+
 
 class TestOption(unittest.TestCase):
     # https://en.wikipedia.org/wiki/Option_symbol#The_OCC_Option_Symbol
@@ -265,6 +334,21 @@ class TestQuote(unittest.TestCase):
 
 
 class TestTrade(unittest.TestCase):
+    def test_replacingFlags(self) -> None:
+        t = Trade(date=datetime(2019, 1, 1),
+                  instrument=Stock('SPY', Currency.USD),
+                  quantity=Decimal(10),
+                  amount=helpers.cashUSD(Decimal(-2500)),
+                  fees=helpers.cashUSD(Decimal(1)),
+                  flags=TradeFlags.OPEN | TradeFlags.DRIP)
+
+        replaced = t.replacingFlags(TradeFlags.CLOSE)
+        self.assertEqual(replaced, t._replace(flags=TradeFlags.CLOSE))
+        self.assertEqual(t.flags, TradeFlags.OPEN | TradeFlags.DRIP)
+
+        with self.assertRaises(ValueError):
+            t.replacingFlags(TradeFlags.CLOSE | TradeFlags.DRIP)
+
     @given(from_type(Trade))
     def test_tradeEqualsItself(self, t: Trade) -> None:
         self.assertEqual(t, t)
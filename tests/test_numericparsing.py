@@ -0,0 +1,53 @@
+from decimal import Decimal, InvalidOperation, localcontext
+from hypothesis import given
+from hypothesis.strategies import decimals
+from model import Cash, Currency
+from numericparsing import parseAmount, parseFiniteDecimal
+from schwab import schwabDecimal
+
+import helpers
+import unittest
+
+finiteDecimals = decimals(allow_nan=False, allow_infinity=False)
+
+
+class TestNumericParsing(unittest.TestCase):
+    @given(finiteDecimals)
+    def test_parseFiniteDecimalIsExact(self, d: Decimal) -> None:
+        parsed = parseFiniteDecimal(str(d))
+        self.assertEqual(parsed, d)
+        self.assertEqual(str(parsed), str(d))
+
+    def test_parseFiniteDecimalRejectsInvalid(self) -> None:
+        for s in ['', 'abc', 'NaN', 'sNaN', 'Infinity', '-inf', '1,000']:
+            with self.assertRaises(ValueError):
+                parseFiniteDecimal(s)
+
+    @given(helpers.cashAmounts())
+    def test_parseFormattedUSD(self, d: Decimal) -> None:
+        formatted = str(Cash(currency=Currency.USD, quantity=d))
+        self.assertEqual(parseAmount(formatted), round(d, 2))
+
+    def test_parseAmount(self) -> None:
+        self.assertEqual(parseAmount('$1,234.56'), Decimal('1234.56'))
+        self.assertEqual(parseAmount('-$5.00'), Decimal('-5'))
+        self.assertEqual(parseAmount('$-5.00'), Decimal('-5'))
+        self.assertEqual(parseAmount(' (12.5) '), Decimal('-12.5'))
+        self.assertEqual(parseAmount('N/A', notAvailable=Decimal(0)),
+                         Decimal(0))
+
+        for s in ['N/A', '', '$', '()', '(1', 'twelve']:
+            with self.assertRaises(ValueError):
+                parseAmount(s)
+
+    def test_parseAmountRejectsInvalidWithoutTraps(self) -> None:
+        with localcontext() as ctx:
+            ctx.traps[InvalidOperation] = False
+            for s in ['NaN', 'Infinity', '$', 'twelve']:
+                with self.assertRaises(ValueError):
+                    parseAmount(s)
+                with self.assertRaises(ValueError):
+                    schwabDecimal(s)
+
+            self.assertEqual(parseAmount('($1,000)'), Decimal('-1000'))
+            self.assertEqual(schwabDecimal('N/A'), Decimal(0))
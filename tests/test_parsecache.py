@@ -0,0 +1,172 @@
+from bankroll import combinePositions
+from parsecache import ParseCache, parserVersion
+from parsetools import ParseErrors, lenientParse
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Optional
+
+import fidelity
+import helpers
+import os
+import unittest
+
+parseCalls: List[Path] = []
+
+
+def countingParse(path: Path, lenient: bool = False) -> List[str]:
+    parseCalls.append(path)
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() or not lenient]
+
+
+def nonEmptyLine(line: str) -> str:
+    if not line.strip():
+        raise ValueError('Empty line')
+
+    return line.strip()
+
+
+def collectingParse(path: Path,
+                    lenient: bool = False,
+                    errors: Optional[ParseErrors] = None) -> List[str]:
+    parseCalls.append(path)
+    with open(path) as f:
+        return list(
+            lenientParse(f,
+                         transform=nonEmptyLine,
+                         lenient=lenient,
+                         errors=errors))
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = TemporaryDirectory()
+        self.cache = ParseCache(Path(self.directory.name) / 'cache')
+        self.path = Path(self.directory.name) / 'statement.csv'
+        with open(self.path, 'w') as f:
+            f.write('a\n\nb\n')
+
+        parseCalls.clear()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_hitSkipsParsing(self) -> None:
+        first = self.cache.parse(countingParse, self.path, lenient=False)
+        second = self.cache.parse(countingParse, self.path, lenient=False)
+
+        self.assertEqual(first, ['a', '', 'b'])
+        self.assertEqual(second, first)
+        self.assertEqual(len(parseCalls), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lenientIsPartOfKey(self) -> None:
+        self.cache.parse(countingParse, self.path, lenient=False)
+        lenient = self.cache.parse(countingParse, self.path, lenient=True)
+
+        self.assertEqual(lenient, ['a', 'b'])
+        self.assertEqual(len(parseCalls), 2)
+
+    def test_changedFileIsReparsed(self) -> None:
+        self.cache.parse(countingParse, self.path, lenient=False)
+        with open(self.path, 'a') as f:
+            f.write('c\n')
+
+        self.assertEqual(
+            self.cache.parse(countingParse, self.path, lenient=False),
+            ['a', '', 'b', 'c'])
+        self.assertEqual(len(parseCalls), 2)
+
+    def test_unreadableEntryIsReparsed(self) -> None:
+        self.cache.parse(countingParse, self.path, lenient=False)
+        with open(self.cache.entryPath(countingParse, self.path, False),
+                  'wb') as f:
+            f.write(b'garbage')
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(
+                self.cache.parse(countingParse, self.path, lenient=False),
+                ['a', '', 'b'])
+        self.assertEqual(len(parseCalls), 2)
+
+    def test_evictsLeastRecentlyUsed(self) -> None:
+        paths = []
+        for i in range(3):
+            path = Path(self.directory.name) / 'statement{}.csv'.format(i)
+            with open(path, 'w') as f:
+                f.write('{}\n'.format(i) * 100)
+            paths.append(path)
+
+        self.cache.parse(countingParse, paths[0], lenient=False)
+        entrySize = self.cache.entryPath(countingParse, paths[0],
+                                         False).stat().st_size
+
+        cache = ParseCache(self.cache.directory, maxBytes=entrySize * 2)
+        cache.parse(countingParse, paths[1], lenient=False)
+
+        # Age the first entry, so it is evicted next.
+        oldEntry = cache.entryPath(countingParse, paths[0], False)
+        os.utime(oldEntry, (0, 0))
+
+        cache.parse(countingParse, paths[2], lenient=False)
+
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertFalse(oldEntry.exists())
+
+    def test_cachesRealParser(self) -> None:
+        path = Path('tests/fidelity_positions.csv')
+        positions = fidelity.parsePositions(path)
+
+        self.assertEqual(
+            self.cache.parse(fidelity.parsePositions, path, False), positions)
+        self.assertEqual(
+            self.cache.parse(fidelity.parsePositions, path, False), positions)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_hitFromAnotherProcess(self) -> None:
+        path = Path('tests/fidelity_positions.csv')
+        helpers.runWithHashSeed(
+            'from parsecache import ParseCache\n'
+            'from pathlib import Path\n'
+            'import fidelity\n'
+            'ParseCache(Path({!r})).parse(fidelity.parsePositions, Path({!r}), False)'
+            .format(str(self.cache.directory), str(path)),
+            hashSeed=1 if os.environ.get('PYTHONHASHSEED') != '1' else 2)
+
+        loaded = self.cache.parse(fidelity.parsePositions, path, False)
+        self.assertEqual(self.cache.hits, 1)
+
+        fresh = fidelity.parsePositions(path)
+        freshByInstrument = {p.instrument: p for p in fresh}
+        for p in loaded:
+            self.assertEqual(freshByInstrument[p.instrument], p)
+
+        self.assertEqual(combinePositions(loaded + fresh),
+                         combinePositions(fresh + fresh))
+
+    def test_hitReportsRecordedErrors(self) -> None:
+        first = ParseErrors()
+        self.assertEqual(
+            self.cache.parse(collectingParse,
+                             self.path,
+                             lenient=True,
+                             errors=first), ['a', 'b'])
+
+        second = ParseErrors()
+        self.assertEqual(
+            self.cache.parse(collectingParse,
+                             self.path,
+                             lenient=True,
+                             errors=second), ['a', 'b'])
+
+        self.assertEqual(parseCalls, [self.path])
+        self.assertEqual(first.countsByParser,
+                         {'test_parsecache.nonEmptyLine': 1})
+        self.assertEqual(second.countsByParser, first.countsByParser)
+        self.assertEqual(second.samples, first.samples)
+
+    def test_parserVersionCoversDependencies(self) -> None:
+        self.assertEqual(parserVersion(fidelity.parsePositions),
+                         parserVersion(fidelity.parseTransactions))
+        self.assertNotEqual(parserVersion(fidelity.parsePositions),
+                            parserVersion(countingParse))
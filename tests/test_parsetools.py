@@ -1,16 +1,25 @@
 from hypothesis import given, reproduce_failure
-from hypothesis.strategies import booleans, decimals, iterables, integers, none, nothing, one_of, text
-from parsetools import lenientParse
-from typing import Any, Iterable, no_type_check
+from hypothesis.strategies import booleans, decimals, iterables, integers, lists, none, nothing, one_of, text
+from parsetools import ParseErrors, lenientParse
+from typing import Any, Iterable, List, no_type_check
 
 import os
+import pickle
 import unittest
+import warnings
 
 
 def failingTransform(_: Any) -> Any:
     raise ValueError('Transform failed!')
 
 
+def parseEven(i: int) -> int:
+    if i % 2:
+        raise ValueError('Odd: {}'.format(i))
+
+    return i
+
+
 class TestParsetools(unittest.TestCase):
     @no_type_check
     @given(
@@ -35,4 +44,59 @@ class TestParsetools(unittest.TestCase):
                 lenientParse(i, transform=failingTransform, lenient=True))
 
         self.assertEqual(result, [])
-        self.assertIn(os.path.basename(__file__), cm.filename)
\ No newline at end of file
+        self.assertIn(os.path.basename(__file__), cm.filename)
+
+    @given(lists(integers()))
+    def test_lenientParseCollectsErrors(self, i: List[int]) -> None:
+        errors = ParseErrors(maxSamples=3)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            result = list(
+                lenientParse(i,
+                             transform=parseEven,
+                             lenient=True,
+                             errors=errors))
+
+        odd = [x for x in i if x % 2]
+        self.assertEqual(result, [x for x in i if not x % 2])
+        self.assertEqual(len(errors), len(odd))
+        self.assertEqual(errors.countsByType,
+                         {'ValueError': len(odd)} if odd else {})
+        self.assertEqual(
+            errors.countsByParser,
+            {'test_parsetools.parseEven': len(odd)} if odd else {})
+        self.assertEqual([s.input for s in errors.samples],
+                         [str(x) for x in odd[:3]])
+
+    def test_lenientParseErrorsIgnoredUnlessLenient(self) -> None:
+        errors = ParseErrors()
+        with self.assertRaises(ValueError):
+            list(
+                lenientParse([1],
+                             transform=parseEven,
+                             lenient=False,
+                             errors=errors))
+
+        self.assertEqual(len(errors), 0)
+
+    def test_parseErrorsUpdateAndSummary(self) -> None:
+        errors = ParseErrors(maxSamples=2, maxInputLength=5)
+        self.assertEqual(errors.summary(), 'No parse failures')
+
+        errors.record('a', 'x' * 10, ValueError('first'))
+
+        other = ParseErrors()
+        other.record('b', 'y', KeyError('second'))
+        other.record('b', 'z', ValueError('third'))
+        errors.update(pickle.loads(pickle.dumps(other)))
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(errors.countsByParser, {'a': 1, 'b': 2})
+        self.assertEqual(errors.countsByType, {'ValueError': 2, 'KeyError': 1})
+        self.assertEqual([s.input for s in errors.samples], ['xxxxx...', 'y'])
+
+        summary = errors.summary()
+        self.assertIn('Skipped 3 inputs', summary)
+        self.assertIn('First 2 of 3', summary)
+        self.assertIn('first', summary)
+        self.assertNotIn('third', summary)
@@ -0,0 +1,89 @@
+from datetime import datetime
+from decimal import Decimal
+from hypothesis import given
+from hypothesis.strategies import lists, text
+from rowschema import RowSchema, dateConverter, defaultIfEmpty
+from typing import Any, List, NamedTuple
+
+import unittest
+
+
+class Row(NamedTuple):
+    a: str
+    b: str
+    c: str
+
+
+class TestRowSchema(unittest.TestCase):
+    @given(lists(text(), min_size=3))
+    def test_matchesMake(self, values: List[str]) -> None:
+        self.assertEqual(
+            RowSchema(Row).compile()(values), Row._make(values[0:3]))
+
+    def test_onlyNeededFieldsAreRead(self) -> None:
+        schema = RowSchema(Row, needed=['b'])
+        self.assertEqual(schema.needed, ['b'])
+        self.assertEqual(schema.width, 2)
+
+        row = schema.compile()(['x', 'y'])
+        self.assertIsInstance(row, Row)
+        self.assertEqual(row.b, 'y')
+        self.assertEqual(repr(row), "Row(b='y')")
+
+    def test_unreadFieldsRaise(self) -> None:
+        row = RowSchema(Row, needed=['b']).compile()(['x', 'y', 'z'])
+        with self.assertRaisesRegex(AttributeError, 'a is not read'):
+            row.a
+        with self.assertRaisesRegex(AttributeError, 'c is not read'):
+            row.c
+
+    def test_allFieldsNeededBuildsRowType(self) -> None:
+        self.assertIs(type(RowSchema(Row).compile()(['x', 'y', 'z'])), Row)
+
+    def test_convertersForUnreadFieldsAreRejected(self) -> None:
+        with self.assertRaises(ValueError):
+            RowSchema(Row, needed=['a'], converters={'b': Decimal})
+
+    def test_shortRowRaisesValueError(self) -> None:
+        with self.assertRaisesRegex(ValueError, r"\['x', 'y'\]"):
+            RowSchema(Row).compile()(['x', 'y'])
+
+    def test_unknownFieldsAreRejected(self) -> None:
+        with self.assertRaises(ValueError):
+            RowSchema(Row, needed=['d'])
+        with self.assertRaises(ValueError):
+            RowSchema(Row, converters={'d': Decimal})
+
+    def test_converters(self) -> None:
+        schema: RowSchema[Any] = RowSchema(Row, converters={'c': Decimal})
+        self.assertEqual(schema.compile()(['x', 'y', '1.5']),
+                         ('x', 'y', Decimal('1.5')))
+
+        with self.assertRaisesRegex(ValueError,
+                                    r"c of Row from 'z'.*\['x', 'y', 'z'\]"):
+            schema.compile()(['x', 'y', 'z'])
+
+    def test_dateAndDefaultConverters(self) -> None:
+        schema: RowSchema[Any] = RowSchema(Row,
+                                           converters={
+                                               'a':
+                                               dateConverter('%m/%d/%Y'),
+                                               'c':
+                                               defaultIfEmpty(
+                                                   Decimal, Decimal(0)),
+                                           })
+        fromRow = schema.compile()
+        self.assertEqual(fromRow(['01/02/2019', 'y', '']),
+                         (datetime(2019, 1, 2), 'y', Decimal(0)))
+        self.assertEqual(fromRow(['01/02/2019', 'y', '3']),
+                         (datetime(2019, 1, 2), 'y', Decimal(3)))
+
+        with self.assertRaisesRegex(ValueError, 'a of Row'):
+            fromRow(['2019-01-02', 'y', ''])
+
+    def test_compileMapping(self) -> None:
+        schema = RowSchema(Row, needed=['a', 'c'])
+        self.assertEqual(schema.compileMapping()({
+            'a': 'x',
+            'b': 'y'
+        }), ('x', None, ''))
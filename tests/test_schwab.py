@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime
 from decimal import Decimal
 from itertools import groupby
 from model import Cash, Currency, Stock, Bond, Option, OptionType, Position, Trade, TradeFlags
@@ -241,5 +241,46 @@ class TestSchwabTransactions(unittest.TestCase):
         self.assertEqual(ts[0].flags, TradeFlags.CLOSE)
 
 
+def msftTrade(day: int, quantity: Decimal,
+              flags: TradeFlags = TradeFlags.OPEN) -> Trade:
+    return Trade(date=datetime(2018, 1, day),
+                 instrument=Stock('MSFT', Currency.USD),
+                 quantity=quantity,
+                 amount=helpers.cashUSD(-quantity * 90),
+                 fees=helpers.cashUSD(Decimal(0)),
+                 flags=flags)
+
+
+class TestFixUpShortSales(unittest.TestCase):
+    def test_shortSaleClosedByLaterTransfer(self) -> None:
+        transfers = [msftTrade(3, Decimal(5)), msftTrade(10, Decimal(10))]
+
+        # Trades are given newest first.
+        trades = [
+            msftTrade(12, Decimal(-10)),
+            msftTrade(8, Decimal(-7)),
+            msftTrade(4, Decimal(-5)),
+            msftTrade(2, Decimal(-10)),
+        ]
+
+        fixed = schwab.fixUpShortSales(trades, transfers)
+        self.assertEqual([t.flags for t in fixed], [
+            TradeFlags.CLOSE, TradeFlags.OPEN, TradeFlags.OPEN, TradeFlags.OPEN
+        ])
+        self.assertEqual(
+            [t.quantity for t in fixed],
+            [Decimal(-10),
+             Decimal(-5), Decimal(-7),
+             Decimal(-10)])
+
+    def test_coverAfterShortSale(self) -> None:
+        trades = [msftTrade(2, Decimal(5)), msftTrade(1, Decimal(-10))]
+
+        fixed = schwab.fixUpShortSales(trades, [])
+        self.assertEqual([t.flags for t in fixed],
+                         [TradeFlags.OPEN, TradeFlags.CLOSE])
+        self.assertEqual(fixed[1], trades[0].replacingFlags(TradeFlags.CLOSE))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@ from decimal import Decimal
 from itertools import groupby
 from model import Bond, Cash, Currency, Instrument, Position, Stock, Trade, TradeFlags
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 import helpers
 import unittest
@@ -18,6 +19,19 @@ class TestVanguardPositions(unittest.TestCase):
     def test_positionValidity(self) -> None:
         self.assertEqual(len(self.positions), 6)
 
+    def test_sectionsInEitherOrder(self) -> None:
+        path = Path('tests/vanguard_positions_and_transactions.csv')
+        with open(path) as f:
+            sections = f.read().split('\n\n')
+
+        with TemporaryDirectory() as directory:
+            reversedPath = Path(directory) / 'reversed.csv'
+            with open(reversedPath, 'w') as f:
+                f.write('\n\n'.join(reversed(sections)))
+
+            self.assertEqual(vanguard.parsePositionsAndTrades(reversedPath),
+                             vanguard.parsePositionsAndTrades(path))
+
     def test_tBill(self) -> None:
         self.assertEqual(
             self.positions[0].instrument,
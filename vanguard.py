@@ -1,12 +1,14 @@
-from analysis import realizedBasisForSymbol
+from analysis import realizedBasisBySymbol
 from collections import namedtuple
-from csvsectionslicer import parseSectionsForCSV, CSVSectionCriterion, CSVSectionResult
+from csvsectionslicer import streamSectionsForCSV, CSVSectionCriterion
 from datetime import datetime
 from decimal import Decimal
 from model import Bond, Cash, Currency, Instrument, Position, Stock, Trade, TradeFlags
-from parsetools import lenientParse
+from numericparsing import parseFiniteDecimal
+from parsetools import ParseErrors, lenientParse
 from pathlib import Path
-from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from rowschema import RowSchema, dateConverter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
 import csv
 import re
@@ -20,113 +22,181 @@ class PositionsAndTrades(NamedTuple):
 class VanguardPosition(NamedTuple):
     investmentName: str
     symbol: str
-    shares: str
+    shares: Decimal
     sharePrice: str
     totalValue: str
 
 
-class VanguardPositionAndTrades(NamedTuple):
+# The fields read by parseVanguardPosition().
+positionSchema = RowSchema(VanguardPosition,
+                           needed=['investmentName', 'symbol', 'shares'],
+                           converters={'shares': parseFiniteDecimal})
+
+
+class VanguardPositionAndBasis(NamedTuple):
     position: VanguardPosition
-    trades: List[Trade]
+    realizedBasisBySymbol: Dict[str, Cash]
+
+
+bondInvestmentNamePattern = re.compile(r'^.+\s\%\s.+$')
 
 
 def guessInstrumentForInvestmentName(name: str) -> Instrument:
     instrument: Instrument
-    if re.match(r'^.+\s\%\s.+$', name):
+    if bondInvestmentNamePattern.match(name):
         # TODO: Determine valid CUSIP for bonds
-        instrument = Bond(name, currency=Currency.USD, validateSymbol=False)
+        instrument = Bond.interned(name,
+                                   currency=Currency.USD,
+                                   validateSymbol=False)
     else:
-        instrument = Stock(name, currency=Currency.USD)
+        instrument = Stock.interned(name, currency=Currency.USD)
 
     return instrument
 
 
-def parseVanguardPositionAndTrades(vpb: VanguardPositionAndTrades) -> Position:
-    return parseVanguardPosition(vpb.position, vpb.trades)
+def parseVanguardPositionAndBasis(vpb: VanguardPositionAndBasis) -> Position:
+    return parseVanguardPosition(vpb.position, vpb.realizedBasisBySymbol)
 
 
 def parseVanguardPosition(p: VanguardPosition,
-                          trades: List[Trade]) -> Position:
+                          realizedBasisBySymbol: Dict[str, Cash]) -> Position:
     instrument: Instrument
     if len(p.symbol) > 0:
-        instrument = Stock(p.symbol, currency=Currency.USD)
+        instrument = Stock.interned(p.symbol, currency=Currency.USD)
     else:
         instrument = guessInstrumentForInvestmentName(p.investmentName)
 
-    qty = Decimal(p.shares)
-
-    realizedBasis = realizedBasisForSymbol(instrument.symbol, trades)
+    realizedBasis = realizedBasisBySymbol.get(instrument.symbol)
     assert realizedBasis, ("Invalid realizedBasis: %s for %s" %
                            (realizedBasis, instrument))
 
     return Position(instrument=instrument,
-                    quantity=qty,
+                    quantity=p.shares,
                     costBasis=realizedBasis)
 
 
-def __parsePositions(path: Path, trades: List[Trade],
-                     lenient: bool = False) -> List[Position]:
-    with open(path, newline='') as csvfile:
-        criterion = CSVSectionCriterion(
-            startSectionRowMatch=["Account Number"],
-            endSectionRowMatch=[],
-            rowFilter=lambda r: r[1:6])
-        sections = parseSectionsForCSV(csvfile, [criterion])
+def parsePositionsWithTrades(vanPositions: Iterable[VanguardPosition],
+                             trades: List[Trade],
+                             lenient: bool = False,
+                             errors: Optional[ParseErrors] = None
+                             ) -> List[Position]:
+    bases = realizedBasisBySymbol(trades)
+    vanPosAndBases = map(lambda pos: VanguardPositionAndBasis(pos, bases),
+                         vanPositions)
+
+    return list(
+        lenientParse(vanPosAndBases,
+                     transform=parseVanguardPositionAndBasis,
+                     lenient=lenient,
+                     errors=errors))
 
-        if len(sections) == 0:
-            return []
 
-        vanPositions = (VanguardPosition._make(r) for r in sections[0].rows)
-        vanPosAndBases = list(
-            map(lambda pos: VanguardPositionAndTrades(pos, trades),
-                vanPositions))
+positionsCriterion = CSVSectionCriterion(
+    startSectionRowMatch=["Account Number"],
+    endSectionRowMatch=[],
+    rowFilter=lambda r: r[1:6])
 
-        return list(
-            lenientParse(vanPosAndBases,
-                         transform=parseVanguardPositionAndTrades,
-                         lenient=lenient))
+transactionsCriterion = CSVSectionCriterion(
+    startSectionRowMatch=["Account Number", "Trade Date"],
+    endSectionRowMatch=[],
+    rowFilter=lambda r: r[1:-1])
 
 
+# Reads the holdings and transactions sections in a single pass over the file.
 def parsePositionsAndTrades(path: Path,
-                            lenient: bool = False) -> PositionsAndTrades:
-    trades = __parseTransactions(path, lenient=lenient)
-    positions = __parsePositions(path, trades=trades, lenient=lenient)
+                            lenient: bool = False,
+                            errors: Optional[ParseErrors] = None
+                            ) -> PositionsAndTrades:
+    positionRows: List[List[str]] = []
+    transactionRows: List[List[str]] = []
+
+    with open(path, newline='') as csvfile:
+        # Both sections start with "Account Number", so list transactions first for its longer match to be tried first.
+        for r in streamSectionsForCSV(
+                csvfile, [transactionsCriterion, positionsCriterion],
+                ordered=False):
+            if r.criterion is positionsCriterion:
+                positionRows.append(r.row)
+            else:
+                transactionRows.append(r.row)
+
+    # Rows are converted leniently, so that a malformed value is reported with the row it came from. Transactions which aren't trades are skipped beforehand, as they needn't hold valid amounts.
+    transactionType = transactionSchema.column('transactionType')
+    vanTransactions = lenientParse(
+        (r for r in transactionRows
+         if r[transactionType] in validTransactionTypes),
+        transform=transactionSchema.compile(),
+        lenient=lenient,
+        errors=errors,
+        parser='vanguard.parseVanguardTransaction')
+    vanPositions = lenientParse(positionRows,
+                                transform=positionSchema.compile(),
+                                lenient=lenient,
+                                errors=errors,
+                                parser='vanguard.parseVanguardPosition')
+
+    trades = parseTransactions(vanTransactions, lenient=lenient, errors=errors)
+    positions = parsePositionsWithTrades(vanPositions,
+                                         trades=trades,
+                                         lenient=lenient,
+                                         errors=errors)
     return PositionsAndTrades(positions, trades)
 
 
 class VanguardTransaction(NamedTuple):
-    tradeDate: str
+    tradeDate: datetime
     settlementDate: str
     transactionType: str
     transactionDescription: str
     investmentName: str
     symbol: str
-    shares: str
+    shares: Decimal
     sharePrice: str
-    principalAmount: str
-    commissionFees: str
+    principalAmount: Decimal
+    commissionFees: Decimal
     netAmount: str
     accruedInterest: str
     accountType: str
 
 
+# The fields read by parseVanguardTransaction().
+transactionSchema = RowSchema(VanguardTransaction,
+                              needed=[
+                                  'tradeDate', 'transactionType',
+                                  'transactionDescription', 'investmentName',
+                                  'symbol', 'shares', 'principalAmount',
+                                  'commissionFees'
+                              ],
+                              converters={
+                                  'tradeDate': dateConverter('%m/%d/%Y'),
+                                  'shares': parseFiniteDecimal,
+                                  'principalAmount': parseFiniteDecimal,
+                                  'commissionFees': parseFiniteDecimal,
+                              })
+
+validTransactionTypes = frozenset([
+    'Buy', 'Sell', 'Reinvestment', 'Corp Action (Redemption)',
+    'Transfer (outgoing)'
+])
+
+
 def forceParseVanguardTransaction(t: VanguardTransaction,
                                   flags: TradeFlags) -> Optional[Trade]:
     instrument: Instrument
     if len(t.symbol) > 0:
-        instrument = Stock(t.symbol, currency=Currency.USD)
+        instrument = Stock.interned(t.symbol, currency=Currency.USD)
     else:
         instrument = guessInstrumentForInvestmentName(t.investmentName)
 
-    totalFees = Decimal(t.commissionFees)
-    amount = Decimal(t.principalAmount)
+    totalFees = t.commissionFees
+    amount = t.principalAmount
 
     if t.transactionDescription == 'Redemption':
-        shares = Decimal(t.shares) * (-1)
+        shares = t.shares * (-1)
     else:
-        shares = Decimal(t.shares)
+        shares = t.shares
 
-    return Trade(date=datetime.strptime(t.tradeDate, '%m/%d/%Y'),
+    return Trade(date=t.tradeDate,
                  instrument=instrument,
                  quantity=shares,
                  amount=Cash(currency=Currency(Currency.USD), quantity=amount),
@@ -136,11 +206,6 @@ def forceParseVanguardTransaction(t: VanguardTransaction,
 
 
 def parseVanguardTransaction(t: VanguardTransaction) -> Optional[Trade]:
-    validTransactionTypes = set([
-        'Buy', 'Sell', 'Reinvestment', 'Corp Action (Redemption)',
-        'Transfer (outgoing)'
-    ])
-
     if t.transactionType not in validTransactionTypes:
         return None
 
@@ -157,22 +222,13 @@ def parseVanguardTransaction(t: VanguardTransaction) -> Optional[Trade]:
 
 
 # Transactions will be ordered from newest to oldest
-def __parseTransactions(path: Path, lenient: bool = False) -> List[Trade]:
-    with open(path, newline='') as csvfile:
-        transactionsCriterion = CSVSectionCriterion(
-            startSectionRowMatch=["Account Number", "Trade Date"],
-            endSectionRowMatch=[],
-            rowFilter=lambda r: r[1:-1])
-
-        sections = parseSectionsForCSV(csvfile, [transactionsCriterion])
-
-        if len(sections) == 0:
-            return []
-
-        return list(
-            filter(
-                None,
-                lenientParse(
-                    (VanguardTransaction._make(r) for r in sections[0].rows),
-                    transform=parseVanguardTransaction,
-                    lenient=lenient)))
+def parseTransactions(vanTransactions: Iterable[VanguardTransaction],
+                      lenient: bool = False,
+                      errors: Optional[ParseErrors] = None) -> List[Trade]:
+    return list(
+        filter(
+            None,
+            lenientParse(vanTransactions,
+                         transform=parseVanguardTransaction,
+                         lenient=lenient,
+                         errors=errors)))